@@ -278,6 +278,9 @@ def get_status(jobId):
     
     cfg_settings = jobs_list[jobId].settings
     status = ap.read_ideal_job_status(cfg_settings)
+    if status == ap.RUNNING:
+        # number of primaries, uncertainty and predictions per beam, from the job control daemon
+        return jsonify({'status': status, 'beams': ap.read_ideal_job_beam_statistics(jobs_list[jobId].workdir,cfg_settings)})
     return jsonify({'status': status})
 
 
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Benchmark of the gamma index computation with different numbers of worker processes.
+
+The reference dose is an analytical SOBP-like dose distribution (box-shaped
+field with a lateral penumbra, an entrance plateau and a distal falloff) on a
+dose grid of the size of a full CT. The target dose is the same distribution,
+slightly shifted and scaled, with statistical noise. For each number of workers
+the gamma index is computed with the same settings as in the postprocessing and
+the wall clock time is printed, such that the scaling curve can be measured on
+the machine on which the postprocessing runs.
+"""
+
+import argparse
+import itk
+import numpy as np
+from scipy.special import erf
+from datetime import datetime
+from utils.gamma_index import get_gamma_summary
+
+def sobp_dose(shape,spacing,field,shift=(0.,0.,0.),scale=1.,noise=0.,seed=1):
+    """
+    Dose on a grid with `shape` and `spacing` (x,y,z) centered on the origin, for a field with
+    size `field` (x,y,z) in mm: the dose is 1 inside the field, 0.4 in the entrance channel (z<field[2]/2)
+    and falls off with a lateral penumbra of 3 mm and a distal falloff of 2 mm.
+    """
+    def box(u,lo,hi,slo,shi):
+        return 0.25*(1+erf((u-lo)/(np.sqrt(2)*slo)))*(1-erf((u-hi)/(np.sqrt(2)*shi)))
+    x,y,z = [(np.arange(n)-0.5*(n-1))*s-d for n,s,d in zip(shape,spacing,shift)]
+    zz,yy,xx = np.meshgrid(z,y,x,indexing='ij')
+    fx,fy,fz = 0.5*np.array(field,dtype=float)
+    dose = box(xx,-fx,fx,3.,3.)*box(yy,-fy,fy,3.,3.)*(0.4+0.6*box(zz,-fz,fz,4.,2.))*box(zz,-0.5*shape[2]*spacing[2],fz,1.,2.)
+    dose *= scale
+    if noise > 0:
+        dose *= np.random.default_rng(seed).normal(1.,noise,dose.shape)
+    img = itk.GetImageFromArray(dose.astype(np.float32))
+    img.SetSpacing(spacing)
+    img.SetOrigin([-0.5*(n-1)*s for n,s in zip(shape,spacing)])
+    return img
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n","--nvoxels",nargs=3,type=int,default=[256,256,160],help="Number of voxels of the dose grid (x,y,z).")
+    parser.add_argument("-s","--spacing",nargs=3,type=float,default=[2.,2.,2.],help="Voxel size of the dose grid in mm (x,y,z).")
+    parser.add_argument("-f","--field",nargs=3,type=float,default=[100.,100.,100.],help="Field size and SOBP length in mm (x,y,z).")
+    parser.add_argument("-w","--workers",nargs='+',type=int,default=[1,2,4,8,16,32],help="Numbers of worker processes.")
+    parser.add_argument("-c","--chunk-voxels",type=int,default=2**20,help="Maximum number of target voxels per slab.")
+    parser.add_argument("-g","--gamma",nargs=3,type=float,default=[3.,3.,10.],help="DTA [mm], dose difference [%%] and threshold [%%].")
+    parser.add_argument("-p","--pass-rate-only",default=False,action='store_true',help="Only compute the pass rate (early stop of the search).")
+    args = parser.parse_args()
+    ref = sobp_dose(args.nvoxels,args.spacing,args.field)
+    target = sobp_dose(args.nvoxels,args.spacing,args.field,shift=(1.,0.,1.5),scale=1.02,noise=0.02)
+    dta,dd,threshold = args.gamma
+    nmask = np.sum(itk.GetArrayViewFromImage(target)>0.01*threshold*np.max(itk.GetArrayViewFromImage(ref)))
+    print("dose grid {} x {} x {} voxels of {} x {} x {} mm, {} voxels above threshold".format(*args.nvoxels,*args.spacing,nmask))
+    t1 = None
+    for n in args.workers:
+        t0 = datetime.now()
+        kwargs = dict(dta=dta,dd=dd,threshold=threshold,threshold_percent=True,chunk_voxels=args.chunk_voxels,n_workers=n)
+        if args.pass_rate_only:
+            summary = get_gamma_summary(ref,target,**kwargs)
+        else:
+            summary = get_gamma_summary(ref,target,pass_rate_only=False,**kwargs)
+        dt = (datetime.now()-t0).total_seconds()
+        t1 = dt if t1 is None else t1
+        print("{:3d} workers: {:8.2f} seconds (speedup {:5.2f}), {}".format(n,dt,t1/dt,summary))
+
+# vim: set et softtabstop=4 sw=4 smartindent:
@@ -20,6 +20,7 @@ from impl.hlut_conf import hlut_conf
 from impl.version import version_info
 import impl.dicom_functions as dcm
 from job_control_daemon import check_accuracy_for_beam, dose_monitoring_config, update_user_logs, periodically_check_statistical_accuracy
+from utils.job_dose_state import job_dose_state
 
 #global logger
 
@@ -224,6 +225,30 @@ class ideal_simulation():
         self.cfg = dose_monitoring_config(self.workdir,self.username,daemonize=False,uncertainty_goal_percent=self.percent_uncertainty_goal,
                                           minimum_number_of_primaries=self.number_of_primaries_per_beam,time_out_minutes=self.time_limit_in_minutes)
     
+    def get_beam_statistics(self,beamname,dosemhd):
+        """
+        Number of primaries and average uncertainty of a beam. If a job control
+        daemon is running for this job, then the statistics are taken from the
+        state that it shares (see `utils.job_dose_state`); the dose files are
+        only summed here if there is no such daemon, or if its state is stale.
+        Returns None if there are no statistics (yet) for this beam.
+        """
+        cfg = self.cfg
+        state = job_dose_state.load(cfg.workdir)
+        if state is not None and state.is_stale():
+            print(f"the state of the job control daemon (pid={state.pid}) is stale, summing the dose files")
+        elif state is not None and state.running:
+            if beamname not in state.beams:
+                print(f"the job control daemon did not check beam={beamname} yet")
+                return None
+            return state.beams[beamname]['n_particles'],state.mean_unc_pct(beamname)
+        dose_files = glob(os.path.join(cfg.workdir,"tmp","output.*.*",dosemhd))
+        if len(dose_files) == 0:
+            print(f"looks like simulation for {dosemhd} did not start yet (zero dose files)")
+            return None
+        dc = check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files)
+        return dc.tot_n_primaries,dc.mean_unc_pct
+
     def check_accuracy(self,sim_time_minutes,input_stop=False):
         cfg = self.cfg
         current_dict = dict()
@@ -232,31 +257,29 @@ class ideal_simulation():
             status = f"RUNNING GATE FOR BEAM={beamname}"
             current_dict[beamname]=dict()
             print(f"checking {dosemhd} for beam={beamname}")
-            dose_files = glob(os.path.join(cfg.workdir,"tmp","output.*.*",dosemhd))
-            if len(dose_files) == 0:
-                print(f"looks like simulation for {dosemhd} did not start yet (zero dose files)")
+            beam_stats = self.get_beam_statistics(beamname,dosemhd)
+            if beam_stats is None:
                 continue
-
-            dc = check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files)
-            current_dict[beamname]['n_particles']=dc.tot_n_primaries
-            current_dict[beamname]['average uncertainty']=dc.mean_unc_pct
+            tot_n_primaries,mean_unc_pct = beam_stats
+            current_dict[beamname]['n_particles']=tot_n_primaries
+            current_dict[beamname]['average uncertainty']=mean_unc_pct
             current_dict['simulation time in minutes'] = sim_time_minutes
             self.stats.append(current_dict)
             
             tmsg = f"Tsim = {sim_time_minutes} minutes (timeout = {cfg.time_out_minutes} minutes)"
-            nmsg = f"Nsim = {dc.tot_n_primaries} primaries (minimum = {cfg.min_num_primaries})"
-            umsg = f"Average Uncertainty = {dc.mean_unc_pct} pct (goal = {dc.cfg.unc_goal_pct} pct)"
+            nmsg = f"Nsim = {tot_n_primaries} primaries (minimum = {cfg.min_num_primaries})"
+            umsg = f"Average Uncertainty = {mean_unc_pct} pct (goal = {cfg.unc_goal_pct} pct)"
             msg = ""
             # Maybe the following logic tree can be compactified, but for now I prefer to spell it out very explicitly
             if sim_time_minutes > cfg.time_out_minutes > 0:
                 stop = True
                 msg = "STOP: time is up: " + tmsg
             elif cfg.min_num_primaries > 0:
-                if dc.tot_n_primaries < cfg.min_num_primaries:
+                if tot_n_primaries < cfg.min_num_primaries:
                     stop = False
                     msg = "CONTINUE: not yet enough primaries: " + nmsg
-                elif dc.cfg.unc_goal_pct > 0:
-                    if dc.mean_unc_pct < dc.cfg.unc_goal_pct:
+                elif cfg.unc_goal_pct > 0:
+                    if mean_unc_pct < cfg.unc_goal_pct:
                         stop = True
                         msg = "STOP: uncertainty goal reached: " + umsg
                     else:
@@ -265,8 +288,8 @@ class ideal_simulation():
                 else:
                     stop = True
                     msg = "STOP: desired number of primaries reached: " + nmsg
-            elif dc.cfg.unc_goal_pct > 0:
-                if dc.mean_unc_pct < dc.cfg.unc_goal_pct:
+            elif cfg.unc_goal_pct > 0:
+                if mean_unc_pct < cfg.unc_goal_pct:
                     stop = True
                     msg = "STOP: uncertainty goal reached: " + umsg
                 else:
@@ -24,7 +24,12 @@ from filelock import Timeout, SoftFileLock
 # IDEAL stuff
 from impl.system_configuration import get_sysconfig, system_configuration
 from impl.version import version_info
-from utils.resample_dose import mass_weighted_resampling
+from utils.resample_dose import ResamplingOperator, equal_geometry
+from utils.mhd_reader import read_mhd
+from utils.dose_statistics import batch_mean_and_std, uncertainty_history, top_dose_voxels, mean_and_std_of_mean_at, mean_relative_uncertainty
+from utils.file_watcher import get_file_watcher
+from utils.sparse_dose import box_accumulator, dose_box
+from utils.job_dose_state import job_dose_state
 import impl.dual_logging as dl
 
 def update_user_logs(user_cfg,status,section="DEFAULT",changes=dict()):
@@ -49,7 +54,8 @@ class dose_monitoring_config:
     * the post processing config file (e.g. to get the mass file)
     * the system configuration file (e.g. to get the parameters for the uncertainty calculation)
     """
-    def __init__(self,workdir,username,daemonize=False,uncertainty_goal_percent=0,minimum_number_of_primaries=0,time_out_minutes=0,sysconfig="",verbose=False,polling_interval_seconds=-1):
+    def __init__(self,workdir,username,daemonize=False,uncertainty_goal_percent=0,minimum_number_of_primaries=0,time_out_minutes=0,sysconfig="",verbose=False,polling_interval_seconds=-1,
+                 debounce_seconds=5.,file_poll_seconds=10.,predictive_stop=False):
         self.workdir = workdir
         self.verbose = verbose
         self.username = username
@@ -59,6 +65,9 @@ class dose_monitoring_config:
         self.time_out_minutes = time_out_minutes
         self.time_out_seconds = time_out_minutes*60
         self.polling_interval_seconds = polling_interval_seconds
+        self.debounce_seconds = debounce_seconds
+        self.file_poll_seconds = file_poll_seconds
+        self.predictive_stop = predictive_stop
         self.sysconfigfile = sysconfig
         post_proc_cfg = os.path.join(self.workdir,"postprocessor.cfg")
         if not os.path.exists(post_proc_cfg):
@@ -98,8 +107,41 @@ class dose_monitoring_config:
 class dose_collector:
     """
     The dose collector adds up the dose from all subjobs and if necessary computes the statistical ("Type A") uncertainty.
+
+    The collector is meant to persist between polling intervals: with `update`
+    only the dose files that are new or that changed since the previous update
+    (according to their modification time) are read and the sums are updated
+    with the difference between the new and the previous contribution of each
+    file. The last contribution of each dose file is saved in the checkpoint
+    directory (if given), together with the state of the sums, such that a
+    restarted daemon can continue where the previous one stopped.
+
+    If the dose needs to be resampled, then by default every dose file is
+    resampled before it is added to the sums. With the "resample dose after
+    sum" option in the system configuration, the dose files are distributed
+    over a fixed number of batches and the dose sums are accumulated per
+    batch on the simulation grid instead; only the batch sums are resampled,
+    in `estimate_uncertainty` (see `utils.dose_statistics`).
+
+    The sums are only stored for the box that contains the nonzero dose (see
+    `utils.sparse_dose`), and likewise only the box of each dose file is saved
+    as its contribution in the checkpoint directory.
+
+    The saved contributions are not free: the checkpoint directory (in the
+    `tmp` subdirectory of the work directory) holds the boxes of all dose
+    files, in the precision of the dose files, i.e. up to the total size of
+    the dose files themselves. When a dose file changed, its previous
+    contribution is read back and the new one is written, i.e. besides the
+    dose file itself twice the size of its box is read or written. Without checkpoint
+    directory nothing is saved, but then all dose files are read again in
+    every update. A contribution file is only removed after the checkpoint
+    that no longer refers to it has been saved.
+
+    Each uncertainty estimate is added to the `history` (also saved in the
+    checkpoint directory), which is used to predict when the uncertainty goal
+    will be reached.
     """
-    def __init__(self,cfg):
+    def __init__(self,cfg,checkpoint_dir=None,resampling_cache_dir=None):
         self.out_dose_nxyz = cfg.out_dose_nxyz.astype(int) #np.int
         self.sim_dose_nxyz = cfg.sim_dose_nxyz.astype(int) #np.int
 
@@ -110,8 +152,11 @@ class dose_collector:
                 msg = "mask resolution {} inconsistent with expected output dose resolution {}".format(self.out_dose_nxyz[::-1],self.amask.shape)
                 logger.error(msg)
                 raise RuntimeError(msg)
+            # flat indices of the voxels inside the mask: the uncertainty is only evaluated for these
+            self.mask_index = np.flatnonzero(self.amask>0)
         else:
             self.mask = None
+            self.mask_index = None
         if bool(cfg.mass_mhd):
             #self.mass = itk.imread(cfg.mass_mhd)
             self.mass = itk.imread(os.path.join(cfg.workdir,cfg.mass_mhd))
@@ -125,24 +170,58 @@ class dose_collector:
             msg += "you should provide EITHER both the mass and the mask file, OR neither of them."
             logger.error(msg)
             raise RuntimeError(msg)
+        if bool(self.mass) and bool(self.mask) and not equal_geometry(self.mass,self.mask):
+            # the overlaps and normalization for the resampling are the same for all dose files
+            tick = time.time()
+            self.resampler = ResamplingOperator(self.mass,self.mask,cache_dir=resampling_cache_dir)
+            logger.debug("Time to create resampling operator: "+str(time.time()-tick)+"s")
+        else:
+            self.resampler = None
         self.cfg = cfg
         syscfg = system_configuration.getInstance()
         self.ntop = syscfg["n top voxels for mean dose max"]
         self.toppct = syscfg["dose threshold as fraction in percent of mean dose max"]
+        self.resample_after_sum = bool(syscfg["resample dose after sum"]) and self.resampler is not None
+        self.nbatch = syscfg["number of batches for resampling after sum"] if self.resample_after_sum else 1
+        self.checkpoint_dir = checkpoint_dir
+        self.history = uncertainty_history()
         self.reset()
+        if bool(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir,exist_ok=True)
+            self.load_checkpoint()
     def reset(self):
-        # the sums
-        self.dosesum = np.zeros(self.out_dose_nxyz[::-1],dtype=float)
-        # the sums of the squares
-        self.dose2sum = np.zeros(self.out_dose_nxyz[::-1],dtype=float)
+        if self.resample_after_sum:
+            # the sums per batch (one channel per batch), on the simulation grid
+            self.sums = box_accumulator(self.sim_dose_nxyz[::-1],nchannels=self.nbatch)
+            # the number of primaries per batch (the sums of the squares are computed from the resampled batch sums)
+            self.batch_weights = np.zeros(self.nbatch,dtype=float)
+        else:
+            # channel 0: the sums, channel 1: the sums of the squares (divided by the number of primaries)
+            self.sums = box_accumulator(self.out_dose_nxyz[::-1],nchannels=2)
+            self.batch_weights = None
+        # flat indices of the voxels in the box of the sums that are inside the mask
+        self._box_mask_index = (None,None)
         self.weightsum = 0
         self.wmin = np.inf
         self.wmax = -np.inf
         self.mean_unc_pct = np.inf
         self.n = 0
-    def get_nprimaries(self,dose_file):
+        # dose file path => (modification time in ns, number of primaries, file name of the saved contribution, batch)
+        self.contributions = dict()
+        self.ncontrib = 0
+        # saved contributions that can be removed after the next checkpoint
+        self.obsolete = list()
+    def get_stat_file(self,dose_file):
         statActorTxt=os.path.basename(dose_file).replace("idc-","statActor-").replace("-DoseToWater.mhd",".txt").replace("-Dose.mhd",".txt")
-        statspath=os.path.join(os.path.dirname(dose_file),statActorTxt)
+        return os.path.join(os.path.dirname(dose_file),statActorTxt)
+    def get_mtime(self,dose_file):
+        """
+        Latest modification time (in ns) of the dose MHD file, the corresponding raw data file and the stat actor file.
+        """
+        related = [dose_file[:-4]+".raw",dose_file[:-4]+".zraw",self.get_stat_file(dose_file)]
+        return max([os.stat(dose_file).st_mtime_ns]+[os.stat(f).st_mtime_ns for f in related if os.path.exists(f)])
+    def get_nprimaries(self,dose_file):
+        statspath=self.get_stat_file(dose_file)
         logger.debug("going to get #primaries from stat actor file {}".format(statspath))
         assert(os.path.exists(statspath))
         with open(statspath,"r") as sf:
@@ -155,9 +234,15 @@ class dose_collector:
     @property
     def tot_n_primaries(self):
         return int(self.weightsum)
-    def add(self,dose_file):
+    def read_dose(self,dose_file):
+        """
+        Read the dose (resampled to the output dose resolution if necessary, unless
+        the dose is resampled after summing) and the number of primaries of a dose file.
+        Returns None if the lock could not be acquired, otherwise the number of primaries and the dose
+        (a `dose_box`, or None if the dose file could not be used).
+        """
         lockfile = dose_file+".lock"
-        dose = None
+        adose = None
         n_primaries=0
         t0=datetime.now()
         logger.debug("lockfile exists" if os.path.exists(lockfile) else "lockfile does not exist")
@@ -171,20 +256,23 @@ class dose_collector:
                 n_primaries = self.get_nprimaries(dose_file)
                 if n_primaries<1:
                     logger.warn(f"dose file seems to be based on too few primaries ({n_primaries})")
-                elif bool(self.mass) and bool(self.mask):
+                elif self.resampler is not None and not self.resample_after_sum:
                     tick = time.time()
-                    simdose=itk.imread(dose_file)
-                    logger.debug("Time to read dose file: "+str(time.time()-tick)+"s")
-                    logger.debug("resampling dose with size {} using mass file of size {} to target size {}".format(itk.size(simdose),itk.size(self.mass),itk.size(self.mask)))
-                    tick = time.time()
-                    dose = mass_weighted_resampling(simdose,self.mass,self.mask)
-                    logger.debug("Time for resampling: "+str(time.time()-tick)+"s")
-                    del simdose
+                    amap,geometry=read_mhd(dose_file)
+                    logger.debug("resampling dose with size {} using mass file of size {} to target size {}".format(geometry.size,itk.size(self.mass),itk.size(self.mask)))
+                    # the resampling reads the memory mapped dose only once, while we hold the lock
+                    adose = self.sums.crop(self.resampler.apply(amap))
+                    del amap
+                    logger.debug("Time for reading and resampling: "+str(time.time()-tick)+"s")
                 else:
                     tick = time.time()
-                    dose=itk.imread(dose_file)
+                    # The dose file is memory mapped and the box with nonzero dose is copied only once, while
+                    # we hold the lock: the running simulation may rewrite the file as soon as the lock is released.
+                    amap,geometry=read_mhd(dose_file)
+                    adose=self.sums.crop(amap)
+                    del amap
                     logger.debug("Time to read dose file: "+str(time.time()-tick)+"s")
-                    logger.debug("read dose with size {}".format(itk.size(dose)))
+                    logger.debug("read dose with size {}".format(geometry.size))
                 t2=datetime.now()
                 logger.info("acquiring dose data {} file took {} seconds".format(os.path.basename(dose_file),(t2-t1).total_seconds()))
                 if self.wmin>n_primaries:
@@ -193,68 +281,227 @@ class dose_collector:
                     self.wmax = n_primaries
         except Timeout:
             logger.warn("failed to acquire lock for {} for 3 seconds, giving up for now".format(dose_file))
-            return
-        if not bool(dose):
+            return None
+        if adose is None:
             logger.warn("skipping {}".format(dose_file))
+            return n_primaries,None
+        if adose.shape != self.sums.shape:
+            raise RuntimeError("PROGRAMMING ERROR: dose shape {} differs from expected shape {}".format(adose.shape,self.sums.shape))
+        return n_primaries,adose
+    def _increment(self,adose,n_primaries,sign=1,batch=0):
+        if self.resample_after_sum:
+            self.sums.add(adose,batch,weight=sign)
+            self.batch_weights[batch] += sign*n_primaries
+        else:
+            self.sums.add(adose,0,weight=sign) # n_primaries * (adose / n_primaries)
+            self.sums.add(adose,1,weight=sign/n_primaries,power=2) # n_primaries * (adose / n_primaries)**2
+        self.weightsum += sign*n_primaries
+        self.n += sign
+    def add(self,dose_file):
+        result = self.read_dose(dose_file)
+        if result is None or result[1] is None:
             return
+        n_primaries,adose = result
         tick = time.time()
-        adose = itk.array_from_image(dose)
-        print("Time array from image: "+str(time.time()-tick)+"s")
-        if adose.shape != self.dosesum.shape:
-            raise RuntimeError("PROGRAMMING ERROR: dose shape {} differs from expected shape {}".format(adose.shape,self.dosesum.shape))
-        tick = time.time()
-        self.dosesum += adose # n_primaries * (adose / n_primaries)
-        self.dose2sum += adose**2 / n_primaries # n_primaries * (adose / n_primaries)**2
-        self.weightsum += n_primaries
-        self.n += 1
+        self._increment(adose,n_primaries,batch=self.n%self.nbatch)
         logger.debug("Time increment variables: "+str(time.time()-tick)+"s")
+    def _remove_contribution(self,dose_file):
+        mtime,n_primaries,fname,batch = self.contributions.pop(dose_file)
+        if bool(fname):
+            fpath = os.path.join(self.checkpoint_dir,fname)
+            with np.load(fpath) as contribution:
+                adose = dose_box(contribution['shape'],contribution['lo'],contribution['data'])
+            self._increment(adose,n_primaries,sign=-1,batch=batch)
+            # the saved checkpoint still refers to the file
+            self.obsolete.append(fpath)
+    def _add_contribution(self,dose_file,mtime,n_primaries,adose):
+        fname = ""
+        batch = self.ncontrib % self.nbatch
+        if bool(self.checkpoint_dir):
+            fname = "dose{:06d}.npz".format(self.ncontrib)
+            np.savez(os.path.join(self.checkpoint_dir,fname),shape=adose.shape,lo=adose.lo,data=adose.data)
+        self.ncontrib += 1
+        self._increment(adose,n_primaries,batch=batch)
+        self.contributions[dose_file] = (mtime,n_primaries,fname,batch)
+    def update(self,dose_files):
+        """
+        Incremental version of `add` for a list of dose files: files that did not
+        change since the previous update are not read again, and files that are no
+        longer in the list are removed from the sums. Without checkpoint directory,
+        all files are read again (like with `add`).
+        Returns the number of dose files that were (re)read.
+        """
+        if not bool(self.checkpoint_dir):
+            self.reset()
+            for dose_file in dose_files:
+                self.add(dose_file)
+            return len(dose_files)
+        nread = 0
+        for dose_file in set(self.contributions.keys()).difference(dose_files):
+            logger.debug(f"removing contribution of {dose_file}")
+            self._remove_contribution(dose_file)
+        for dose_file in dose_files:
+            try:
+                mtime = self.get_mtime(dose_file)
+            except OSError as e:
+                logger.warn(f"cannot stat {dose_file}: {e}")
+                continue
+            if dose_file in self.contributions and self.contributions[dose_file][0] == mtime:
+                continue
+            result = self.read_dose(dose_file)
+            nread += 1
+            if result is None:
+                # could not get the lock, keep the previous contribution (if any) until the next update
+                continue
+            n_primaries,adose = result
+            if dose_file in self.contributions:
+                self._remove_contribution(dose_file)
+            if adose is not None:
+                self._add_contribution(dose_file,mtime,n_primaries,adose)
+        nprim = [c[1] for c in self.contributions.values()]
+        self.wmin = min(nprim,default=np.inf)
+        self.wmax = max(nprim,default=-np.inf)
+        self.save_checkpoint()
+        return nread
+    @property
+    def checkpoint_file(self):
+        return os.path.join(self.checkpoint_dir,"state.npz")
+    @property
+    def history_file(self):
+        return os.path.join(self.checkpoint_dir,"history.txt")
+    def save_checkpoint(self):
+        """
+        Save the sums and the bookkeeping of the dose file contributions. The file is replaced atomically,
+        after that the contribution files that are no longer referenced are removed.
+        """
+        tmpfile = self.checkpoint_file+".tmp"
+        paths = list(self.contributions.keys())
+        with open(tmpfile,"wb") as fp:
+            empty = self.sums.box is None
+            np.savez(fp,
+                     shape=np.array(self.sums.shape),
+                     box=np.zeros((2,len(self.sums.shape)),dtype=np.int64) if empty else np.array(self.sums.box),
+                     sums=np.zeros((0,),dtype=float) if empty else self.sums.data,
+                     batch_weights=np.zeros((0,),dtype=float) if self.batch_weights is None else self.batch_weights,
+                     paths=np.array(paths,dtype=str),
+                     mtimes=np.array([self.contributions[p][0] for p in paths],dtype=np.int64),
+                     nprimaries=np.array([self.contributions[p][1] for p in paths],dtype=np.int64),
+                     fnames=np.array([self.contributions[p][2] for p in paths],dtype=str),
+                     batches=np.array([self.contributions[p][3] for p in paths],dtype=np.int64),
+                     ncontrib=np.array(self.ncontrib),
+                     resample_after_sum=np.array(self.resample_after_sum))
+        os.replace(tmpfile,self.checkpoint_file)
+        for fpath in self.obsolete:
+            if os.path.exists(fpath):
+                os.remove(fpath)
+        self.obsolete = list()
+    def load_checkpoint(self):
+        """
+        Restore the state that was saved by a previous daemon, if any. If a contribution file
+        that the checkpoint refers to is missing, the checkpoint is not used.
+        Contribution files that are not referenced by the checkpoint (left-overs of an interrupted update) are removed.
+        """
+        if os.path.exists(self.checkpoint_file):
+            try:
+                with np.load(self.checkpoint_file) as state:
+                    if tuple(state['shape']) != self.sums.shape:
+                        raise RuntimeError("checkpoint dose shape {} differs from expected shape {}".format(tuple(state['shape']),self.sums.shape))
+                    if bool(state['resample_after_sum']) != self.resample_after_sum:
+                        raise RuntimeError("checkpoint was saved with a different resampling mode")
+                    if state['sums'].size > 0:
+                        if state['sums'].shape[0] != self.sums.nchannels:
+                            raise RuntimeError("checkpoint has {} dose sums, expected {}".format(state['sums'].shape[0],self.sums.nchannels))
+                        self.sums.box = tuple([tuple(b) for b in state['box'].tolist()])
+                        self.sums.data = np.array(state['sums'],dtype=self.sums.dtype)
+                    if self.batch_weights is not None:
+                        self.batch_weights[:] = state['batch_weights']
+                    for path,mtime,n_primaries,fname,batch in zip(state['paths'],state['mtimes'],state['nprimaries'],state['fnames'],state['batches']):
+                        if bool(str(fname)) and not os.path.exists(os.path.join(self.checkpoint_dir,str(fname))):
+                            raise RuntimeError(f"contribution file {fname} of {path} is missing")
+                        self.contributions[str(path)] = (int(mtime),int(n_primaries),str(fname),int(batch))
+                    self.ncontrib = int(state['ncontrib'])
+                self.n = len(self.contributions)
+                self.weightsum = sum([c[1] for c in self.contributions.values()])
+                logger.info(f"restored dose sums of {self.n} dose files from {self.checkpoint_file}")
+            except Exception as e:
+                logger.warn(f"failed to restore dose sums from {self.checkpoint_file}, starting from scratch: {e}")
+                self.reset()
+        if os.path.exists(self.history_file):
+            try:
+                self.history.load(self.history_file)
+            except Exception as e:
+                logger.warn(f"failed to restore uncertainty history from {self.history_file}: {e}")
+        known = set([c[2] for c in self.contributions.values()])
+        for fname in os.listdir(self.checkpoint_dir):
+            if fname.startswith("dose") and fname.endswith((".npy",".npz")) and fname not in known:
+                os.remove(os.path.join(self.checkpoint_dir,fname))
+    @property
+    def box_mask_index(self):
+        """
+        Flat indices (in the box of the dose sums) of the voxels inside the mask, or None without a mask.
+        """
+        if self.mask_index is None or self.sums.box is None:
+            return None
+        box,index = self._box_mask_index
+        if box != self.sums.box:
+            index = np.flatnonzero(self.amask[self.sums.slices]>0)
+            self._box_mask_index = (self.sums.box,index)
+        return index
     def estimate_uncertainty(self):
+        self.mean_unc_pct = np.inf
         if self.n < 2:
             return
-        if self.mask:
-            amask = itk.array_view_from_image(self.mask)
-            logger.info("applying mask with {} voxels enabled out of {}".format(np.sum(amask>0),np.prod(amask.shape)))
-            self.dosesum *= amask
-            self.dose2sum *= amask
-        logger.info("dose sum is nonzero in {} voxels".format(np.sum(self.dosesum>0)))
-        logger.info("dose**2 sum is nonzero in {} voxels".format(np.sum(self.dose2sum>0)))
         logger.info("sum of weights is {}, wmin={}, wmax={}".format(self.weightsum,self.wmin,self.wmax))
-        amean = self.dosesum/self.weightsum
-        amean2 = self.dose2sum/self.weightsum
-        avariance = amean2 - amean**2
-        m0 = avariance<0
-        logger.info("negative variance in {} voxels".format(np.sum(m0)))
-        avariance[m0] = 0.
-        m0 = amean<0
-        logger.info("negative mean in {} voxels".format(np.sum(m0)))
-        amean[m0] = 0.
-        m0 = amean>0
-        m00 = amean2>0
-        logger.info("positive mean in {} voxels".format(np.sum(m0)))
-        logger.info("positive mean of squares in {} voxels".format(np.sum(m00)))
-        logger.info("positive mean and mean of squares masks are different in {} voxels".format(np.sum(m0!=m00)))
-        logger.info("average/median of nonzero variance in is {}/{}".format(np.mean(avariance[m0]),np.median(avariance[m0])))
-        logger.info("average/median of nonzero mean in is {}/{}".format(np.mean(amean[m0]),np.median(amean[m0])))
-        logger.info("average/median of nonzero mean of squares in is {}/{}".format(np.mean(amean2[m0]),np.median(amean2[m0])))
-        logger.info("average/median of nonzero square of the mean in is {}/{}".format(np.mean(amean[m0]**2),np.median(amean[m0]**2)))
-        std_pct = np.full_like(avariance,100.)
-        std_pct[m0] = np.sqrt(avariance[m0]/self.n)*100./amean[m0]
-        dmax = np.mean(np.partition(amean.flat,-self.ntop)[-self.ntop:])
-        dthr = dmax * self.toppct / 100.0
-        mask = (amean>dthr)
-        logger.info("{} voxels have more than {} percent of the 'max dose'".format(np.sum(mask),self.toppct))
-        self.mean_unc_pct = np.mean(std_pct[mask])
+        # The sums themselves are not modified, they are updated incrementally.
+        # The mean and the uncertainty are only computed for the voxels inside the
+        # mask with a dose above the threshold (see utils.dose_statistics).
+        if self.resample_after_sum:
+            # the batch sums are resampled on the full simulation grid
+            batch_sums = (self.sums.full(b) for b in range(self.nbatch))
+            amean,astd,nbatch = batch_mean_and_std(batch_sums,self.batch_weights,self.resampler)
+            logger.info("resampled the dose sums of {} batches".format(nbatch))
+            if nbatch < 2:
+                return
+            voxels,dmax = top_dose_voxels(amean,self.ntop,self.toppct,self.mask_index)
+            vmean,vstd = amean.reshape(-1)[voxels],astd.reshape(-1)[voxels]
+        else:
+            # the dose sum is proportional to the mean dose; outside of the box of the sums the dose is zero
+            dosesum,dose2sum = self.sums.channel(0),self.sums.channel(1)
+            voxels,dmax = top_dose_voxels(dosesum,self.ntop,self.toppct,self.box_mask_index)
+            dmax /= self.weightsum
+            vmean,vstd = mean_and_std_of_mean_at(dosesum,dose2sum,self.weightsum,self.n,voxels)
+        if logger.isEnabledFor(logging.DEBUG):
+            # these statistics need several passes over the box of the dose sums
+            logger.debug("dose sums are stored for box {} ({} MB)".format(self.sums.box,self.sums.nbytes/2**20))
+            logger.debug("dose sum is nonzero in {} voxels".format(np.sum(self.sums.data[0]>0) if self.sums.data is not None else 0))
+            if self.mask_index is not None:
+                logger.debug("applying mask with {} voxels enabled out of {}".format(len(self.mask_index),self.amask.size))
+            if len(voxels) > 0:
+                logger.debug("average/median of standard deviation of the mean above threshold is {}/{}".format(np.mean(vstd),np.median(vstd)))
+                logger.debug("average/median of mean above threshold is {}/{}".format(np.mean(vmean),np.median(vmean)))
+        logger.info("{} voxels have more than {} percent of the 'max dose' {}".format(len(voxels),self.toppct,dmax))
+        self.mean_unc_pct = mean_relative_uncertainty(vmean,vstd)
+        self.history.add(time.time(),self.tot_n_primaries,self.mean_unc_pct)
+        if bool(self.checkpoint_dir):
+            self.history.save(self.history_file)
         # if no goal is specified, this will never converge
         converged = self.mean_unc_pct < self.cfg.unc_goal_pct
         logger.info("'mean uncertainty' = {0:.2f} pct, goal = {1} pct, => {2}".format(self.mean_unc_pct,self.cfg.unc_goal_pct,"CONVERGED" if converged else "CONTINUE"))
 
-def check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files):
+def check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files,dc=None):
+    """
+    Sum the dose of all (finished or running) subjobs of a beam and estimate the uncertainty.
+    If a dose collector `dc` from a previous polling interval is given, then
+    it is updated with only the new and changed dose files.
+    """
     tick = time.time()
-    dc=dose_collector(cfg)
-    logger.debug("Time to create dose collector: "+str(time.time()-tick)+ "s")
+    if dc is None:
+        dc=dose_collector(cfg)
+        logger.debug("Time to create dose collector: "+str(time.time()-tick)+ "s")
     ndosefiles=0
     nfinished=0
     ncrashed=0
+    summable=list()
     for dose_file in dose_files:
         ndosefiles+=1
         outputdir=os.path.basename(os.path.dirname(dose_file))
@@ -266,7 +513,7 @@ def check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files):
                     if 0 == ret:
                         nfinished+=1
                         final_dose_file = os.path.join(cfg.workdir,outputdir,dosemhd)
-                        dc.add(final_dose_file)
+                        summable.append(final_dose_file)
                         logger.debug(f"adding {final_dose_file} to list of summable dose files, because Gate terminated successfully.")
                     else:
                         ncrashed+=1
@@ -274,10 +521,10 @@ def check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files):
             except Exception as e:
                 logger.error(f"gate exit file {retfile} exists but a problem arose when trying to read the return value from it: {e}")
         else:
-            tick1 = time.time()
-            dc.add(dose_file)
-            logger.debug("Time to add single dose file: "+str(time.time()-tick1)+ "s")
-            
+            summable.append(dose_file)
+    tick1 = time.time()
+    nread = dc.update(summable)
+    logger.debug(f"Time to read {nread} new or changed dose files: "+str(time.time()-tick1)+ "s")
     logger.info(f"found {ndosefiles} dose files '{dosemhd}'")
     logger.info(f"using {dc.n} for summed dose, {nfinished} jobs have finished successfully, {ncrashed} jobs have crashed.")
     tick2 = time.time()
@@ -287,6 +534,52 @@ def check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files):
             
     return dc
 
+def predict_convergence(cfg,dc,t0):
+    """
+    Predict, from the uncertainty history of dose collector `dc`, when the
+    stopping criteria will be met and what the uncertainty will be when the
+    subjobs stop. The subjobs see the STOP flag only after at most one polling
+    interval (the stop on script actor time interval), and they keep simulating
+    until then.
+    Returns a dictionary with the predictions (for the user logs; empty if no
+    prediction is possible yet) and a flag that is True if the number of
+    primaries and/or uncertainty goal will be reached within one polling
+    interval, so that a STOP flag written now would not stop the simulation
+    too early.
+    """
+    history = dc.history
+    if history.fit() is None:
+        return dict(),False
+    now = time.time()
+    latency = cfg.polling_interval_seconds
+    t_timeout = t0.timestamp()+cfg.time_out_seconds if cfg.time_out_minutes > 0 else np.inf
+    t_goal = np.inf
+    if cfg.unc_goal_pct > 0 or cfg.min_num_primaries > 0:
+        t_goal = history.records[-1][0] + history.time_to_reach(cfg.unc_goal_pct,cfg.min_num_primaries)
+    t_stop = min(t_goal,t_timeout)
+    if not np.isfinite(t_stop):
+        return dict(),False
+    stop_now = bool(cfg.predictive_stop and t_goal <= now+latency)
+    t_final = max(t_goal,now+latency) if cfg.predictive_stop and t_goal <= t_timeout else t_stop+latency
+    prediction = {"predicted time to stop [s]": "{:.0f}".format(max(0.,t_stop-now)),
+                  "predicted stop time": datetime.fromtimestamp(t_stop).ctime(),
+                  "predicted final number of primaries": "{:.0f}".format(history.primaries_at(t_final)),
+                  "predicted final uncertainty [pct]": "{:.3f}".format(history.predicted_uncertainty(t_final)),
+                  "simulation rate [primaries/s]": "{:.1f}".format(history.fit()[1])}
+    return prediction,stop_now
+
+def get_dose_file_watcher(cfg):
+    """
+    Watcher for the dose files of all beams: the copies of the (intermediate)
+    dose files in tmp/output.*.*, the release of the lock with which they are
+    copied, and the exit value files of the subjobs.
+    """
+    patterns = ["output.*.*/gate_exit_value.txt"]
+    for dosemhd in cfg.dose_mhd_list:
+        patterns += [os.path.join("tmp","output.*.*",dosemhd),os.path.join("tmp","output.*.*",dosemhd+".lock")]
+    return get_file_watcher(cfg.workdir,patterns,poll_seconds=cfg.file_poll_seconds,
+                            debounce_seconds=cfg.debounce_seconds,max_delay_seconds=max(cfg.debounce_seconds,0.1*cfg.polling_interval_seconds))
+
 def periodically_check_statistical_accuracy(cfg):
     # Get/Create the system config only now, AFTER (possibly) daemonizing.
     # Because the system config creation also initializes the logging system,
@@ -302,18 +595,37 @@ def periodically_check_statistical_accuracy(cfg):
     logger = dl.create_logger('job_daemon',logfilename)
     #logger = logging.getLogger()
     cfg.polling_interval_seconds = syscfg['stop on script actor time interval [s]'] if cfg.polling_interval_seconds<0 else cfg.polling_interval_seconds
+    cfg.predictive_stop = cfg.predictive_stop or syscfg['predictive stopping']
     t0 = None
+    dose_collectors = dict()
+    last_check = dict()
     save_curdir=os.path.realpath(os.curdir)
+    watcher = None
+    # the statistics of all beams, for the API and other processes (see utils.job_dose_state)
+    state = job_dose_state(cfg.workdir,polling_interval=cfg.polling_interval_seconds)
     try:
+        state.save()
         #config_logging(cfg)
         os.chdir(cfg.workdir)
         if len(cfg.dose_mhd_list)==0:
             logger.error("zero dose files configured?!")
+        # The accuracy is checked as soon as new dose files have been written (see
+        # utils.file_watcher), and for every beam at least once per polling interval.
+        watcher = get_dose_file_watcher(cfg)
+        changed = None
         while len(cfg.dose_mhd_list)>0:
-            logger.debug(f"going to sleep for {cfg.polling_interval_seconds} seconds")
-            time.sleep(cfg.polling_interval_seconds)
-            logger.debug("waking up from polling interval sleep")
-            for beamname,dosemhd in zip(cfg.beamname_list,cfg.dose_mhd_list):
+            if changed is not None:
+                logger.debug(f"going to wait at most {cfg.polling_interval_seconds} seconds for new dose files")
+                changed = watcher.wait(cfg.polling_interval_seconds)
+                logger.debug("waking up: {} changed files".format("unknown number of" if changed is None else len(changed)))
+                # heartbeat, such that readers can tell that the daemon is still alive
+                state.save()
+            for beamname,dosemhd in list(zip(cfg.beamname_list,cfg.dose_mhd_list)):
+                changed_files = None if changed is None else [f for f in changed if os.path.basename(f) == "gate_exit_value.txt" or os.path.basename(f).startswith(dosemhd)]
+                if changed_files == [] and time.time()-last_check.get(dosemhd,0) < cfg.polling_interval_seconds:
+                    logger.debug(f"no new dose files for beam={beamname}")
+                    continue
+                last_check[dosemhd] = time.time()
                 logger.info(f"checking {dosemhd} for beam={beamname}")
                 dose_files = glob(os.path.join(cfg.workdir,"tmp","output.*.*",dosemhd))
                 if len(dose_files) == 0:
@@ -326,7 +638,11 @@ def periodically_check_statistical_accuracy(cfg):
                     logger.info(f"starting the clock at t0={t0}")
                     
                 status = f"RUNNING GATE FOR BEAM={beamname}"   
-                dc = check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files)
+                if dosemhd not in dose_collectors:
+                    checkpoint_dir = os.path.join(cfg.workdir,"tmp","dose_collector_"+dosemhd.replace(".mhd",""))
+                    resampling_cache_dir = os.path.join(cfg.workdir,"tmp","resampling_cache")
+                    dose_collectors[dosemhd] = dose_collector(cfg,checkpoint_dir,resampling_cache_dir)
+                dc = check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files,dose_collectors[dosemhd])
         
                 sim_time_minutes = (datetime.now()-t0).total_seconds()/60.
                 tmsg = f"Tsim = {sim_time_minutes} minutes (timeout = {cfg.time_out_minutes} minutes)"
@@ -362,16 +678,36 @@ def periodically_check_statistical_accuracy(cfg):
                 else:
                     stop = False
                     msg = "CONTINUE: time out not yet reached: " + tmsg
+                prediction,stop_now = predict_convergence(cfg,dc,t0)
+                if stop_now and not stop:
+                    stop = True
+                    msg = "STOP: the stopping criteria will be met before the next check: " + (umsg if dc.cfg.unc_goal_pct > 0 else nmsg)
                 logger.info(f"{dosemhd} {tmsg} {nmsg} {umsg}")
+                if prediction:
+                    logger.info("prediction: " + ", ".join([f"{k} = {v}" for k,v in prediction.items()]))
                 logger.info(msg)
-                update_user_logs(cfg.user_cfg,status,section=beamname,changes={"job control daemon status":msg})
+                changes = {"job control daemon status":msg}
+                changes.update(prediction)
+                update_user_logs(cfg.user_cfg,status,section=beamname,changes=changes)
+                state.set_beam(beamname,job_dose_state.beam_stats(dosemhd,dc.n,dc.tot_n_primaries,dc.mean_unc_pct,msg,stopped=stop,
+                                                                  **{"simulation time in minutes":sim_time_minutes},**prediction))
+                state.save()
                 if stop:
                     with open(os.path.join(cfg.workdir,"STOP_"+dosemhd),"w") as stopfd:
                         stopfd.write("{msg}\n")
                     cfg.dose_mhd_list.remove(dosemhd)
                     cfg.beamname_list.remove(beamname)
+            if changed is None:
+                changed = set()
     except Exception as e:
         logger.error(f"job control daemon failed: {e}")
+    if watcher is not None:
+        watcher.close()
+    try:
+        state.running = False
+        state.save()
+    except Exception as e:
+        logger.error(f"failed to save the final dose state: {e}")
     os.chdir(save_curdir)
 
 if __name__ == '__main__':
@@ -409,9 +745,12 @@ undefined.
     aparser.add_argument("-V","--version",default=False,action='store_true', help="Print version label and exit.")
     aparser.add_argument("-d","--daemonize",default=False,action='store_true',help="run as daemon in the background")
     aparser.add_argument("-l","--username",help="Your user name (default: your login name).")
-    aparser.add_argument("-p","--polling_interval_seconds",type=int, default=-1,help="Override polling interval (in seconds) from the system config file.")
+    aparser.add_argument("-p","--polling_interval_seconds",type=int, default=-1,help="Override polling interval (in seconds) from the system config file. New dose files are normally detected right away, this is the maximum time between checks.")
+    aparser.add_argument("--debounce_seconds",type=float,default=5.,help="After new dose files have been written, wait until no more files have been written for this many seconds before checking the accuracy (default: 5 seconds).")
+    aparser.add_argument("--file_poll_seconds",type=float,default=10.,help="Interval for checking the modification times of the dose files, if the file system does not support inotify (default: 10 seconds).")
     aparser.add_argument("-u","--uncertainty_goal_percent",type=float,default=0.,help="Uncertainty level (in percent) at which the simulations should stop (default: 0 percent).")
     aparser.add_argument("-n","--minimum_number_of_primaries",type=int,default=0,help="If nonzero: minimum number of primaries for a simulation (default: 0).")
+    aparser.add_argument("-P","--predictive_stop",default=False,action='store_true',help="Stop the simulation one polling interval before the number of primaries and/or uncertainty goal is predicted to be reached, instead of after (see also the 'predictive stopping' option in the system configuration).")
     aparser.add_argument("-t","--time_out_minutes",type=int,default=0, help="If nonzero: time-out, maximum of time that a job is allowed to run, apart from pre- and post-processing (default: 0 minutes).")
     args = aparser.parse_args()
     if args.version:
@@ -420,7 +759,8 @@ undefined.
         
     cfg = dose_monitoring_config(args.workdir,args.username,daemonize=args.daemonize,uncertainty_goal_percent=args.uncertainty_goal_percent,
                                  minimum_number_of_primaries=args.minimum_number_of_primaries,time_out_minutes=args.time_out_minutes,
-                                 sysconfig=args.sysconfig,verbose=args.verbose,polling_interval_seconds=args.polling_interval_seconds)
+                                 sysconfig=args.sysconfig,verbose=args.verbose,polling_interval_seconds=args.polling_interval_seconds,
+                                 debounce_seconds=args.debounce_seconds,file_poll_seconds=args.file_poll_seconds,predictive_stop=args.predictive_stop)
     if cfg.daemonize:
         want_logfile=os.path.join(cfg.workdir,"job_control_daemon.log")
     else:
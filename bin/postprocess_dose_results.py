@@ -14,9 +14,11 @@ import numpy as np
 import logging
 import tarfile
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 from datetime import datetime
-from utils.gamma_index import get_gamma_index
+from utils.gamma_index import get_gamma_summary
 
 if False:
     logging.basicConfig(level=logging.DEBUG)
@@ -32,6 +34,9 @@ else:
     logger.addHandler(fh)
 
 from utils.resample_dose import mass_weighted_resampling
+from utils.mhd_reader import read_mhd
+from utils.sparse_dose import box_accumulator
+from utils.roi_utils import region_of_interest, list_roinames, get_dvhs, use_mask_cache
 
 def update_user_logs(user_cfg,status,section="DEFAULT",changes=dict()):
     if bool(user_cfg):
@@ -118,7 +123,7 @@ def image_2_dicom_dose(img_dose,dose_dcm_template,my_dose_dcm,physical=True):
     except Exception as e:
         logger.info("something went wrong: {}".format(e))
 
-def run_gamma_analysis(ref_dose_path,gamma_parameters,dose_sum_final,mhd_dose_final):
+def run_gamma_analysis(ref_dose_path,gamma_parameters,dose_sum_final,mhd_dose_final,pass_rate_only=False,interpolated_ref=False,n_workers=1):
     ushort_imgref=itk.imread(ref_dose_path)
     aimgref=itk.array_from_image(ushort_imgref)*float(pydicom.dcmread(ref_dose_path).DoseGridScaling)
     imgref=itk.image_from_array(np.float32(aimgref))
@@ -127,17 +132,62 @@ def run_gamma_analysis(ref_dose_path,gamma_parameters,dose_sum_final,mhd_dose_fi
     if not npar==4:
         raise ValueError(f"wrong number gamma index parameters ({npar}, should be 4)")
     dta_mm,dd_percent,dosethr,defgamma = gamma_parameters.tolist()
-    g=get_gamma_index(ref=imgref,
-                      target=dose_sum_final,
-                      dta=dta_mm,
-                      dd=dd_percent,
-                      ddpercent=True,
-                      threshold=dosethr,
-                      defvalue=defgamma,
-                      verbose=False,
-                      threshold_percent=True)
-    itk.imwrite(g,mhd_dose_final.replace(".mhd","_gamma.mhd"))
+    summary=get_gamma_summary(ref=imgref,
+                              target=dose_sum_final,
+                              pass_rate_only=pass_rate_only,
+                              interpolated_ref=interpolated_ref,
+                              n_workers=n_workers,
+                              dta=dta_mm,
+                              dd=dd_percent,
+                              ddpercent=True,
+                              threshold=dosethr,
+                              defvalue=defgamma,
+                              verbose=False,
+                              threshold_percent=True)
+    logger.info(str(summary))
+    if summary.image is not None:
+        itk.imwrite(summary.image,mhd_dose_final.replace(".mhd","_gamma.mhd"))
     itk.imwrite(imgref,mhd_dose_final.replace(".mhd","_tpsdose.mhd"))
+    return summary
+
+######################################################################################
+# DVHs of all ROIs (the ROIs and their masks are reused for all beam and plan doses)
+######################################################################################
+def get_dvh_rois(cfg,drd):
+    # 'drd' is the DVH ROI dictionary: structure set path => list of ROIs
+    if cfg.dvh_structure_set not in drd:
+        if cfg.roi_mask_cache_dir:
+            use_mask_cache(cfg.roi_mask_cache_dir,cfg.roi_mask_cache_size)
+        ds = pydicom.dcmread(cfg.dvh_structure_set)
+        rois = []
+        for roiname in list_roinames(ds):
+            try:
+                rois.append(region_of_interest(ds=ds,roi_id=roiname))
+            except Exception as e:
+                logger.warn("cannot compute DVH for ROI '{}': {}".format(roiname,e))
+        drd[cfg.dvh_structure_set] = rois
+    return drd[cfg.dvh_structure_set]
+
+def get_mass_image(cfg,mid):
+    # 'mid' is the mass image dictionary: mass file path => mass image
+    # All beams use the same mass image object, such that the resampling operator
+    # that is cached in memory for the first beam is reused for the other beams.
+    if cfg.mass_mhd not in mid:
+        mid[cfg.mass_mhd] = itk.imread(cfg.mass_mhd)
+    return mid[cfg.mass_mhd]
+
+def write_dvh_table(cfg,drd,img_dose,dvh_txt):
+    # 'drd' is the DVH ROI dictionary, see get_dvh_rois
+    try:
+        t0=datetime.now()
+        dvh_rois = get_dvh_rois(cfg,drd)
+        masks = region_of_interest.get_masks(dvh_rois,img_dose,corrected=True,compact=True)
+        table = get_dvhs(img_dose,masks,names=[roi.roiname for roi in dvh_rois],nbins=cfg.dvh_nbins)
+        table.write(dvh_txt)
+        t1=datetime.now()
+        logger.debug("computing and writing {} DVHs to {} took {} seconds".format(len(dvh_rois),dvh_txt,(t1-t0).total_seconds()))
+    except Exception as e:
+        logger.error("something went wrong when attempting to compute the DVHs: {}".format(e))
 
 def update_plan_dose(pdd,label,beam_dose_image):
     # 'pdd' is plan dose dictionary
@@ -235,13 +285,116 @@ def compress_jobdata(cfg,outputdirs,statfiles):
 
 
 
+class job_dose_reader:
+    """
+    Reads the dose and the stats of subjob outputs, possibly in several threads
+    at the same time. Each thread adds the dose to its own partial sum, so the
+    reading of the next file overlaps with the accumulation in other threads.
+    The partial sums only cover the box with nonzero dose (see utils.sparse_dose),
+    which for a small target is a small part of the dose grid.
+    All files are checked against the geometry of the reference dose file.
+    """
+    def __init__(self,geometry0):
+        self.geometry0 = geometry0
+        self.partial_sums = list()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+    def partial_sum(self):
+        if not hasattr(self.local,"dosesum"):
+            self.local.dosesum = box_accumulator(self.geometry0.size[::-1])
+            with self.lock:
+                self.partial_sums.append(self.local.dosesum)
+        return self.local.dosesum
+    def __call__(self,mhd):
+        """
+        Add the dose from `mhd` to the partial sum of the current thread, if the job was successful.
+        Returns a dictionary with the job stats and the status.
+        """
+        t0 = datetime.now()
+        result = {"mhd":mhd,"ok":False,"retval":None,"nMC":0,"nbytes":0,"error":""}
+        try:
+            statdict,retval = get_job_stats(mhd)
+            nMCjob = int(statdict['NumberOfEvents'])
+            result.update(stats=statdict,retval=retval,nMC=nMCjob)
+            # FIXME: such errors should be reported in the final result
+            if retval != 0:
+                raise RuntimeError("return value {} means that something went WRONG, Gate did not terminate normally".format(retval))
+            # FIXME: such errors should be reported in the final result
+            elif nMCjob <= 0:
+                raise RuntimeError("ZERO ({}) primaries from mhd={}".format(nMCjob,mhd))
+            dose,geometry = read_mhd(mhd)
+            assert bool(tuple(self.geometry0.size) == tuple(geometry.size)), str("sizes {} and {} don't match".format(self.geometry0.size,geometry.size))
+            assert bool(np.allclose(self.geometry0.origin, geometry.origin)), str("origins don't match")  # TODO: check that this sufficiently allows rounding differences
+            assert bool(np.allclose(self.geometry0.spacing,geometry.spacing)), str("spacings don't match") # TODO: check that this sufficiently allows rounding differences
+            partial = self.partial_sum()
+            partial.add(partial.crop(dose))
+            result["nbytes"] = dose.nbytes
+            result["ok"] = True
+            del dose
+        except Exception as e:
+            result["error"] = str(e)
+        result["seconds"] = (datetime.now()-t0).total_seconds()
+        return result
+
+def sum_job_doses(mhdlist,nthreads=1):
+    """
+    Sum the dose of the subjob outputs in `mhdlist`, using a pool of `nthreads` threads.
+    Jobs that did not terminate normally or with zero primaries are not included.
+    Returns the dose sum as a float32 array and its geometry, the total number of primaries,
+    the numbers of jobs with bad return value and with zero primaries, the CPU times
+    (with and without initialization) and the list of stat actor files.
+    """
+    t0 = datetime.now()
+    _,geometry0 = read_mhd(mhdlist[0])
+    logger.debug("first dose file is {}".format(mhdlist[0]))
+    logger.debug("dose distribution has orig={} spacing={} size={}".format(geometry0.origin,geometry0.spacing,geometry0.size))
+    reader = job_dose_reader(geometry0)
+    nthreads = max(1,min(int(nthreads),len(mhdlist)))
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        results = list(pool.map(reader,mhdlist))
+    nMC=0
+    nBADretval=0
+    nBADzeronmc=0
+    tCPUbrutto=0.
+    tCPUnetto=0.
+    nbytes=0
+    statfiles=list()
+    for r in results:
+        if "stats" in r:
+            statfiles.append(r["stats"]["StatsFile"])
+        if r["ok"]:
+            logger.debug("added dose from {} primaries from {}, reading and adding took {} seconds".format(r["nMC"],r["mhd"],r["seconds"]))
+            nMC += r["nMC"]
+            nbytes += r["nbytes"]
+            tCPUbrutto += float(r["stats"]['ElapsedTime'])
+            tCPUnetto += float(r["stats"]['ElapsedTimeWoInit'])
+        else:
+            # FIXME: such errors should be reported in the final result
+            if r["retval"] is not None and r["retval"] != 0:
+                nBADretval += 1
+            elif r["retval"] is not None and r["nMC"] <= 0:
+                nBADzeronmc += 1
+            logger.error("something went wrong while processing {}: {}".format(r["mhd"],r["error"]))
+    adose = np.zeros(geometry0.size[::-1],dtype=float)
+    for partial in reader.partial_sums:
+        logger.debug("partial dose sum covers a box of {} voxels ({} MiB)".format(partial.box_shape,partial.nbytes/1024.**2))
+        partial.add_to(adose)
+    dt = (datetime.now()-t0).total_seconds()
+    MiB = 1024.**2
+    logger.info("summed {0} of {1} dose files ({2:.1f} MiB) with {3} threads in {4:.2f} seconds: {5:.1f} MiB/s".format(
+        sum([r["ok"] for r in results]),len(results),nbytes/MiB,nthreads,dt,nbytes/MiB/dt if dt>0 else np.inf))
+    logger.debug("max dose (unscaled) is {}".format(np.max(adose)))
+    return np.float32(adose),geometry0,nMC,nBADretval,nBADzeronmc,tCPUbrutto,tCPUnetto,statfiles
+
 ######################################################################################
 # Implementation details: accumulate the doses, apply rescaling and correction factors
 ######################################################################################
-def post_processing(cfg,pdd,cul):
+def post_processing(cfg,pdd,cul,drd,mid):
     # cfg=config
     # pdd=plan dose dictionary
     # cul=cleanup list
+    # drd=DVH ROI dictionary
+    # mid=mass image dictionary
     if bool(cfg.user_cfg):
         update_user_logs(cfg.user_cfg,status=f"POSTPROCESSING beam '{cfg.origname}'")
 
@@ -267,64 +420,13 @@ def post_processing(cfg,pdd,cul):
         return False
     # sum
     logger.debug("going to sum all {} doses and do some rescaling".format(len(mhdlist)))
-    logger.debug("first dose file is {}".format(mhdlist[0]))
-    logger.debug("type first dose file is {}".format(type(mhdlist[0])))
-    dose0=itk.imread(mhdlist[0])
-    logger.debug("dose distribution has orig={} spacing={} size={}".format(dose0.GetOrigin(),dose0.GetSpacing(),dose0.GetLargestPossibleRegion().GetSize()))
-    adose=itk.GetArrayFromImage(dose0)
-    statdict,retval=get_job_stats(mhdlist[0])
-    nMC=int(statdict['NumberOfEvents'])
-    nBADretval=0
-    nBADzeronmc=0
-    tCPUbrutto=0.
-    tCPUnetto=0.
-    statfiles=[statdict['StatsFile']]
-    logger.debug("adding dose from {} primaries, Gate return value was {}".format(nMC,retval))
-    if retval != 0:
-        logger.error("return value {} means that something went WRONG, Gate did not terminate normally".format(retval))
-        nBADretval += 1
-    elif nMC <= 0:
-        logger.error("ZERO ({}) primaries from mhd={}".format(nMCjob,mhd))
-        nBADzeronmc += 1
-    else:
-        tCPUbrutto += float(statdict['ElapsedTime'])
-        tCPUnetto += float(statdict['ElapsedTimeWoInit'])
-    for mhd in mhdlist[1:]:
-        logger.debug("next dose file is {}".format(mhd))
-        try:
-            dose=itk.imread(mhd)
-            statdict,retval = get_job_stats(mhd)
-            nMCjob = int(statdict['NumberOfEvents'])
-            statfiles.append(statdict['StatsFile'])
-            #nMCjob,statfile,retval = nprimaries(mhd)
-            #statfiles.append(statfile)
-            logger.debug("adding dose from {} primaries, Gate return value was {}".format(nMCjob,retval))
-            # FIXME: such errors should be reported in the final result
-            if retval != 0:
-                nBADretval += 1
-                raise RuntimeError("return value {} means that something went WRONG, Gate did not terminate normally".format(retval))
-            # FIXME: such errors should be reported in the final result
-            elif nMCjob <= 0:
-                nBADzeronmc += 1
-                raise RuntimeError("ZERO ({}) primaries from mhd={}".format(nMCjob,mhd))
-            nMC += nMCjob
-            tCPUbrutto += float(statdict['ElapsedTime'])
-            tCPUnetto += float(statdict['ElapsedTimeWoInit'])
-            assert bool(tuple(dose0.GetLargestPossibleRegion().GetSize()) == tuple(dose.GetLargestPossibleRegion().GetSize())), str("sizes {} and {} don't match".format(dose0.GetLargestPossibleRegion().GetSize(),dose.GetLargestPossibleRegion().GetSize()))
-            assert bool(np.allclose(tuple(dose0.GetOrigin()), tuple(dose.GetOrigin()))), str("origins don't match")  # TODO: check that this sufficiently allows rounding differences
-            assert bool(np.allclose(tuple(dose0.GetSpacing()),tuple(dose.GetSpacing()))), str("spacings don't match") # TODO: check that this sufficiently allows rounding differences
-            adose += itk.GetArrayViewFromImage(dose)
-            logger.debug("max dose (unscaled) is now {}".format(np.max(adose)))
-        except Exception as e:
-            # FIXME: such errors should be reported in the final result
-            logger.error("something went wrong while processing {}: {}".format(mhd,e))
+    adose,geometry0,nMC,nBADretval,nBADzeronmc,tCPUbrutto,tCPUnetto,statfiles = sum_job_doses(mhdlist,cfg.dose_summation_threads)
     if nMC <= 0:
         logger.error("failed to find any primaries for beam '{}', cannot scale any dose.".format(cfg.origname))
         return False
     logger.info("total simulated number of primaries is {}".format(nMC))
     # now make an image
-    dose_sum = itk.GetImageFromArray(np.float32(adose))
-    dose_sum.CopyInformation(dose0)
+    dose_sum = geometry0.image_from_array(np.float32(adose))
     if cfg.write_mhd_unscaled_dose:
         itk.imwrite(dose_sum,mhd_dose_sum)
     # rescaling: get physical dose
@@ -333,8 +435,7 @@ def post_processing(cfg,pdd,cul):
     scale_factor = cfg.dosecorrfactor*float(cfg.nTPS)/float(nMC)
     logger.info("scaling with number dose_correction_factor*nTPS/nMC = {}*{}/{} = {}".format(cfg.dosecorrfactor,cfg.nTPS,nMC,scale_factor))
     adose*=scale_factor
-    dose_sum_rescaled = itk.GetImageFromArray(np.float32(adose))
-    dose_sum_rescaled.CopyInformation(dose0)
+    dose_sum_rescaled = geometry0.image_from_array(np.float32(adose))
     if cfg.write_mhd_scaled_dose:
         itk.imwrite(dose_sum_rescaled,mhd_dose_rescaled)
     if cfg.write_unresampled_dose:
@@ -348,11 +449,12 @@ def post_processing(cfg,pdd,cul):
             dose_resampled_ref = itk.GetImageFromArray(np.zeros(cfg.dose_nvoxels[::-1],dtype=np.float32))
             dose_resampled_ref.SetOrigin(cfg.dose_origin)
             dose_resampled_ref.SetSpacing(dose_spacing)
-            mass_img=itk.imread(cfg.mass_mhd)
+            mass_img=get_mass_image(cfg,mid)
             logger.debug("dose_sum has dimsize={} mass has dimsize={}".format(np.array(itk.size(dose_sum_rescaled)),np.array(itk.size(mass_img))))
             logger.debug("going to resample from voxels with spacing {} to voxels with spacing {}".format(dose_sum_rescaled.GetSpacing(),dose_resampled_ref.GetSpacing()))
             t0=datetime.now()
-            dose_physical = mass_weighted_resampling(dose_sum_rescaled,mass_img,dose_resampled_ref)
+            # the job control daemon may already have saved the resampling operator for this mass and dose grid in the cache
+            dose_physical = mass_weighted_resampling(dose_sum_rescaled,mass_img,dose_resampled_ref,cache_dir=os.path.join("tmp","resampling_cache"))
             t1=datetime.now()
             logger.debug("resampling took {} seconds".format((t1-t0).total_seconds()))
         except Exception as e:
@@ -407,12 +509,15 @@ def post_processing(cfg,pdd,cul):
             image_2_dicom_dose(dose_rbe,str(cfg.dcm_beam_in),str(dcm_dose_rbe),physical=False)
             if cfg.dicom_plan_dose or cfg.mhd_plan_dose:
                 update_plan_dose(pdd,"RBE",dose_rbe)
+    if cfg.dvh_structure_set:
+        write_dvh_table(cfg,drd,dose_sum_final,mhd_dose_final.replace(".mhd","-DVH.txt"))
+    gamma_summary = dict()
     if cfg.ref_dose_path:
         if cfg.gamma_analysis:
             try:
                 logger.debug("going to run gamma analysis, using ref dose = {}".format(cfg.ref_dose_path))
                 t0=datetime.now()
-                run_gamma_analysis(cfg.ref_dose_path,cfg.gamma_parameters,dose_sum_final,mhd_dose_final)
+                gamma_summary = run_gamma_analysis(cfg.ref_dose_path,cfg.gamma_parameters,dose_sum_final,mhd_dose_final,cfg.gamma_pass_rate_only,cfg.gamma_interpolated_ref,cfg.gamma_workers).as_dict()
                 #ushort_imgref=itk.imread(cfg.ref_dose_path)
                 #aimgref=itk.GetArrayFromImage(ushort_imgref)*float(pydicom.dcmread(cfg.ref_dose_path).DoseGridScaling)
                 #imgref=itk.GetImageFromArray(np.float32(aimgref))
@@ -440,7 +545,8 @@ def post_processing(cfg,pdd,cul):
                          "CPU time [seconds] excluding init":str(tCPUnetto),
                          "CPU time [hours] including init":str(tCPUbrutto/3600.),
                          "CPU time [hours] excluding init":str(tCPUnetto/3600.),
-                         "number of primaries per second per core":str(nMC/tCPUnetto) })
+                         "number of primaries per second per core":str(nMC/tCPUnetto),
+                         **gamma_summary })
     # update the clean up list
     outputdirs = [ os.path.realpath(os.path.dirname(mhd)) for mhd in mhdlist ]
     #logger.debug("going to compress {} output directories".format(len(outputdirs)))
@@ -474,6 +580,10 @@ class post_proc_config:
         self.mass_mhd = sec.get("mass mhd","")
         # MFA 11/16/22
         self.gamma_analysis = sec.getboolean("run gamma analysis")
+        self.gamma_pass_rate_only = sec.getboolean("gamma pass rate only",fallback=False)
+        self.gamma_interpolated_ref = sec.getboolean("gamma interpolated reference",fallback=False)
+        self.gamma_workers = sec.getint("gamma number of workers",fallback=1)
+        self.dose_summation_threads = sec.getint("number of dose summation threads",fallback=4)
         self.debug = sec.getboolean("debug")
         
         self.write_mhd_unscaled_dose = sec.getboolean("write mhd unscaled dose")
@@ -502,6 +612,10 @@ class post_proc_config:
             msg = "masking of dose with external requested, but no mask provided"
             logger.error(msg)
             raise RuntimeError(msg)
+        self.dvh_structure_set = sec.get("dvh structure set","")
+        self.dvh_nbins = sec.getint("dvh number of bins",fallback=100)
+        self.roi_mask_cache_dir = sec.get("roi mask cache directory","")
+        self.roi_mask_cache_size = sec.getfloat("roi mask cache size [MB]",fallback=1000.)
         self.ref_dose_path = sec.get("path to reference dose image for gamma index calculation","")
         self.gamma_parameters = np.array([float(v) for v in sec.get("gamma index parameters dta_mm dd_percent thr_percent def","").split()])
         self.ref_physical_plan_dose_path = sec.get("path to reference PHYSICAL plan dose image for gamma index calculation","")
@@ -520,6 +634,8 @@ if __name__ == '__main__':
     ok = True
     plan_dose_dict = dict()
     cleanup_list = list()
+    dvh_roi_dict = dict()
+    mass_image_dict = dict()
     # MFA 11/21/22
 #    api_cfg = configparser.ConfigParser()
 #    with open("/opt/IDEAL-1.1test/cfg/api.cfg","r") as fp:
@@ -531,7 +647,7 @@ if __name__ == '__main__':
         t0 = datetime.now()
         cfg = post_proc_config(parser,beamname)
         # TODO: the post_processing now also includes the archiving (making a tarball of) the output directories of all subjobs. Maybe this needs to be separated.
-        success = post_processing(cfg,plan_dose_dict,cleanup_list)
+        success = post_processing(cfg,plan_dose_dict,cleanup_list,dvh_roi_dict,mass_image_dict)
         t1 = datetime.now()
         dt = (t1-t0).total_seconds()
         if success:
@@ -555,16 +671,20 @@ if __name__ == '__main__':
                 itk.imwrite(img_dose,plan_dose_mhd)
                 mhd_gamma = plan_dose_mhd
                 logger.debug(f"finished writing {label} PLAN dose to MHD")
+            if cfg.dvh_structure_set and label != "unresampled":
+                write_dvh_table(cfg,dvh_roi_dict,img_dose,str(os.path.join(str(cfg.output_dicom1),f"idc-PLAN-{label}-DVH.txt")))
             if cfg.ref_physical_plan_dose_path != "" and label.upper() == "PHYSICAL" and cfg.gamma_analysis:
                 logger.debug("start gamma index calculation PHYSICAL PLAN DOSE")
                 t0=datetime.now()
-                run_gamma_analysis(cfg.ref_physical_plan_dose_path,cfg.gamma_parameters,img_dose,mhd_gamma)
+                summary = run_gamma_analysis(cfg.ref_physical_plan_dose_path,cfg.gamma_parameters,img_dose,mhd_gamma,cfg.gamma_pass_rate_only,cfg.gamma_interpolated_ref,cfg.gamma_workers)
+                update_user_logs(cfg.user_cfg,status=f"BEAM DOSES OK, COMPUTING PLAN DOSES",changes=summary.as_dict("physical plan dose gamma"))
                 t1=datetime.now()
                 logger.debug("gamma index calculation PHYSICAL PLAN DOSE took {} seconds".format((t1-t0).total_seconds()))
             elif cfg.ref_effective_plan_dose_path != "" and label.upper() == "RBE" and cfg.gamma_analysis:
                 logger.debug("start gamma index calculation EFFECTIVE PLAN DOSE")
                 t0=datetime.now()
-                run_gamma_analysis(cfg.ref_effective_plan_dose_path,cfg.gamma_parameters,img_dose,mhd_gamma)
+                summary = run_gamma_analysis(cfg.ref_effective_plan_dose_path,cfg.gamma_parameters,img_dose,mhd_gamma,cfg.gamma_pass_rate_only,cfg.gamma_interpolated_ref,cfg.gamma_workers)
+                update_user_logs(cfg.user_cfg,status=f"BEAM DOSES OK, COMPUTING PLAN DOSES",changes=summary.as_dict("effective plan dose gamma"))
                 t1=datetime.now()
                 logger.debug("gamma index calculation EFFECTIVE PLAN DOSE took {} seconds".format((t1-t0).total_seconds()))
         if cfg.output_dicom2:
@@ -29,7 +29,7 @@ import numpy as np
 #import SimpleITK as sitk
 import itk
 from datetime import datetime
-from utils.roi_utils import region_of_interest, list_roinames
+from utils.roi_utils import region_of_interest, list_roinames, use_mask_cache
 from utils.bounding_box import bounding_box
 from utils.ct_dicom_to_img import ct_image_from_dicom
 from utils.crop import crop_and_pad_image
@@ -57,7 +57,7 @@ def update_user_logs(user_cfg,status,section="DEFAULT",changes=dict()):
 
 def GetMCPatientCTImage(rpdir,ssdcm,ctuid,HUoverride,HU_override_density,hlut_path, #mhd_resized,
                         mhd_orig_ct, mhd_overrides, ct_bb,
-                        dose_grid_center,dose_grid_size,dose_grid_nvoxels,mhd_dose_grid_mask):
+                        dose_grid_center,dose_grid_size,dose_grid_nvoxels,mhd_dose_grid_mask,nworkers=1):
 
     global current_action
     current_action="initializing preprocessing"
@@ -93,11 +93,16 @@ def GetMCPatientCTImage(rpdir,ssdcm,ctuid,HUoverride,HU_override_density,hlut_pa
     #mask *= np.logical_not(act_resized==hu_air) # do not apply this override to padded voxels
     act_orig[mask] = hu_max
 
-    # step 2c: enforce air outside of external
-    current_action="overriding voxels outside external ROI with G4_AIR"
+    # step 2c: compute the masks of the external ROI and the override ROIs (in parallel, with nworkers>1)
+    current_action="computing ROI masks"
     ext_roi = region_of_interest(ds=structure_set,roi_id=external)
-    ext_mask = ext_roi.get_mask(ct_orig,corrected=False)
-    ext_array = itk.GetArrayViewFromImage(ext_mask)>0
+    override_rois = [(region_of_interest(ds=structure_set,roi_id=roiname),huval) for roiname,huval in HUoverride.items() if roiname[0] != "!"]
+    masks = region_of_interest.get_masks([ext_roi]+[roi for roi,huval in override_rois],ct_orig,corrected=False,compact=True,nworkers=nworkers)
+    ext_mask = masks[0]
+
+    # step 2d: enforce air outside of external
+    current_action="overriding voxels outside external ROI with G4_AIR"
+    ext_array = ext_mask.full_array()>0
     act_orig[np.logical_not(ext_array)] = hu_air
     ntot = np.prod(ext_array.shape)
     nin = np.sum(ext_array)
@@ -105,26 +110,19 @@ def GetMCPatientCTImage(rpdir,ssdcm,ctuid,HUoverride,HU_override_density,hlut_pa
     update_user_logs(user_logs,"PREPROCESSING AIR OVERRIDE COMPLETE",section="CT",
             changes={"orig ct nr voxels [total,external,air]":f"{ntot},{nin},{nout}"})
 
-    # step 2d: apply other HU overrides
+    # step 2e: apply other HU overrides
     current_action="overriding materials inside given ROIs"
     n_override=0
     n_rois=0
-    for roiname,huval in HUoverride.items():
-        if roiname[0] == "!":
-            continue
-        roi = region_of_interest(ds=structure_set,roi_id=roiname)
-        mask = roi.get_mask(ct_orig,corrected=False)
-        aroi = itk.GetArrayViewFromImage(mask)>0
-        logger.debug("applying material override HU={} inside ROI '{}' on {} voxels".format(int(huval),roiname,np.sum(aroi)))
-        logger.debug("aroi is contiguous: {}".format("YES" if aroi.flags.contiguous else "NO"))
-        if not aroi.flags.contiguous:
-            aroi=np.ascontiguousarray(aroi)
-            logger.debug("NOW aroi is contiguous: {}".format("YES" if aroi.flags.contiguous else "NO"))
+    for (roi,huval),mask in zip(override_rois,masks[1:]):
+        # the mask only covers the bounding box of the ROI
+        aroi = mask.binary
+        logger.debug("applying material override HU={} inside ROI '{}' on {} voxels".format(int(huval),roi.roiname,np.sum(aroi)))
         logger.debug("act_orig is contiguous: {}".format("YES" if act_orig.flags.contiguous else "NO"))
         if not act_orig.flags.contiguous:
             act_orig=np.ascontiguousarray(act_orig)
             logger.debug("NOW act_orig is contiguous: {}".format("YES" if act_orig.flags.contiguous else "NO"))
-        act_orig[aroi] = huval
+        act_orig[mask.slices][aroi] = huval
         n_override += np.sum(aroi)
         n_rois += 1
     logger.debug("converting ct array back to ITK image")
@@ -222,6 +220,10 @@ if __name__ == '__main__':
         #logger.debug("mhd_resized={}".format(mhd_resized))
         logger.debug("bounding box={}".format(ct_bb))
         logger.debug("mhd_overrides={}".format(mhd_overrides))
+        if parser.has_section('roi mask cache'):
+            mask_cache = parser['roi mask cache']
+            use_mask_cache(mask_cache['directory'],float(mask_cache.get('size [MB]','1000')))
+        nworkers = parser.getint('roi masks','number of workers',fallback=4)
         update_user_logs(user_logs,"PREPROCESSING STARTED")
         #sys.exit(0)
         logger.debug('finished parsing config file, now going to do the preprocessing')
@@ -238,7 +240,8 @@ if __name__ == '__main__':
                             dose_grid_center,
                             dose_grid_size,
                             dose_grid_nvoxels,
-                            mhd_dose_grid_mask)
+                            mhd_dose_grid_mask,
+                            nworkers)
         update_user_logs(user_logs,"PREPROCESSING FINISHED, JOB QUEUED")
     except Exception as e:
         logger.error("something went wrong: {}".format(e))
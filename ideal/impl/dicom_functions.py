@@ -1,12 +1,12 @@
 import pydicom
 import os
-import itk
 from impl.IDEAL_dictionary import *
 from impl.beamline_model import beamline_model
 from impl.hlut_conf import hlut_conf
 from impl.system_configuration import system_configuration
 from utils.dose_info import dose_info
 from utils.beamset_info import beam_info
+from utils.dicom_index import get_dicom_index
 from glob import glob
 
 class dicom_files:
@@ -96,72 +96,18 @@ class dicom_files:
     def get_RS_file(self):
         ss_ref_uid = self.rp_data.ReferencedStructureSetSequence[0].ReferencedSOPInstanceUID
         print("going to try to find the file with structure set with UID '{}'".format(ss_ref_uid))
-        nskip=0
-        ndcmfail=0
-        nwrongtype=0
-        nfiles=len([s for s in os.listdir(self.dcm_dir)])
-        for s in os.listdir(self.dcm_dir):
-            if s[-4:].lower() != '.dcm':
-                nskip+=1
-                print("no .dcm suffix: {}".format(s))
-                continue
-            try:
-                #print(s)
-                ds = pydicom.dcmread(os.path.join(self.dcm_dir,s))
-                dcmtype = ds.SOPClassUID.name
-            except:
-                ndcmfail+=1
-                continue
-            if dcmtype == "RT Structure Set Storage" and ss_ref_uid == ds.SOPInstanceUID:
-                print("found structure set for CT: {}".format(s))
-                self.rs_data = ds
-                self.rs_path = os.path.join(self.dcm_dir,s)
-                break
-            else:
-                nwrongtype+=1
-                #print("rejected structure set for CT: {}".format(s))
-                #print("because it as a wrong SOP class ID: {}".format(dcmtype))
-                #print("AND/OR because it has the wrong SOP Instance UID: {} != {}".format(ds.SOPInstanceUID,ss_ref_uid))
-        if self.rs_data is None:
-            raise RuntimeError("could not find structure set with UID={}; skipped {} with wrong suffix, got {} with 'dcm' suffix but pydicom could not read it, got {} with wrong class UID and/or instance UID. It could well be that this is a commissioning plan without CT and structure set data.".format(ss_ref_uid,nskip,ndcmfail,nwrongtype))
+        self.rs_path = get_dicom_index(self.dcm_dir).structure_set(ss_ref_uid,toplevel=True)
+        if self.rs_path is None:
+            raise RuntimeError("could not find structure set with UID={} in {}. It could well be that this is a commissioning plan without CT and structure set data.".format(ss_ref_uid,self.dcm_dir))
+        print("found structure set for CT: {}".format(os.path.basename(self.rs_path)))
+        self.rs_data = pydicom.dcmread(self.rs_path)
 
     def get_CT_files(self):
-        dcmseries_reader = itk.GDCMSeriesFileNames.New(Directory=self.dcm_dir)
-        ids = dcmseries_reader.GetSeriesUIDs()
-        #print("got DICOM {} series IDs".format(len(ids)))
-        flist=list()
         uid = self.rs_data.ReferencedFrameOfReferenceSequence[0].RTReferencedStudySequence[0].RTReferencedSeriesSequence[0].SeriesInstanceUID
-        if uid:
-            if uid in ids:
-                try:
-                    #flist = sitk.ImageSeriesReader_GetGDCMSeriesFileNames(ddir,uid)
-                    flist = dcmseries_reader.GetFileNames(uid)
-                    return uid,flist
-                except:
-                    logger.error('something wrong with series uid={} in directory {}'.format(uid,self.dcm_dir))
-                    raise
-        else:
-            ctid = list()
-            for suid in ids:
-                #flist = sitk.ImageSeriesReader_GetGDCMSeriesFileNames(ddir,suid)
-                flist = dcmseries_reader.GetFileNames(suid)
-                f0 = pydicom.dcmread(flist[0])
-                if not hasattr(f0,'SOPClassUID'):
-                    logger.warn("weird, file {} has no SOPClassUID".format(os.path.basename(flist[0])))
-                    continue
-                descr = pydicom.uid.UID_dictionary[f0.SOPClassUID][0]
-                if descr == 'CT Image Storage':
-                    print('found CT series id {}'.format(suid))
-                    ctid.append(suid)
-                else:
-                    print('not CT: series id {} is a "{}"'.format(suid,descr))
-            if len(ctid)>1:
-                raise ValueError('no series UID was given, and I found {} different CT image series: {}'.format(len(ctid), ",".join(ctid)))
-            elif len(ctid)==1:
-                uid = ctid[0]
-                #flist = sitk.ImageSeriesReader_GetGDCMSeriesFileNames(ddir,uid)
-                flist = dcmseries_reader.GetFileNames(uid)
-                return flist
+        uid,flist = get_dicom_index(self.dcm_dir).ct_series_files(uid)
+        if not flist:
+            raise RuntimeError("could not find CT series with UID={} in {}".format(uid,self.dcm_dir))
+        return uid,flist
 
 def verify_all_dcm_keys(dcm_dir,rp_name,rs_name,ct_names,rd_names):
     ok = True 
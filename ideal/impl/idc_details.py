@@ -18,7 +18,8 @@ from impl.gate_hlut_cache import generate_hlut_cache, hlut_cache_dir
 from impl.system_configuration import system_configuration
 from impl.hlut_conf import hlut_conf
 from utils.bounding_box import bounding_box
-from utils.roi_utils import region_of_interest, list_roinames
+from utils.roi_utils import roi_registry
+from utils.dicom_index import get_dicom_index
 from utils.ct_dicom_to_img import ct_image_from_dicom
 from utils.beamset_info import beamset_info
 from utils.crop import crop_image
@@ -71,9 +72,9 @@ class IDC_details:
         self.rd_plan_info = None
         self.structure_set = None
         self.structure_set_filename = None
+        self.roi_registry = None
         self.roinames = list()
         self.roinumbers = list()
-        self.roicontoursets = list()
         self.roitypes = list()
         self.external_roiname = ""
         self._tmpdir_job = None
@@ -143,85 +144,26 @@ class IDC_details:
             logger.debug("got plan dose info")
             ss_ref_uid = self.rp_dataset.ReferencedStructureSetSequence[0].ReferencedSOPInstanceUID
             logger.debug("going to try to find the file with structure set with UID '{}'".format(ss_ref_uid))
-            nskip=0
-            ndcmfail=0
-            nwrongtype=0
-            nfiles=len([s for s in os.listdir(rpdir)])
-            for s in os.listdir(rpdir):
-                if s[-4:].lower() != '.dcm':
-                    nskip+=1
-                    logger.debug("no .dcm suffix: {}".format(s))
-                    continue
-                try:
-                    logger.debug(s)
-                    ds = pydicom.dcmread(os.path.join(rpdir,s))
-                    dcmtype = ds.SOPClassUID.name
-                except:
-                    ndcmfail+=1
-                    continue
-                if dcmtype == "RT Structure Set Storage" and ss_ref_uid == ds.SOPInstanceUID:
-                    logger.debug("found structure set for CT: {}".format(s))
-                    ct_series_uid = ds.ReferencedFrameOfReferenceSequence[0].RTReferencedStudySequence[0].RTReferencedSeriesSequence[0].SeriesInstanceUID
-                    self.structure_set = ds
-                    self.structure_set_filename = s
-                    break
-                else:
-                    nwrongtype+=1
-                    logger.debug("rejected structure set for CT: {}".format(s))
-                    logger.debug("because it as a wrong SOP class ID: {}".format(dcmtype))
-                    logger.debug("AND/OR because it has the wrong SOP Instance UID: {} != {}".format(ds.SOPInstanceUID,ss_ref_uid))
-            if self.structure_set is None:
-                raise RuntimeError("could not find structure set with UID={}; skipped {} with wrong suffix, got {} with 'dcm' suffix but pydicom could not read it, got {} with wrong class UID and/or instance UID. It could well be that this is a commissioning plan without CT and structure set data.".format(ss_ref_uid,nskip,ndcmfail,nwrongtype))
+            # the DICOM files in the plan directory are indexed once, the CT series is found with the same index
+            ss_path = get_dicom_index(rpdir).structure_set(ss_ref_uid,toplevel=True)
+            if ss_path is None:
+                raise RuntimeError("could not find structure set with UID={} in {}. It could well be that this is a commissioning plan without CT and structure set data.".format(ss_ref_uid,rpdir))
+            s = os.path.basename(ss_path)
+            logger.debug("found structure set for CT: {}".format(s))
+            ds = pydicom.dcmread(ss_path)
+            ct_series_uid = ds.ReferencedFrameOfReferenceSequence[0].RTReferencedStudySequence[0].RTReferencedSeriesSequence[0].SeriesInstanceUID
+            self.structure_set = ds
+            self.structure_set_filename = s
             self.ct_info = ct_image_from_dicom(rpdir,uid=ct_series_uid)
             logger.debug("image spacing is {}".format(self.ct_info.img.GetSpacing()))
             logger.debug("image size is {}".format(self.ct_info.img.GetLargestPossibleRegion().GetSize()))
             logger.debug("image origin is {}".format(self.ct_info.img.GetOrigin()))
-            # the following code should be encapsulated in a "roi_info" class/object
+            # only the ROI names, numbers and types are read now, the contours are decoded when a ROI is used
             logger.debug("checking out structure set with {} ROIs".format(len(self.structure_set.StructureSetROISequence)))
-            for i,roi in enumerate(self.structure_set.StructureSetROISequence):
-                try:
-                    logger.debug("{}. ROI number {}".format(i,roi.ROINumber))
-                    logger.debug("{}. ROI name   {}".format(i,roi.ROIName))
-                    roinumber = str(roi.ROINumber) # NOTE: roi numbers are *strings*
-                    roiname = str(roi.ROIName)
-                    contourset = None
-                    roitype = None
-                    if i<len( self.structure_set.ROIContourSequence ):
-                        # normally this works
-                        ci = self.structure_set.ROIContourSequence[i]
-                        if str(ci.ReferencedROINumber) == roinumber:
-                            contourset = ci
-                    if not contourset:
-                        logger.debug("(nr={},name={}) looks like this is a messed up structure set...".format(roinumber,roiname))
-                        for ci in self.structure_set.ROIContourSequence:
-                            if str(ci.ReferencedROINumber) == roinumber:
-                                logger.debug("(nr={},name={}) contour found, phew!".format(roinumber,roiname))
-                                contourset = ci
-                                break
-                    if not contourset:
-                        logger.warn("ROI nr={} name={} does not have a contour, skipping it".format(roinumber,roiname))
-                    if i<len( self.structure_set.RTROIObservationsSequence ):
-                        # normally this works
-                        obsi = self.structure_set.RTROIObservationsSequence[i]
-                        if str(obsi.ReferencedROINumber) == roinumber:
-                            roitype = str(obsi.RTROIInterpretedType)
-                    if not roitype:
-                        logger.debug("(nr={},name={}) looks like this is a messed up structure set...".format(roinumber,roiname))
-                        for obsi in self.structure_set.RTROIObservationsSequence:
-                            if str(obsi.ReferencedROINumber) == roinumber:
-                                roitype = str(obsi.RTROIInterpretedType)
-                                logger.debug("(nr={},name={}) type={} found, phew!".format(roinumber,roiname,roitype))
-                                break
-                    if not roitype:
-                        logger.warn("ROI nr={} name={} does not have a type, skipping it".format(roinumber,roiname))
-                    if bool(roitype) and bool(contourset):
-                        self.roinumbers.append(roinumber)
-                        self.roinames.append(roiname)
-                        self.roicontoursets.append(contourset)
-                        self.roitypes.append(roitype)
-                except Exception as e:
-                    logger.error("something went wrong with {}th ROI in the structure set: {}".format(i,e))
-                    logger.error("skipping that for now, keep fingers crossed")
+            self.roi_registry = roi_registry(self.structure_set)
+            self.roinumbers = list(self.roi_registry.roinumbers)
+            self.roinames = list(self.roi_registry.roinames)
+            self.roitypes = list(self.roi_registry.roitypes)
             dose_roinr = str(self.bs_info.target_ROI_number)
             dose_roiname = "NOT FOUND" if dose_roinr not in self.roinumbers else self.roinames[self.roinumbers.index(dose_roinr)]
             self.bs_info.target_ROI_name = dose_roiname
@@ -432,7 +374,7 @@ class IDC_details:
                 logger.debug("ignoring !HUMAX")
                 continue
             roi_id,margin = (roiname[1:],dose_air_margin) if roiname[0]=="!" else (roiname,0.)
-            roi = region_of_interest(ds=self.structure_set,roi_id=roi_id)
+            roi = self.roi_registry.get(roi_id)
             logger.debug("merging roi_bb with id={} BB={}, using margin={}".format(roi_id,roi.bb,margin))
             self.roi_bb.should_contain(roi.bb.mincorner-margin)
             self.roi_bb.should_contain(roi.bb.maxcorner+margin)
@@ -513,6 +455,11 @@ class IDC_details:
         parser['dose grid'].update({'dose grid size':" ".join([str(v) for v in self.dosegrid_size])})
         parser['dose grid'].update({'dose grid nvoxels':" ".join([str(v) for v in self.dosegrid_nvoxels])})
         parser['dose grid'].update({'dose grid air margin': str(syscfg["air box margin [mm]"])})
+        parser.add_section('roi mask cache')
+        parser['roi mask cache'].update({'directory':os.path.join(syscfg['CT/cache'],"roi_masks")})
+        parser['roi mask cache'].update({'size [MB]':str(syscfg['roi mask cache size [MB]'])})
+        parser.add_section('roi masks')
+        parser['roi masks'].update({'number of workers':str(syscfg['number of roi mask workers'])})
         with open(os.path.join(submitdir,"preprocessor.cfg"),"w") as fp:
             parser.write(fp)
         if self.score_dose_on_full_CT:
@@ -527,6 +474,10 @@ class IDC_details:
         parser=configparser.RawConfigParser()
         parser.optionxform = lambda option : option
         parser['DEFAULT']["run gamma analysis"]       = str(syscfg["run gamma analysis"])
+        parser['DEFAULT']["gamma pass rate only"]     = str(syscfg["gamma pass rate only"])
+        parser['DEFAULT']["gamma interpolated reference"] = str(syscfg["gamma interpolated reference"])
+        parser['DEFAULT']["gamma number of workers"]  = str(syscfg["gamma number of workers"])
+        parser['DEFAULT']["number of dose summation threads"] = str(syscfg["number of dose summation threads"])
         parser['DEFAULT']["debug"]       = str(syscfg["debug"])
         parser['DEFAULT']["first output dicom"]       = self.output_job
         parser['DEFAULT']["second output dicom"]      = self.output_job_2nd
@@ -562,6 +513,10 @@ class IDC_details:
         if self.run_with_CT_geometry:
             parser['DEFAULT']["apply external dose mask"] = "yes" if syscfg["remove dose outside external"] else "no"
             parser['DEFAULT']["external dose mask"] = self.dosemask
+            if syscfg["write dvh tables"]:
+                parser['DEFAULT']["dvh structure set"] = os.path.join(os.path.dirname(self.rp_filepath),self.structure_set_filename)
+                parser['DEFAULT']["roi mask cache directory"] = os.path.join(syscfg['CT/cache'],"roi_masks")
+                parser['DEFAULT']["roi mask cache size [MB]"] = str(syscfg['roi mask cache size [MB]'])
         for beamname,qspec in qspecs.items():
             origname=qspec["origname"]
             beam = self.bs_info[origname]
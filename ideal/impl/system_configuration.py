@@ -162,6 +162,8 @@ def get_mc_stats_settings(syscfg,sysprsr,logger):
         MCStatType.cfglabels[MCStatType.Xpct_unc_in_target]      : [   0.1,      1.,        99.,   0.1],
         "n top voxels for mean dose max"                         : 100,
         "dose threshold as fraction in percent of mean dose max" : 50.,
+        "resample dose after sum"                                : False,
+        "number of batches for resampling after sum"             : 10,
     }
     problems = []
     kdef = "nions per beam"
@@ -174,6 +176,14 @@ def get_mc_stats_settings(syscfg,sysprsr,logger):
             elif k.strip().lower()=='dose threshold as fraction in percent of mean dose max':
                 mc_stats_config[k]=float(v)
                 continue
+            elif k.strip().lower()=='resample dose after sum':
+                mc_stats_config[k]=sysprsr['mc stats'].getboolean(k)
+                continue
+            elif k.strip().lower()=='number of batches for resampling after sum':
+                mc_stats_config[k]=int(v)
+                if mc_stats_config[k]<2:
+                    problems.append("number of batches for resampling after sum should be at least 2, got {}".format(v))
+                continue
             if k in mc_stats_config.keys():
                 logger.debug("found setting for {}".format(k))
                 words = v.split()
@@ -232,8 +242,15 @@ def get_simulation_install(syscfg,sysprsr,logger):
                           'remove dose outside external',
                           'gamma index parameters dta_mm dd_percent thr_percent def',
                           'stop on script actor time interval [s]',
+                          'predictive stopping',
                           'htcondor next job start delay [s]',
                           'run gamma analysis',
+                          'gamma pass rate only',
+                          'gamma interpolated reference',
+                          'gamma number of workers',
+                          'number of dose summation threads',
+                          'roi mask cache size [MB]',
+                          'number of roi mask workers',
                           'write mhd unscaled dose',
                           'write mhd scaled dose',
                           'write mhd physical dose',
@@ -241,7 +258,8 @@ def get_simulation_install(syscfg,sysprsr,logger):
                           'write mhd plan dose',
                           'write dicom physical dose',
                           'write dicom rbe dose',
-                          'write dicom plan dose']
+                          'write dicom plan dose',
+                          'write dvh tables']
     for k,v in simulation.items():
         if k not in simulation_options:
             msg="unknown option in simulation section of {}: '{}'; recognized options are:\n * {}".format(syscfg['sysconfig'],k,'\n * '.join(simulation_options))
@@ -258,9 +276,16 @@ def get_simulation_install(syscfg,sysprsr,logger):
     syscfg['remove dose outside external'] = simulation.getboolean('remove dose outside external',False)
     syscfg["gamma index parameters dta_mm dd_percent thr_percent def"] = simulation.get("gamma index parameters dta_mm dd_percent thr_percent def","")
     syscfg['stop on script actor time interval [s]'] = simulation.getint('stop on script actor time interval [s]',300)
+    syscfg['predictive stopping'] = simulation.getboolean('predictive stopping',False)
     syscfg['htcondor next job start delay [s]'] = simulation.getfloat('htcondor next job start delay [s]',1.)
     # TODO: check that SoS actor time interval and next job start delay are not crazy
     syscfg['run gamma analysis']=simulation.getboolean('run gamma analysis',False)
+    syscfg['gamma pass rate only']=simulation.getboolean('gamma pass rate only',False)
+    syscfg['gamma interpolated reference']=simulation.getboolean('gamma interpolated reference',False)
+    syscfg['gamma number of workers']=simulation.getint('gamma number of workers',1)
+    syscfg['number of dose summation threads']=simulation.getint('number of dose summation threads',4)
+    syscfg['roi mask cache size [MB]']=simulation.getint('roi mask cache size [MB]',1000)
+    syscfg['number of roi mask workers']=simulation.getint('number of roi mask workers',4)
     syscfg['write mhd unscaled dose']=simulation.getboolean('write mhd unscaled dose',False)
     syscfg['write mhd scaled dose']=simulation.getboolean('write mhd scaled dose',False)
     syscfg['write mhd physical dose']=simulation.getboolean('write mhd physical dose',False)
@@ -269,6 +294,7 @@ def get_simulation_install(syscfg,sysprsr,logger):
     syscfg['write dicom physical dose']=simulation.getboolean('write dicom physical dose',True)
     syscfg['write dicom rbe dose']=simulation.getboolean('write dicom rbe dose',False)
     syscfg['write dicom plan dose']=simulation.getboolean('write dicom plan dose',False)
+    syscfg['write dvh tables']=simulation.getboolean('write dvh tables',False)
     # TODO: paranoid GATE version test (should be GateRTion 1.0)
     # TODO: silly density tolerance check (positive, less than 1.0)
     # TODO: check that the physics list is actually an existing one
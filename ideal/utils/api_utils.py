@@ -7,6 +7,7 @@ import time
 import base64
 from cryptography.fernet import Fernet
 from urllib.parse import urljoin
+from utils.job_dose_state import job_dose_state
 
 # status variables
 RUNNING = 'running'
@@ -130,6 +131,31 @@ def read_ideal_job_status(cfg_settings):
     new_status = convert_ideal_to_api_status(status)
     return new_status
     
+def read_ideal_job_predictions(cfg_settings):
+    """
+    Predictions by the job control daemon (time to stop, final uncertainty, etc.) per beam, if any.
+    """
+    cfg = configparser.ConfigParser()
+    cfg.read(cfg_settings)
+    predictions = dict()
+    for section in cfg.sections():
+        beam = {k:v for k,v in cfg.items(section) if k.startswith("predicted") or k.startswith("simulation rate")}
+        if beam:
+            predictions[section] = beam
+    return predictions
+
+def read_ideal_job_beam_statistics(workdir,cfg_settings):
+    """
+    Convergence statistics per beam (number of primaries, average uncertainty,
+    predictions) as shared by the job control daemon, without reading any dose
+    files. Falls back to the predictions in the user logs if the daemon did
+    not share its state, or if its state is stale (e.g. the daemon was killed).
+    """
+    state = job_dose_state.load(workdir)
+    if state is None or state.is_stale():
+        return read_ideal_job_predictions(cfg_settings)
+    return state.beams
+
 def convert_ideal_to_api_status(status):
     new_status = status
     if 'RUNNING GATE' in status:
@@ -13,6 +13,8 @@ import numpy as np
 import itk
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor
+from utils.dicom_index import get_dicom_index
 logger=logging.getLogger(__name__)
 
 class ct_image_base:
@@ -63,16 +65,44 @@ class ct_image_base:
         assert(mhd[-4:].lower() == ".mhd")
         itk.imwrite(self._img,mhd)
 
+def _decode_slice(fname,out):
+    """
+    Read the pixel data of CT slice file `fname` and store it in HU in the int16 array `out`.
+    Returns the rescale slope and intercept of the slice.
+    """
+    ds = pydicom.dcmread(fname)
+    intercept = np.int16(ds.RescaleIntercept)
+    slope = np.float64(ds.RescaleSlope)
+    if slope != 1:
+        # same rounding as before: the slope is applied to the int16 pixel values, then truncated
+        np.copyto(out,(slope*ds.pixel_array.astype(np.int16)).astype(np.int16))
+    else:
+        np.copyto(out,ds.pixel_array,casting='unsafe')
+    out += intercept
+    return slope,intercept
+
 class ct_image_from_dicom(ct_image_base):
-    def __init__(self,ddir,uid=None):
+    """
+    CT image from a DICOM series. The slice headers are read first (without
+    pixel data) and sorted by position, then the pixel data of the slices are
+    decoded by `nthreads` threads (default: up to 8) directly into the volume,
+    with the HU rescaling applied per slice. The time spent in each stage is
+    logged and available in the `timings` dictionary.
+    """
+    def __init__(self,ddir,uid=None,nthreads=None):
         # TODO: is there really not any ITK library function that actually does this for us?
-        self._ndepth = 0
+        t0 = time.time()
         uid,flist = self._get_series_filenames(ddir,uid)
         if not bool(uid) or len(flist)<=1:
             raise RuntimeError("no CT image found in dir {}".format(ddir))
         logger.debug("got {} CT files, first={} last={}".format(len(flist),flist[0],flist[-1]))
-        self._slices = [pydicom.read_file(f) for f in flist]
+        if nthreads is None:
+            nthreads = min(8,os.cpu_count() or 1)
+        t1 = time.time()
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            self._slices = list(pool.map(lambda f: pydicom.dcmread(f,stop_before_pixels=True),flist))
         logger.debug("got {} CT slices".format(len(self._slices)))
+        t2 = time.time()
         #slice_nrs = list()
         #for i,s in enumerate(self._slices):
         #    logger.debug("{}th has instance number '{}' with type '{}'".format(i,str(s.InstanceNumber),type(s.InstanceNumber)))
@@ -81,7 +111,9 @@ class ct_image_from_dicom(ct_image_base):
         #    logger.debug("yep, CT series is correctly sorted")
         #else:
         #    logger.info("CT series needs sorting!")
-        self._slices.sort( key = lambda x: float(x.ImagePositionPatient[2]) )
+        order = sorted(range(len(flist)), key = lambda i: float(self._slices[i].ImagePositionPatient[2]) )
+        self._slices = [self._slices[i] for i in order]
+        flist = [flist[i] for i in order]
         slice_thicknesses = np.round(np.diff([s.ImagePositionPatient[2] for s in self._slices]),decimals=2)
         pixel_widths = np.round([s.PixelSpacing[1] for s in self._slices],decimals=2)
         pixel_heights = np.round([s.PixelSpacing[0] for s in self._slices],decimals=2)
@@ -97,15 +129,16 @@ class ct_image_from_dicom(ct_image_base):
         logger.debug("spacing is ({},{},{})".format(*spacing))
         origin = self._slices[0].ImagePositionPatient[:]
         logger.debug("origin is ({},{},{})".format(*origin))
-        # TODO: is it possible that some self._slices have a different intercept and slope?
-        intercept = np.int16(self._slices[0].RescaleIntercept)
-        slope = np.float64(self._slices[0].RescaleSlope)
-        logger.debug("HU rescale: slope={}, intercept={}".format(slope,intercept))
-        if slope != 1:
-            self._img_array = np.stack([s.pixel_array for s in self._slices]).astype(np.int16)
-            self._img_array = (slope*self._img_array).astype(np.int16)+intercept
-        else:
-            self._img_array = np.stack([s.pixel_array for s in self._slices]).astype(np.int16)+intercept
+        t3 = time.time()
+        rows,cols = int(self._slices[0].Rows),int(self._slices[0].Columns)
+        self._img_array = np.empty((len(flist),rows,cols),dtype=np.int16)
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            rescale = list(pool.map(_decode_slice,flist,self._img_array))
+        # the slope and intercept are applied per slice, in case they are not the same for all slices
+        if len(set(rescale))>1:
+            logger.warn("CT slices have different HU rescale parameters: {}".format(", ".join(["slope={}, intercept={}".format(*sr) for sr in sorted(set(rescale))])))
+        logger.debug("HU rescale: slope={}, intercept={}".format(*rescale[0]))
+        t4 = time.time()
         logger.debug("after HU rescale: min={}, mean={}, median={}, max={}".format( np.min(self._img_array),
                                                                                     np.mean(self._img_array),
                                                                                     np.median(self._img_array),
@@ -114,53 +147,15 @@ class ct_image_from_dicom(ct_image_base):
         self._img.SetSpacing(tuple(spacing))
         self._img.SetOrigin(tuple(origin))
         self._uid = uid
+        t5 = time.time()
+        self.timings = {"series":t1-t0,"headers":t2-t1,"geometry":t3-t2,"pixels":t4-t3,"image":t5-t4}
+        logger.info("read CT with {} slices in {:.3f} seconds ({})".format(len(flist),t5-t0,
+            ", ".join(["{} {:.3f} s".format(k,v) for k,v in self.timings.items()])))
     def _get_series_filenames(self,ddir,uid):
-        logger.debug("getting DICOM series IDs in dir={}, depth={}".format(ddir,self._ndepth))
-        #ids = sitk.ImageSeriesReader_GetGDCMSeriesIDs(ddir)
-        dcmseries_reader = itk.GDCMSeriesFileNames.New(Directory=ddir)
-        ids = dcmseries_reader.GetSeriesUIDs()
-        logger.debug("got DICOM {} series IDs".format(len(ids)))
-        flist=list()
-        if uid:
-            if uid in ids:
-                try:
-                    #flist = sitk.ImageSeriesReader_GetGDCMSeriesFileNames(ddir,uid)
-                    flist = dcmseries_reader.GetFileNames(uid)
-                    return uid,flist
-                except:
-                    logger.error('something wrong with series uid={} in directory {}'.format(uid,ddir))
-                    raise
-        else:
-            ctid = list()
-            for suid in ids:
-                #flist = sitk.ImageSeriesReader_GetGDCMSeriesFileNames(ddir,suid)
-                flist = dcmseries_reader.GetFileNames(suid)
-                f0 = pydicom.dcmread(flist[0])
-                if not hasattr(f0,'SOPClassUID'):
-                    logger.warn("weird, file {} has no SOPClassUID".format(os.path.basename(flist[0])))
-                    continue
-                descr = pydicom.uid.UID_dictionary[f0.SOPClassUID][0]
-                if descr == 'CT Image Storage':
-                    logger.debug('found CT series id {}'.format(suid))
-                    ctid.append(suid)
-                else:
-                    logger.debug('not CT: series id {} is a "{}"'.format(suid,descr))
-            if len(ctid)>1:
-                raise ValueError('no series UID was given, and I found {} different CT image series: {}'.format(len(ctid), ",".join(ctid)))
-            elif len(ctid)==1:
-                uid = ctid[0]
-                #flist = sitk.ImageSeriesReader_GetGDCMSeriesFileNames(ddir,uid)
-                flist = dcmseries_reader.GetFileNames(uid)
-                return uid,flist
-        # still no files?
-        subdirs = [os.path.realpath(os.path.join(ddir,d)) for d in os.listdir(ddir) if os.path.isdir(os.path.join(ddir,d))]
-        for subdir in subdirs:
-            logger.debug("trying to find CT image series in subdirectory {}".format(subdir))
-            self._ndepth += 1
-            uid,flist = self._get_series_filenames(subdir,uid)
-            self._ndepth -= 1
-            if bool(uid) and bool(flist):
-                break
+        logger.debug("getting DICOM series IDs in dir={}".format(ddir))
+        # the directory tree is scanned only once, see utils.dicom_index
+        uid,flist = get_dicom_index(ddir).ct_series_files(uid)
+        logger.debug("got {} CT files for series uid={}".format(len(flist),uid))
         return uid,flist
 
 class ct_image_from_mhd(ct_image_base):
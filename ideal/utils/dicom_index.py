@@ -0,0 +1,394 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Index of the DICOM files in a directory tree (e.g. the directory with the
+RP, RS, RD and CT files of a treatment plan).
+
+The directory tree is scanned once: the headers of all files are read
+(without pixel data) in parallel, and for every DICOM file the SOP class,
+the study, series and instance UIDs and the UIDs of the referenced plan,
+structure set and image series are stored. The lookups for CT series,
+structure sets, dose files and plans then only query the index.
+
+The index is saved as a small sidecar file (a JSON file in the hidden
+subdirectory `.dicom_index` of the top directory, so that updating it does not
+change the modification time of the top directory). It is used as long as
+the modification times of the (sub)directories are unchanged. If files have
+been added, removed or renamed, only the new and changed files are read
+again. Note that a file that is overwritten in place does not change the
+modification time of its directory. If the directory is not writable, the
+index just lives in memory.
+"""
+
+import os
+import json
+import time
+import pydicom
+from concurrent.futures import ThreadPoolExecutor
+import logging
+logger=logging.getLogger(__name__)
+
+CT_IMAGE_STORAGE = "CT Image Storage"
+RT_STRUCTURE_SET_STORAGE = "RT Structure Set Storage"
+RT_DOSE_STORAGE = "RT Dose Storage"
+RT_PLAN_STORAGES = ("RT Ion Plan Storage","RT Plan Storage")
+
+def _uids(seq,attr):
+    """
+    Values of attribute `attr` of the items in DICOM sequence `seq` (which may be missing).
+    """
+    return [str(getattr(item,attr)) for item in (seq or []) if hasattr(item,attr)]
+
+def _header_entry(fpath,stat):
+    """
+    Read the DICOM header of file `fpath` and return the index entry (a dictionary),
+    with 'sop_class' set to None if the file cannot be read as DICOM.
+    """
+    entry = dict(size=stat.st_size,mtime=stat.st_mtime_ns,sop_class=None)
+    try:
+        ds = pydicom.dcmread(fpath,stop_before_pixels=True)
+    except Exception as e:
+        logger.debug("not DICOM: {} ({})".format(fpath,e))
+        return entry
+    if "SOPClassUID" not in ds:
+        logger.debug("no SOPClassUID: {}".format(fpath))
+        return entry
+    entry.update(sop_class=ds.SOPClassUID.name,
+                 modality=str(ds.get("Modality","")),
+                 sop_instance_uid=str(ds.get("SOPInstanceUID","")),
+                 series_uid=str(ds.get("SeriesInstanceUID","")),
+                 study_uid=str(ds.get("StudyInstanceUID","")),
+                 frame_of_reference_uid=str(ds.get("FrameOfReferenceUID","")))
+    # referenced objects: the plan of a dose file, the structure set (and dose) of a plan, the image series of a structure set
+    entry["ref_plan_uids"] = _uids(ds.get("ReferencedRTPlanSequence"),"ReferencedSOPInstanceUID")
+    entry["ref_structure_set_uids"] = _uids(ds.get("ReferencedStructureSetSequence"),"ReferencedSOPInstanceUID")
+    entry["ref_dose_uids"] = _uids(ds.get("ReferencedDoseSequence"),"ReferencedSOPInstanceUID")
+    entry["ref_series_uids"] = [str(series.SeriesInstanceUID)
+                                for frame in ds.get("ReferencedFrameOfReferenceSequence",[])
+                                for study in frame.get("RTReferencedStudySequence",[])
+                                for series in study.get("RTReferencedSeriesSequence",[])
+                                if "SeriesInstanceUID" in series]
+    return entry
+
+class dicom_index(object):
+    """
+    Index of the DICOM files in directory `ddir` and its subdirectories.
+    File paths in the lookup results are absolute; internally they are
+    stored relative to `ddir`.
+    """
+    version = 1
+    sidecar_dir = ".dicom_index"
+    sidecar_name = "index.json"
+    def __init__(self,ddir,nthreads=None,use_sidecar=True):
+        self.ddir = os.path.realpath(ddir)
+        self.nthreads = min(8,os.cpu_count() or 1) if nthreads is None else nthreads
+        self.use_sidecar = use_sidecar
+        self.sidecar = os.path.join(self.ddir,self.sidecar_dir,self.sidecar_name)
+        self.dir_mtimes = dict()
+        self.entries = dict()
+        self.update()
+    def _scan_dirs(self):
+        """
+        Walk the directory tree, return the modification times of all directories and the stat results of all files.
+        """
+        dir_mtimes = dict()
+        stats = dict()
+        for dpath,dnames,fnames in os.walk(self.ddir):
+            dnames[:] = sorted([d for d in dnames if not d.startswith(".")])
+            rdir = os.path.relpath(dpath,self.ddir)
+            dir_mtimes[rdir] = os.stat(dpath).st_mtime_ns
+            for fname in fnames:
+                if fname.startswith("."):
+                    continue
+                fpath = os.path.join(dpath,fname)
+                try:
+                    stats[os.path.normpath(os.path.join(rdir,fname))] = os.stat(fpath)
+                except OSError as e:
+                    logger.debug("cannot stat {}: {}".format(fpath,e))
+        return dir_mtimes,stats
+    def _dir_mtimes_unchanged(self,dir_mtimes):
+        """
+        True if all directories in `dir_mtimes` still exist and have the same modification times.
+        """
+        try:
+            return all([os.stat(os.path.join(self.ddir,rdir)).st_mtime_ns == mtime for rdir,mtime in dir_mtimes.items()])
+        except OSError:
+            return False
+    def _load_sidecar(self):
+        try:
+            with open(self.sidecar,"r") as fp:
+                data = json.load(fp)
+            if data.get("version") != self.version:
+                return False
+            self.dir_mtimes = dict(data["directories"])
+            self.entries = dict(data["files"])
+        except (OSError,ValueError,KeyError,TypeError) as e:
+            logger.debug("could not load DICOM index sidecar {}: {}".format(self.sidecar,e))
+            return False
+        return True
+    def _save_sidecar(self):
+        tmp = "{}.{}.tmp".format(self.sidecar,os.getpid())
+        try:
+            with open(tmp,"w") as fp:
+                json.dump(dict(version=self.version,directories=self.dir_mtimes,files=self.entries),fp)
+            os.replace(tmp,self.sidecar)
+        except OSError as e:
+            logger.debug("could not write DICOM index sidecar {}: {}".format(self.sidecar,e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    @property
+    def is_up_to_date(self):
+        return bool(self.dir_mtimes) and self._dir_mtimes_unchanged(self.dir_mtimes)
+    def update(self):
+        """
+        Make sure that the index is up to date: load the sidecar, or (re)scan
+        the directory tree, reading only new and changed files.
+        Returns the number of files for which the header was read.
+        """
+        if self.is_up_to_date:
+            return 0
+        if self.use_sidecar and not self.entries and self._load_sidecar() and self.is_up_to_date:
+            logger.debug("using DICOM index sidecar {} with {} files".format(self.sidecar,len(self.entries)))
+            return 0
+        t0 = time.time()
+        if self.use_sidecar:
+            # create the sidecar directory before the scan, since it changes the modification time of the top directory
+            try:
+                os.makedirs(os.path.dirname(self.sidecar),exist_ok=True)
+            except OSError as e:
+                logger.debug("cannot create DICOM index sidecar directory: {}".format(e))
+        dir_mtimes,stats = self._scan_dirs()
+        entries = dict()
+        todo = list()
+        for rpath,stat in stats.items():
+            old = self.entries.get(rpath)
+            if old is not None and old["size"] == stat.st_size and old["mtime"] == stat.st_mtime_ns:
+                entries[rpath] = old
+            else:
+                todo.append(rpath)
+        with ThreadPoolExecutor(max_workers=max(1,self.nthreads)) as pool:
+            for rpath,entry in zip(todo,pool.map(lambda r: _header_entry(os.path.join(self.ddir,r),stats[r]),todo)):
+                entries[rpath] = entry
+        self.entries = entries
+        self.dir_mtimes = dir_mtimes
+        logger.debug("indexed {} files in {} directories under {}, read {} headers in {:.3f} seconds".format(
+            len(entries),len(dir_mtimes),self.ddir,len(todo),time.time()-t0))
+        if self.use_sidecar:
+            self._save_sidecar()
+        return len(todo)
+    def _select(self,sop_class=None,toplevel=False,**kwargs):
+        """
+        Relative paths and entries of DICOM files with SOP class (name) `sop_class` (a string or a tuple of strings).
+        With `toplevel` only files in the top directory are considered. The other keyword
+        arguments select entries with the given value; for the "ref_..." lists the
+        value should be in the list.
+        """
+        if isinstance(sop_class,str):
+            sop_class = (sop_class,)
+        selection = list()
+        for rpath in sorted(self.entries.keys()):
+            entry = self.entries[rpath]
+            if entry["sop_class"] is None:
+                continue
+            if sop_class is not None and entry["sop_class"] not in sop_class:
+                continue
+            if toplevel and os.path.dirname(rpath) != "":
+                continue
+            if all([(v in entry.get(k,[])) if k.startswith("ref_") else (entry.get(k) == v) for k,v in kwargs.items()]):
+                selection.append((rpath,entry))
+        return selection
+    def _path(self,rpath):
+        return os.path.join(self.ddir,rpath)
+    def find_files(self,sop_class=None,toplevel=False,**kwargs):
+        """
+        Absolute paths of the DICOM files with the given SOP class and UIDs, see `_select`.
+        """
+        return [self._path(rpath) for rpath,entry in self._select(sop_class,toplevel,**kwargs)]
+    def find_instance(self,sop_instance_uid,sop_class=None):
+        """
+        Path of the file with SOP instance UID `sop_instance_uid`, or None if there is no such file.
+        """
+        found = self.find_files(sop_class,sop_instance_uid=str(sop_instance_uid))
+        if len(found)>1:
+            logger.warn("found {} files with SOP instance UID {}, using the first one: {}".format(len(found),sop_instance_uid,found[0]))
+        return found[0] if found else None
+    def ct_series(self):
+        """
+        Dictionary with the series UIDs of the CT image series as keys and the lists of CT file paths as values.
+        """
+        series = dict()
+        for rpath,entry in self._select(CT_IMAGE_STORAGE):
+            series.setdefault(entry["series_uid"],list()).append(self._path(rpath))
+        return series
+    def ct_series_files(self,uid=None):
+        """
+        Find the CT slice files of the series with UID `uid`. If no UID is given, then
+        there should be one CT series; if there are more than one, the series that are
+        closest to the top directory are used, and there should be only one of those.
+        Returns the series UID and the list of file paths (empty if nothing was found).
+        """
+        if uid:
+            return uid,self.find_files(CT_IMAGE_STORAGE,series_uid=str(uid))
+        depths = dict()
+        for rpath,entry in self._select(CT_IMAGE_STORAGE):
+            depth = rpath.count(os.sep)
+            suid = entry["series_uid"]
+            depths[suid] = min(depth,depths.get(suid,depth))
+        if not depths:
+            return None,list()
+        mindepth = min(depths.values())
+        ctid = sorted([suid for suid,depth in depths.items() if depth == mindepth])
+        if len(ctid)>1:
+            raise ValueError('no series UID was given, and I found {} different CT image series: {}'.format(len(ctid), ",".join(ctid)))
+        return ctid[0],self.find_files(CT_IMAGE_STORAGE,series_uid=ctid[0])
+    def structure_set(self,ss_uid,toplevel=False):
+        """
+        Path of the structure set file with SOP instance UID `ss_uid`, or None.
+        """
+        found = self.find_files(RT_STRUCTURE_SET_STORAGE,toplevel,sop_instance_uid=str(ss_uid))
+        return found[0] if found else None
+    def dose_files(self,rpuid=None,toplevel=False):
+        """
+        Paths of the dose files that refer to the plan with SOP instance UID `rpuid` (all dose files if `rpuid` is None).
+        """
+        if rpuid:
+            return self.find_files(RT_DOSE_STORAGE,toplevel,ref_plan_uids=str(rpuid))
+        return self.find_files(RT_DOSE_STORAGE,toplevel)
+    def plan_files(self,ss_uid=None,toplevel=False):
+        """
+        Paths of the (ion) plan files, optionally only those that refer to structure set `ss_uid`.
+        """
+        if ss_uid:
+            return self.find_files(RT_PLAN_STORAGES,toplevel,ref_structure_set_uids=str(ss_uid))
+        return self.find_files(RT_PLAN_STORAGES,toplevel)
+
+_indices = dict()
+
+def get_dicom_index(ddir,**kwargs):
+    """
+    Get the (up to date) index for directory `ddir`. The index is kept in
+    memory, so that subsequent lookups in the same directory (e.g. for the
+    structure set, the CT series and the dose files of a plan) do not even need
+    to read the sidecar file.
+    """
+    key = os.path.realpath(ddir)
+    index = _indices.get(key)
+    if index is None:
+        index = _indices[key] = dicom_index(key,**kwargs)
+    else:
+        index.update()
+    return index
+
+################################################################################
+# UNIT TESTS                                                                   #
+################################################################################
+
+import unittest
+import tempfile
+import numpy as np
+try:
+    from .logging_conf import LoggedTestCase
+except:
+    LoggedTestCase=unittest.TestCase
+
+class test_dicom_index(LoggedTestCase):
+    def _write(self,fname,sop_class,**kwargs):
+        from pydicom.dataset import Dataset,FileMetaDataset
+        from pydicom.uid import generate_uid,ExplicitVRLittleEndian
+        ds = Dataset()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.MediaStorageSOPClassUID = sop_class
+        ds.file_meta.MediaStorageSOPInstanceUID = kwargs.pop("SOPInstanceUID",generate_uid())
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.SOPClassUID = sop_class
+        ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+        ds.StudyInstanceUID = self.study_uid
+        for k,v in kwargs.items():
+            setattr(ds,k,v)
+        fpath = os.path.join(self.tmpdir.name,fname)
+        os.makedirs(os.path.dirname(fpath),exist_ok=True)
+        ds.save_as(fpath,write_like_original=False)
+        return ds.SOPInstanceUID
+    def _ref(self,**kwargs):
+        from pydicom.dataset import Dataset
+        item = Dataset()
+        for k,v in kwargs.items():
+            setattr(item,k,v)
+        return [item]
+    def setUp(self):
+        from pydicom.uid import generate_uid,CTImageStorage,RTStructureSetStorage,RTDoseStorage,RTIonPlanStorage
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.study_uid = generate_uid()
+        self.ct_uid = generate_uid()
+        for i in range(5):
+            self._write("CT.{}.dcm".format(i),CTImageStorage,Modality="CT",SeriesInstanceUID=self.ct_uid)
+        # another CT series in a subdirectory
+        self.ct2_uid = generate_uid()
+        for i in range(3):
+            self._write(os.path.join("other","CT.{}.dcm".format(i)),CTImageStorage,Modality="CT",SeriesInstanceUID=self.ct2_uid)
+        series = self._ref(RTReferencedSeriesSequence=self._ref(SeriesInstanceUID=self.ct_uid))
+        study = self._ref(RTReferencedStudySequence=series)
+        self.ss_uid = self._write("RS.dcm",RTStructureSetStorage,Modality="RTSTRUCT",ReferencedFrameOfReferenceSequence=study)
+        self.rp_uid = self._write("RP.dcm",RTIonPlanStorage,Modality="RTPLAN",
+                                  ReferencedStructureSetSequence=self._ref(ReferencedSOPInstanceUID=self.ss_uid))
+        self._write("RD.plan.dcm",RTDoseStorage,Modality="RTDOSE",ReferencedRTPlanSequence=self._ref(ReferencedSOPInstanceUID=self.rp_uid))
+        self._write("RD.other.dcm",RTDoseStorage,Modality="RTDOSE",ReferencedRTPlanSequence=self._ref(ReferencedSOPInstanceUID=generate_uid()))
+        with open(os.path.join(self.tmpdir.name,"README.txt"),"w") as fp:
+            fp.write("not a DICOM file\n")
+    def tearDown(self):
+        _indices.clear()
+        self.tmpdir.cleanup()
+    def test_lookups(self):
+        index = dicom_index(self.tmpdir.name,nthreads=3)
+        ddir = index.ddir
+        self.assertEqual(len(index.entries),13)
+        self.assertEqual(sorted(index.ct_series().keys()),sorted([self.ct_uid,self.ct2_uid]))
+        uid,flist = index.ct_series_files()
+        self.assertEqual(uid,self.ct_uid)
+        self.assertEqual(flist,[os.path.join(ddir,"CT.{}.dcm".format(i)) for i in range(5)])
+        uid,flist = index.ct_series_files(self.ct2_uid)
+        self.assertEqual(len(flist),3)
+        self.assertEqual(index.structure_set(self.ss_uid),os.path.join(ddir,"RS.dcm"))
+        self.assertEqual(index.find_files(RT_STRUCTURE_SET_STORAGE,ref_series_uids=self.ct_uid),[os.path.join(ddir,"RS.dcm")])
+        self.assertEqual(index.dose_files(self.rp_uid),[os.path.join(ddir,"RD.plan.dcm")])
+        self.assertEqual(len(index.dose_files()),2)
+        self.assertEqual(index.plan_files(self.ss_uid),[os.path.join(ddir,"RP.dcm")])
+        self.assertEqual(index.find_instance(self.rp_uid),os.path.join(ddir,"RP.dcm"))
+        self.assertIsNone(index.find_instance("1.2.3"))
+    def test_ambiguous_ct(self):
+        from pydicom.uid import generate_uid,CTImageStorage
+        self._write("CT.extra.dcm",CTImageStorage,Modality="CT",SeriesInstanceUID=generate_uid())
+        index = dicom_index(self.tmpdir.name)
+        with self.assertRaises(ValueError):
+            index.ct_series_files()
+    def test_sidecar(self):
+        from pydicom.uid import RTDoseStorage
+        index = dicom_index(self.tmpdir.name)
+        self.assertTrue(os.path.exists(index.sidecar))
+        self.assertTrue(index.is_up_to_date)
+        # the sidecar is used as is
+        index2 = dicom_index(self.tmpdir.name)
+        self.assertEqual(index2.entries,index.entries)
+        self.assertEqual(index2.update(),0)
+        # a new file in a subdirectory invalidates the index, only the new file is read
+        time.sleep(0.01)
+        self._write(os.path.join("other","RD.new.dcm"),RTDoseStorage,Modality="RTDOSE",
+                    ReferencedRTPlanSequence=self._ref(ReferencedSOPInstanceUID=self.rp_uid))
+        index3 = dicom_index(self.tmpdir.name)
+        self.assertEqual(len(index3.dose_files(self.rp_uid)),2)
+        self.assertEqual(len(index3.dose_files(self.rp_uid,toplevel=True)),1)
+        self.assertFalse(index.is_up_to_date)
+        self.assertEqual(index.update(),1)
+        # in-memory index
+        self.assertIs(get_dicom_index(self.tmpdir.name),get_dicom_index(self.tmpdir.name))
+    def test_read_only(self):
+        index = dicom_index(self.tmpdir.name,use_sidecar=False)
+        self.assertFalse(os.path.exists(index.sidecar))
+        self.assertEqual(len(index.ct_series()),2)
+
+# vim: set et softtabstop=4 sw=4 smartindent:
@@ -10,6 +10,7 @@ import pydicom
 import itk
 import numpy as np
 import os
+from utils.dicom_index import get_dicom_index
 logger=logging.getLogger(__name__)
 
 class dose_info(object):
@@ -66,12 +67,10 @@ class dose_info(object):
         #beam_numbers = [str(beam.BeamNumber) for beam in self._rp.IonBeamSequence]
         logger.debug("going to find RD dose files in directory {}".format(dirpath))
         logger.debug("for UID={} PLAN".format(rpuid if rpuid else "any/all"))
-        for s in os.listdir(dirpath):
-            if not s[-4:].lower() == ".dcm":
-                logger.debug("NOT DICOM (no dcm suffix): {}".format(s))
-                continue # not dicom
-            fpath = os.path.join(dirpath,s)
-            dcm = pydicom.read_file(fpath)
+        # only the RD files (referring to the plan) in the directory itself are read
+        for fpath in get_dicom_index(dirpath).dose_files(rpuid,toplevel=True):
+            s = os.path.basename(fpath)
+            dcm = pydicom.dcmread(fpath)
             if 'SOPClassUID' not in dcm:
                 logger.debug("NOT A DOSE FILE (SOPClassUID attribute is missing): {}".format(s))
                 continue # not a RD dose file
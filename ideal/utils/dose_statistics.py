@@ -0,0 +1,358 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Statistical ("Type A") uncertainty of a dose distribution that is the sum of
+the doses D_k of n independent subjobs, with N_k primaries each. The
+estimate uses three sums over the subjobs:
+
+    dosesum   = Sum_k D_k
+    dose2sum  = Sum_k D_k**2 / N_k
+    weightsum = Sum_k N_k
+
+The mean dose per primary is d = dosesum/weightsum, the (primary weighted)
+variance of the dose per primary of the subjobs is v = dose2sum/weightsum - d**2
+and the standard deviation of the mean is s = sqrt(v/n).
+
+If the dose needs to be resampled (mass weighted, see `utils.resample_dose`)
+then the straightforward way to obtain the uncertainty on the new grid is to
+resample every subjob dose before it is added to the sums ("per file").
+The resampling R is linear, so the resampled dose sum can also be obtained
+by resampling the sum on the simulation grid. This is not true for the sum
+of the squares: resampling dose2sum would add the spatial variation of the
+dose within each new voxel to the variance, and resampling the standard
+deviation on the simulation grid is (for uncorrelated voxels) much too
+pessimistic.
+
+Instead, we use "batch means": the subjob doses are distributed over a fixed
+number of batches, the dose sums and the number of primaries are accumulated
+per batch on the simulation grid, and only the batch sums are resampled. The
+batches are themselves independent sums of independent subjobs, so the
+formulas above apply with the resampled batch sums R(B_b) and the numbers of
+primaries per batch instead of the subjob doses. The resampled mean dose is
+the same as with the "per file" method, and the uncertainty estimate is
+statistically equivalent (it is even identical if every batch contains a
+single subjob), but it has fewer degrees of freedom; with 10 or more batches
+this is hardly noticeable.
+
+The convergence of a simulation is judged by the average relative
+uncertainty in the voxels with a mean dose above a given percentage of the
+"max dose" (the average of the highest doses). That average only involves the
+voxels inside the mask (if any) and above the dose threshold, so
+`top_dose_voxels` selects those first and `mean_and_std_of_mean_at` computes
+the mean and the uncertainty for the selected voxels only, instead of for the
+full volume.
+
+The statistical uncertainty decreases as 1/sqrt(N) with the number of
+primaries N. The `uncertainty_history` of a running simulation (the number
+of primaries and the mean uncertainty at successive checks) is used to
+predict when an uncertainty goal will be reached and what the uncertainty
+will be at a given time.
+"""
+
+import numpy as np
+import logging
+logger=logging.getLogger(__name__)
+
+def mean_and_std_of_mean(dosesum,dose2sum,weightsum,n):
+    """
+    Compute the mean dose per primary and the standard deviation of that mean
+    from the sums of `n` subjob doses (see the module documentation).
+    Negative values of the mean and the variance (caused by rounding errors)
+    are replaced by zero. Returns two arrays with the shape of `dosesum`.
+    """
+    amean = dosesum/weightsum
+    avariance = dose2sum/weightsum - amean**2
+    m0 = avariance<0
+    logger.info("negative variance in {} voxels".format(np.sum(m0)))
+    avariance[m0] = 0.
+    m0 = amean<0
+    logger.info("negative mean in {} voxels".format(np.sum(m0)))
+    amean[m0] = 0.
+    astd = np.sqrt(avariance/n)
+    return amean,astd
+
+def batch_mean_and_std(batch_dosesums,batch_weights,resampler=None):
+    """
+    Compute the mean dose per primary and the standard deviation of that mean
+    from the dose sums `batch_dosesums[b]` and the numbers of primaries
+    `batch_weights[b]` of independent batches of subjobs (see the module
+    documentation). The batch sums are resampled with `resampler` (a
+    `utils.resample_dose.ResamplingOperator`), unless it is None. Empty
+    batches (zero weight) are ignored. Returns the mean, the standard
+    deviation and the number of nonempty batches.
+    """
+    rsum = r2sum = None
+    nbatch = 0
+    for adose,weight in zip(batch_dosesums,batch_weights):
+        if weight <= 0:
+            continue
+        rdose = adose if resampler is None else resampler.apply(adose)
+        if rsum is None:
+            rsum = np.zeros(rdose.shape,dtype=float)
+            r2sum = np.zeros(rdose.shape,dtype=float)
+        rsum += rdose
+        r2sum += np.square(rdose,dtype=float)/weight
+        nbatch += 1
+    if nbatch == 0:
+        raise ValueError("all batches are empty")
+    amean,astd = mean_and_std_of_mean(rsum,r2sum,np.sum(batch_weights),nbatch)
+    return amean,astd,nbatch
+
+def top_dose_voxels(adose,ntop,toppct,index=None):
+    """
+    Select the voxels with a dose above `toppct` percent of the "max dose",
+    which is the average of the `ntop` highest doses (negative doses count as
+    zero). The dose `adose` may be the mean dose or anything proportional to
+    it, such as the dose sum. With `index` (flat indices of the voxels inside
+    a mask) only those voxels are considered; voxels outside of the mask count
+    as having zero dose. Returns the flat indices of the selected voxels and
+    the "max dose".
+    """
+    flat = adose.reshape(-1)
+    subset = flat if index is None else flat[index]
+    k = min(ntop,subset.size)
+    if k > 0:
+        top = np.partition(subset,subset.size-k)[subset.size-k:]
+        dmax = np.sum(np.maximum(top,0.))/ntop
+    else:
+        dmax = 0.
+    dthr = dmax*toppct/100.
+    selected = np.flatnonzero(subset>dthr)
+    if index is not None:
+        selected = index[selected]
+    return selected,dmax
+
+def mean_and_std_of_mean_at(dosesum,dose2sum,weightsum,n,voxels):
+    """
+    Same as `mean_and_std_of_mean`, but only for the voxels with flat indices `voxels`.
+    The sums are gathered and the statistics computed in double precision.
+    """
+    dsum = dosesum.reshape(-1)[voxels].astype(float)
+    d2sum = dose2sum.reshape(-1)[voxels].astype(float)
+    amean = dsum/weightsum
+    avariance = np.maximum(d2sum/weightsum - amean**2,0.)
+    return np.maximum(amean,0.),np.sqrt(avariance/n)
+
+def mean_relative_uncertainty(amean,astd):
+    """
+    Average relative uncertainty in percent (100 percent for voxels without positive mean),
+    or infinity if there are no voxels.
+    """
+    if amean.size == 0:
+        return np.inf
+    std_pct = np.full(amean.shape,100.)
+    m0 = amean>0
+    std_pct[m0] = astd[m0]*100./amean[m0]
+    return np.mean(std_pct)
+
+class uncertainty_history(object):
+    """
+    History of (wall time in seconds, number of primaries, mean uncertainty in
+    percent) of a running simulation. The most recent `nfit` records are used
+    to fit the uncertainty as u = a/sqrt(N) and the simulation rate as a
+    straight line N(t). Predictions are only made if at least three records
+    with different numbers of primaries are available and the rate is positive.
+    """
+    def __init__(self,nfit=10):
+        self.nfit = nfit
+        self.records = list()
+    def add(self,t,nprimaries,unc_pct):
+        """
+        Add a record; records without primaries or without a (finite) uncertainty are ignored.
+        """
+        if nprimaries > 0 and np.isfinite(unc_pct) and unc_pct > 0:
+            self.records.append((float(t),float(nprimaries),float(unc_pct)))
+    def save(self,path):
+        np.savetxt(path,np.array(self.records).reshape(-1,3),header="time[s] nprimaries uncertainty[pct]")
+    def load(self,path):
+        self.records = [tuple(r) for r in np.loadtxt(path,ndmin=2).tolist()]
+    def fit(self):
+        """
+        Returns the coefficient `a` of u = a/sqrt(N) and the rate (primaries per
+        second), or None if there are not enough records for a prediction.
+        """
+        recent = np.array(self.records[-self.nfit:]).reshape(-1,3)
+        if len(np.unique(recent[:,1])) < 3:
+            return None
+        t,n,u = recent.T
+        # least squares fit of u = a*x with x = 1/sqrt(N)
+        a = np.sum(u/np.sqrt(n))/np.sum(1./n)
+        rate = np.polyfit(t-t[-1],n,1)[0]
+        if not rate > 0:
+            return None
+        return a,rate
+    def primaries_at(self,t):
+        """
+        Predicted number of primaries at time `t`, or None.
+        """
+        fitted = self.fit()
+        if fitted is None:
+            return None
+        t_last,n_last,u_last = self.records[-1]
+        return n_last + fitted[1]*max(0.,t-t_last)
+    def predicted_uncertainty(self,t):
+        """
+        Predicted mean uncertainty (in percent) at time `t`, or None.
+        """
+        fitted = self.fit()
+        if fitted is None:
+            return None
+        return fitted[0]/np.sqrt(self.primaries_at(t))
+    def time_to_reach(self,goal_pct=0.,nprimaries=0):
+        """
+        Predicted time (in seconds after the last record) until the uncertainty is
+        below `goal_pct` and at least `nprimaries` primaries are simulated, or None.
+        """
+        fitted = self.fit()
+        if fitted is None:
+            return None
+        a,rate = fitted
+        t_last,n_last,u_last = self.records[-1]
+        n_needed = max(nprimaries,(a/goal_pct)**2 if goal_pct > 0 else 0.)
+        return max(0.,(n_needed-n_last)/rate)
+
+################################################################################
+# UNIT TESTS                                                                   #
+################################################################################
+
+import unittest
+import itk
+import os
+import tempfile
+try:
+    from .logging_conf import LoggedTestCase
+except:
+    LoggedTestCase=unittest.TestCase
+
+class test_resample_after_sum(LoggedTestCase):
+    def setUp(self):
+        from utils.resample_dose import ResamplingOperator
+        dims = (30,24,16)
+        amass = np.random.uniform(0.8,1.2,dims[::-1]).astype(np.float32)
+        self.mass = itk.image_from_array(amass)
+        self.mass.SetSpacing((1.,1.,2.))
+        self.mass.SetOrigin((-15.,-12.,-16.))
+        self.newgrid = itk.image_from_array(np.zeros((7,9,11),dtype=np.float32))
+        self.newgrid.SetSpacing((2.3,2.1,3.7))
+        self.newgrid.SetOrigin((-10.,-8.,-10.))
+        self.resampler = ResamplingOperator(self.mass,self.newgrid)
+        # smooth dose profile, subjob doses with uncorrelated noise
+        z,y,x = np.meshgrid(*[np.arange(d,dtype=float) for d in dims[::-1]],indexing="ij")
+        self.profile = np.exp(-((x-15)**2+(y-12)**2)/50.-(z-8)**2/30.)
+        self.nprimaries = np.random.randint(500,1500,40)
+        self.doses = [(n*self.profile*np.random.normal(1.,0.1,self.profile.shape)).astype(np.float32) for n in self.nprimaries]
+    def per_file(self):
+        shape = self.resampler.shape
+        rsum,r2sum = np.zeros(shape),np.zeros(shape)
+        for n_primaries,adose in zip(self.nprimaries,self.doses):
+            rdose = self.resampler.apply(adose)
+            rsum += rdose
+            r2sum += rdose.astype(float)**2/n_primaries
+        return mean_and_std_of_mean(rsum,r2sum,np.sum(self.nprimaries),len(self.nprimaries))
+    def after_sum(self,nbatch):
+        bsums = np.zeros((nbatch,)+self.profile.shape)
+        bweights = np.zeros(nbatch)
+        for i,(n_primaries,adose) in enumerate(zip(self.nprimaries,self.doses)):
+            bsums[i%nbatch] += adose
+            bweights[i%nbatch] += n_primaries
+        return batch_mean_and_std(bsums,bweights,self.resampler)
+    def test_one_file_per_batch(self):
+        mean_pf,std_pf = self.per_file()
+        mean_as,std_as,nbatch = self.after_sum(50)
+        self.assertEqual(nbatch,len(self.nprimaries))
+        self.assertEqual(mean_as.shape,self.resampler.shape)
+        self.assertTrue(np.allclose(mean_pf,mean_as,rtol=1e-4,atol=1e-6*np.max(mean_pf)))
+        self.assertTrue(np.allclose(std_pf,std_as,rtol=1e-3,atol=1e-6*np.max(mean_pf)))
+    def test_batches(self):
+        mean_pf,std_pf = self.per_file()
+        mean_as,std_as,nbatch = self.after_sum(10)
+        self.assertEqual(nbatch,10)
+        # the mean is identical
+        self.assertTrue(np.allclose(mean_pf,mean_as,rtol=1e-4,atol=1e-6*np.max(mean_pf)))
+        # the uncertainty is statistically equivalent
+        m = mean_pf>0.5*np.max(mean_pf)
+        self.assertTrue(np.sum(m)>10)
+        self.assertLess(abs(np.mean(std_as[m]/std_pf[m])-1.),0.2)
+    def test_no_resampling(self):
+        dsum = np.sum(self.doses,axis=0,dtype=float)
+        d2sum = np.sum([adose.astype(float)**2/n for n,adose in zip(self.nprimaries,self.doses)],axis=0)
+        mean0,std0 = mean_and_std_of_mean(dsum,d2sum,np.sum(self.nprimaries),len(self.nprimaries))
+        mean1,std1,nbatch = batch_mean_and_std(self.doses,self.nprimaries)
+        self.assertEqual(nbatch,len(self.nprimaries))
+        self.assertTrue(np.allclose(mean0,mean1))
+        self.assertTrue(np.allclose(std0,std1))
+        with self.assertRaises(ValueError):
+            batch_mean_and_std(self.doses[:2],[0,0])
+
+class test_top_dose_uncertainty(LoggedTestCase):
+    def reference(self,dsum,d2sum,weightsum,n,amask,ntop,toppct):
+        # straightforward full volume computation
+        amean,astd = mean_and_std_of_mean(dsum.copy(),d2sum.copy(),weightsum,n)
+        if amask is not None:
+            amean *= amask
+            astd *= amask
+        m0 = amean>0
+        std_pct = np.full_like(amean,100.)
+        std_pct[m0] = astd[m0]*100./amean[m0]
+        dmax = np.mean(np.partition(amean.flat,-ntop)[-ntop:])
+        mask = (amean>dmax*toppct/100.)
+        return np.mean(std_pct[mask]),np.sum(mask)
+    def test_against_reference(self):
+        shape = (20,30,40)
+        z,y,x = np.meshgrid(*[np.arange(d,dtype=float) for d in shape],indexing="ij")
+        profile = np.exp(-((x-20)**2+(y-15)**2)/40.-(z-10)**2/20.)
+        nprim = np.random.randint(800,1200,12)
+        doses = [n*profile*np.random.normal(1.,0.2,shape) for n in nprim]
+        dsum = np.sum(doses,axis=0)
+        d2sum = np.sum([d**2/n for d,n in zip(doses,nprim)],axis=0)
+        amask = (np.random.uniform(0.,1.,shape)>0.3).astype(np.uint8)
+        for mask,ntop,toppct in [(None,100,50.),(amask,100,50.),(amask,5,90.),(amask,20000,20.)]:
+            unc_ref,nvox_ref = self.reference(dsum,d2sum,np.sum(nprim),len(nprim),mask,ntop,toppct)
+            index = None if mask is None else np.flatnonzero(mask>0)
+            voxels,dmax = top_dose_voxels(dsum,ntop,toppct,index)
+            amean,astd = mean_and_std_of_mean_at(dsum,d2sum,np.sum(nprim),len(nprim),voxels)
+            self.assertEqual(len(voxels),nvox_ref)
+            self.assertAlmostEqual(mean_relative_uncertainty(amean,astd),unc_ref)
+        # zero dose
+        voxels,dmax = top_dose_voxels(np.zeros(shape),100,50.)
+        self.assertEqual(len(voxels),0)
+        self.assertEqual(mean_relative_uncertainty(np.zeros(0),np.zeros(0)),np.inf)
+
+class test_uncertainty_history(LoggedTestCase):
+    def test_prediction(self):
+        # 1000 primaries per second, uncertainty 50% for 1 primary
+        h = uncertainty_history(nfit=5)
+        self.assertIsNone(h.fit())
+        for t in [0.,60.,120.,180.,240.,300.,360.]:
+            n = 1000.*(t+10.)
+            h.add(1e9+t,n,50./np.sqrt(n)*np.random.normal(1.,0.01))
+        h.add(1e9+400.,0,np.inf)
+        self.assertEqual(len(h.records),7)
+        a,rate = h.fit()
+        self.assertAlmostEqual(a,50.,delta=1.)
+        self.assertAlmostEqual(rate,1000.,delta=1e-6)
+        self.assertAlmostEqual(h.primaries_at(1e9+960.),970000.,delta=1.)
+        self.assertAlmostEqual(h.predicted_uncertainty(1e9+960.),50./np.sqrt(970000.),delta=0.001)
+        # u = 0.05% needs 1e6 primaries, 630000 more than at t=360
+        self.assertAlmostEqual(h.time_to_reach(0.05),630.,delta=20.)
+        self.assertAlmostEqual(h.time_to_reach(0.05,2000000),1630.,delta=1e-6)
+        self.assertEqual(h.time_to_reach(1.),0.)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            h.save(os.path.join(tmpdir,"history.txt"))
+            h2 = uncertainty_history(nfit=5)
+            h2.load(os.path.join(tmpdir,"history.txt"))
+            self.assertTrue(np.allclose(h.records,h2.records))
+    def test_no_progress(self):
+        h = uncertainty_history()
+        for t in range(5):
+            h.add(t,1000.,1.)
+        self.assertIsNone(h.fit())
+        self.assertIsNone(h.time_to_reach(0.5))
+        self.assertIsNone(h.predicted_uncertainty(10))
+
+# vim: set et softtabstop=4 sw=4 smartindent:
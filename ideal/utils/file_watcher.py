@@ -0,0 +1,357 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Wait for files in a directory tree to be written, e.g. the dose files that the
+subjobs of a simulation copy into the `tmp/output.*.*` directories.
+
+The files of interest are given as glob patterns relative to a root
+directory, like "tmp/output.*.*/idc-beam1-Dose.mhd". A file "changes" when
+it is closed after writing, moved into place or deleted (the release of a
+lock file is a deletion).
+
+On Linux the watcher uses inotify, via ctypes: the directories that match the
+leading components of the patterns are watched, and directories that are
+created later (e.g. the output directory of a new subjob) are added on the
+fly. Note that inotify does not see changes that are made by other hosts on
+network file systems (NFS etc.); for those, and where inotify is not
+available, the watcher polls the modification times of the matching files
+instead.
+
+Changes are "debounced": after the first change the watcher keeps collecting
+changes until there is a quiet period of `debounce_seconds`, but at most
+`max_delay_seconds`, so that the subjobs that write their dose at nearly the
+same time trigger only one update.
+"""
+
+import os
+import sys
+import time
+import glob
+import select
+import struct
+import fnmatch
+import ctypes
+import ctypes.util
+import logging
+logger=logging.getLogger(__name__)
+
+# inotify event masks, see /usr/include/linux/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+_event_header = struct.Struct("iIII")
+
+# file system types on which inotify does not see changes made by other hosts
+network_filesystems = ("nfs","nfs4","cifs","smb3","smbfs","lustre","gpfs","ceph","beegfs","glusterfs","fuse.sshfs","afs")
+
+def filesystem_type(path):
+    """
+    Type of the file system (as listed in /proc/mounts) that `path` is on, or None if that cannot be determined.
+    """
+    path = os.path.realpath(path)
+    fstype,mountlen = None,-1
+    try:
+        with open("/proc/mounts","r") as fp:
+            for line in fp:
+                words = line.split()
+                if len(words) < 3:
+                    continue
+                mnt = words[1].replace("\\040"," ")
+                if (path == mnt or path.startswith(mnt.rstrip("/")+"/")) and len(mnt) > mountlen:
+                    fstype,mountlen = words[2],len(mnt)
+    except OSError:
+        return None
+    return fstype
+
+class file_watcher_base(object):
+    """
+    Common part of the inotify and polling watchers: the patterns and the debouncing.
+    """
+    def __init__(self,root,patterns,debounce_seconds=2.,max_delay_seconds=30.):
+        self.root = os.path.realpath(root)
+        self.patterns = [os.path.normpath(p) for p in patterns]
+        self.debounce_seconds = debounce_seconds
+        self.max_delay_seconds = max_delay_seconds
+    def matches(self,relpath):
+        """
+        True if the path (relative to the root) matches one of the patterns.
+        """
+        return any([fnmatch.fnmatchcase(relpath,p) for p in self.patterns])
+    def _poll(self,timeout):
+        """
+        Wait at most `timeout` seconds for changes. Returns the set of changed
+        paths (empty if nothing changed), or None if the changes are unknown.
+        """
+        raise NotImplementedError
+    def wait(self,timeout):
+        """
+        Wait at most `timeout` seconds for changes of the matching files, and
+        return the set of (absolute) paths of the files that changed. The set is
+        empty if nothing changed within `timeout`. None is returned if some changes
+        may have been missed (e.g. inotify queue overflow); the caller should then
+        assume that all files changed.
+        """
+        deadline = time.time()+timeout
+        changed = self._poll(max(0.,deadline-time.time()))
+        if not changed:
+            return changed
+        t_first = time.time()
+        while time.time() < t_first+self.max_delay_seconds:
+            quiet_until = min(time.time()+self.debounce_seconds,t_first+self.max_delay_seconds)
+            more = self._poll(max(0.,quiet_until-time.time()))
+            if more is None:
+                return None
+            if not more:
+                break
+            changed |= more
+        logger.debug("got {} changed files in {:.1f} seconds".format(len(changed),time.time()-t_first))
+        return changed
+    def close(self):
+        pass
+    def __enter__(self):
+        return self
+    def __exit__(self,*args):
+        self.close()
+
+class polling_file_watcher(file_watcher_base):
+    """
+    Watcher that compares the modification times of the matching files every `poll_seconds`.
+    """
+    def __init__(self,root,patterns,poll_seconds=10.,**kwargs):
+        super().__init__(root,patterns,**kwargs)
+        self.poll_seconds = poll_seconds
+        self.mtimes = self._scan()
+    def _scan(self):
+        mtimes = dict()
+        for p in self.patterns:
+            for fpath in glob.glob(os.path.join(glob.escape(self.root),p)):
+                try:
+                    mtimes[fpath] = os.stat(fpath).st_mtime_ns
+                except OSError:
+                    # deleted in the meantime
+                    pass
+        return mtimes
+    def _poll(self,timeout):
+        deadline = time.time()+timeout
+        while True:
+            mtimes = self._scan()
+            changed = set([f for f,t in mtimes.items() if self.mtimes.get(f) != t])
+            changed.update(set(self.mtimes.keys()).difference(mtimes.keys()))
+            self.mtimes = mtimes
+            remaining = deadline-time.time()
+            if changed or remaining <= 0:
+                return changed
+            time.sleep(min(self.poll_seconds,remaining))
+
+class inotify_file_watcher(file_watcher_base):
+    """
+    Watcher based on Linux inotify. Raises OSError if inotify is not available.
+    """
+    def __init__(self,root,patterns,**kwargs):
+        super().__init__(root,patterns,**kwargs)
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",use_errno=True)
+        if not hasattr(self._libc,"inotify_init1"):
+            raise OSError("the C library does not provide inotify")
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK|os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno,"inotify_init1 failed: {}".format(os.strerror(errno)))
+        # watch descriptor => path relative to the root
+        self.watches = dict()
+        self._pending = set()
+        self._add_watch(".")
+        # like for the polling watcher, the files that exist from the start do not count as changed
+        self._pending.clear()
+    def _depth_ok(self,reldir):
+        """
+        True if the directory (relative to the root) matches the leading components of some pattern.
+        """
+        if reldir == ".":
+            return True
+        parts = reldir.split(os.sep)
+        return any([len(p.split(os.sep)) > len(parts) and
+                    all([fnmatch.fnmatchcase(a,b) for a,b in zip(parts,p.split(os.sep))]) for p in self.patterns])
+    def _add_watch(self,reldir):
+        """
+        Watch directory `reldir` and the matching subdirectories. Matching files
+        that already exist are reported as changed, since they may have been
+        written before the watch was added.
+        """
+        path = os.path.normpath(os.path.join(self.root,reldir))
+        mask = IN_CLOSE_WRITE|IN_MOVED_TO|IN_CREATE|IN_DELETE|IN_DELETE_SELF
+        wd = self._libc.inotify_add_watch(self.fd,os.fsencode(path),mask)
+        if wd < 0:
+            logger.debug("cannot watch {}: {}".format(path,os.strerror(ctypes.get_errno())))
+            return
+        self.watches[wd] = reldir
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return
+        for name in names:
+            relpath = os.path.normpath(os.path.join(reldir,name))
+            if os.path.isdir(os.path.join(path,name)):
+                if self._depth_ok(relpath):
+                    self._add_watch(relpath)
+            elif self.matches(relpath):
+                self._pending.add(os.path.join(self.root,relpath))
+    def _read_events(self):
+        """
+        Process the queued events, return the set of changed paths or None after a queue overflow.
+        """
+        changed = set()
+        overflow = False
+        while True:
+            try:
+                buf = os.read(self.fd,65536)
+            except BlockingIOError:
+                break
+            if not buf:
+                break
+            offset = 0
+            while offset+_event_header.size <= len(buf):
+                wd,mask,cookie,namelen = _event_header.unpack_from(buf,offset)
+                offset += _event_header.size
+                name = os.fsdecode(buf[offset:offset+namelen].rstrip(b"\0"))
+                offset += namelen
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd,None)
+                    continue
+                reldir = self.watches.get(wd)
+                if reldir is None or not name:
+                    continue
+                relpath = os.path.normpath(os.path.join(reldir,name))
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE|IN_MOVED_TO) and self._depth_ok(relpath):
+                        self._add_watch(relpath)
+                elif mask & (IN_CLOSE_WRITE|IN_MOVED_TO|IN_DELETE) and self.matches(relpath):
+                    changed.add(os.path.join(self.root,relpath))
+        changed |= self._pending
+        self._pending = set()
+        return None if overflow else changed
+    def _poll(self,timeout):
+        deadline = time.time()+timeout
+        while True:
+            changed = self._read_events()
+            remaining = deadline-time.time()
+            if changed is None or changed or remaining <= 0:
+                return changed
+            select.select([self.fd],[],[],remaining)
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+def get_file_watcher(root,patterns,poll_seconds=10.,**kwargs):
+    """
+    Create an inotify watcher if possible, otherwise (no inotify, or a network file system) a polling watcher.
+    """
+    fstype = filesystem_type(root)
+    if fstype in network_filesystems:
+        logger.info("{} is on a {} file system, polling for changes every {} seconds".format(root,fstype,poll_seconds))
+    else:
+        try:
+            watcher = inotify_file_watcher(root,patterns,**kwargs)
+            logger.info("watching for changes in {} with inotify".format(root))
+            return watcher
+        except OSError as e:
+            logger.info("cannot use inotify ({}), polling for changes every {} seconds".format(e,poll_seconds))
+    return polling_file_watcher(root,patterns,poll_seconds=poll_seconds,**kwargs)
+
+################################################################################
+# UNIT TESTS                                                                   #
+################################################################################
+
+import unittest
+import tempfile
+import threading
+try:
+    from .logging_conf import LoggedTestCase
+except:
+    LoggedTestCase=unittest.TestCase
+
+class test_file_watcher(LoggedTestCase):
+    patterns = ["tmp/output.*.*/dose.mhd","tmp/output.*.*/dose.mhd.lock"]
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = os.path.realpath(self.tmpdir.name)
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def _write(self,relpath,delay=0.):
+        if delay > 0:
+            time.sleep(delay)
+        path = os.path.join(self.root,relpath)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        with open(path,"w") as fp:
+            fp.write("{}\n".format(time.time()))
+        return path
+    def _check_watcher(self,watcher,tol):
+        with watcher:
+            # nothing happens
+            self.assertEqual(watcher.wait(0.2),set())
+            # the tmp directory and an output directory are created later
+            t0 = time.time()
+            threading.Thread(target=self._write,args=("tmp/output.1.0/dose.mhd",0.3)).start()
+            changed = watcher.wait(10.)
+            self.assertLess(time.time()-t0,0.3+tol+watcher.debounce_seconds+0.5)
+            self.assertEqual(changed,set([os.path.join(self.root,"tmp/output.1.0/dose.mhd")]))
+            # changes of other files are ignored
+            self._write("tmp/output.1.0/other.txt")
+            self._write("tmp/dose.mhd")
+            self.assertFalse(watcher.wait(0.2+tol))
+            # several subjobs write nearly at the same time: one update
+            threads = [threading.Thread(target=self._write,args=("tmp/output.1.{}/dose.mhd".format(i),0.1*i)) for i in range(4)]
+            for t in threads:
+                t.start()
+            changed = watcher.wait(10.)
+            for t in threads:
+                t.join()
+            if len(changed) < 4:
+                changed |= watcher.wait(tol+watcher.debounce_seconds)
+            self.assertEqual(len(changed),4)
+            # a lock file is released
+            lockfile = self._write("tmp/output.1.2/dose.mhd.lock")
+            watcher.wait(tol+watcher.debounce_seconds)
+            os.remove(lockfile)
+            self.assertEqual(watcher.wait(10.),set([lockfile]))
+    def test_inotify(self):
+        try:
+            watcher = inotify_file_watcher(self.root,self.patterns,debounce_seconds=0.5,max_delay_seconds=5.)
+        except OSError as e:
+            self.skipTest("no inotify: {}".format(e))
+        self._check_watcher(watcher,0.1)
+    def test_polling(self):
+        watcher = polling_file_watcher(self.root,self.patterns,poll_seconds=0.1,debounce_seconds=0.5,max_delay_seconds=5.)
+        self._check_watcher(watcher,0.2)
+    def test_existing_files(self):
+        path = self._write("tmp/output.3.1/dose.mhd")
+        try:
+            watcher = inotify_file_watcher(self.root,self.patterns,debounce_seconds=0.1)
+        except OSError as e:
+            self.skipTest("no inotify: {}".format(e))
+        with watcher:
+            # existing files are not reported, unless they change
+            self.assertEqual(watcher.wait(0.1),set())
+            self._write("tmp/output.3.1/dose.mhd")
+            self.assertEqual(watcher.wait(1.),set([path]))
+    def test_filesystem_type(self):
+        if not os.path.exists("/proc/mounts"):
+            self.skipTest("no /proc/mounts")
+        self.assertIsNotNone(filesystem_type(self.root))
+
+# vim: set et softtabstop=4 sw=4 smartindent:
@@ -12,6 +12,8 @@ Compare two 3D images using the gamma index formalism as introduced by Daniel Lo
 import numpy as np
 import itk
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 logger=logging.getLogger(__name__)
 
 def _reldiff2(dref,dtarget,ddref):
@@ -35,6 +37,15 @@ def get_gamma_index(ref,target,**kwargs):
     * `threshold` indicates minimum dose value (exclusive) for calculating gamma values
     * `verbose` is a flag, True will result in some chatter, False will keep the computation quiet.
     * `threshold_percent` is a flag, True means that threshold is given in percent, False (default) means that the threshold is absolute.
+    * `chunk_voxels` limits the number of target voxels that are processed in one go.
+    * `interpolated_ref` is a flag, True means that for images with different geometry the reference dose is
+      interpolated on a fine grid aligned with the target (see `gamma_index_3d_interpolated_reference`), False (default)
+      means that the nearest voxel implementation `gamma_index_3d_unequal_geometry` is used. The two implementations
+      can give very different pass rates for reference spacings larger than DTA/3, see `gamma_index_3d_interpolated_reference`.
+    * `subdivision` and `margin` configure the fine grid for the interpolated reference.
+    * `n_workers` is the number of worker processes (default 1). With more than one worker the target volume is split
+      in z-tiles which are processed in a process pool; the result is identical to that of a single process.
+      See `gamma_index_3d_equal_geometry` for when this pays off.
 
     Returns an image with the same geometry as the target image.
     For all target voxels in the overlap between ref and target that have d>dmin, a gamma index value is given.
@@ -44,20 +55,122 @@ def get_gamma_index(ref,target,**kwargs):
     """
     if (np.allclose(ref.GetOrigin(),target.GetOrigin())) and \
        (np.allclose(ref.GetSpacing(),target.GetSpacing())) and \
-       (ref.GetLargestPossibleRegion().GetSize() == ref.GetLargestPossibleRegion().GetSize() ):
+       (ref.GetLargestPossibleRegion().GetSize() == target.GetLargestPossibleRegion().GetSize() ):
         if kwargs.get('verbose',False):
-            print("Images with equal geometry, using the slightly faster implementation.")
+            print("Images with equal geometry, using the faster implementation.")
+        for k in ['interpolated_ref','subdivision','margin']:
+            kwargs.pop(k,None)
         return gamma_index_3d_equal_geometry(ref,target,**kwargs)
     else:
         if kwargs.get('verbose',False):
-            print("Images with different geometry, using the slightly slower implementation.")
+            print("Images with different geometry, using the slower implementation.")
+        if kwargs.pop('interpolated_ref',False):
+            return gamma_index_3d_interpolated_reference(ref,target,**kwargs)
+        for k in ['chunk_voxels','subdivision','margin','n_workers']:
+            kwargs.pop(k,None)
         return gamma_index_3d_unequal_geometry(ref,target,**kwargs)
 
 
-# FIXME: Should this function remain public or be made private (by prefixing it with an _underscore)?
-# TODO: Discuss whether to keep this function. It is 30% faster than the
-# "unequal geometry" implementation on the same input images. Is that worth it?
-def gamma_index_3d_equal_geometry(imgref,imgtarget,dta=3.,dd=3., ddpercent=True,threshold=0.,defvalue=-1.,verbose=False,threshold_percent=False):
+# Default bin edges for the gamma histogram in `GammaSummary`.
+default_gamma_bin_edges = (0.,0.25,0.5,0.75,1.,1.25,1.5,2.,3.,5.,np.inf)
+
+class GammaSummary:
+    """
+    Summary of a gamma index distribution: the number of voxels for which a gamma
+    value was computed, the pass rate (fraction of these voxels with gamma<=1),
+    the mean and max gamma value and a histogram of the gamma values.
+    The histogram bins are (lower,upper] intervals, except for the first bin, which includes gamma=0.
+
+    In "pass rate only" mode (see `get_gamma_summary`) the gamma values of
+    passing voxels are only known to be at most 1, so the histogram bins below
+    gamma=1 are merged into one and the mean gamma value is an upper limit.
+    The gamma values of the failing voxels are exact, so the max gamma is exact
+    if at least one voxel fails.
+
+    The `interpolated_ref` flag records whether the reference dose was interpolated
+    (see `gamma_index_3d_interpolated_reference`).
+    """
+    def __init__(self,g2,bin_edges=None,pass_rate_only=False,interpolated_ref=False):
+        g2 = np.asarray(g2,dtype=float)
+        edges = np.array(default_gamma_bin_edges if bin_edges is None else bin_edges,dtype=float)
+        if pass_rate_only:
+            edges = np.concatenate(([0.,1.],edges[edges>1.]))
+        self.pass_rate_only = pass_rate_only
+        self.interpolated_ref = interpolated_ref
+        self.n_voxels = len(g2)
+        self.n_pass = int(np.sum(g2<=1.))
+        self.pass_rate = self.n_pass/self.n_voxels if self.n_voxels>0 else np.nan
+        self.mean_gamma = float(np.mean(np.sqrt(g2))) if self.n_voxels>0 else np.nan
+        self.max_gamma = float(np.sqrt(np.max(g2))) if self.n_voxels>0 else np.nan
+        self.bin_edges = edges
+        # compare squared values, such that the histogram is consistent with the pass rate
+        ibin = np.clip(np.searchsorted(edges**2,g2,side='left')-1,0,len(edges)-2)
+        self.histogram = np.bincount(ibin,minlength=len(edges)-1)
+        self.image = None
+    def as_dict(self,prefix="gamma"):
+        """
+        Summary as a dictionary with strings, e.g. for the user logs/settings.
+        """
+        return {f"{prefix} pass rate only":str(self.pass_rate_only),
+                f"{prefix} interpolated reference":str(self.interpolated_ref),
+                f"{prefix} number of voxels":str(self.n_voxels),
+                f"{prefix} pass rate":str(self.pass_rate),
+                f"{prefix} mean":str(self.mean_gamma),
+                f"{prefix} max":str(self.max_gamma),
+                f"{prefix} histogram bin edges":" ".join([str(e) for e in self.bin_edges]),
+                f"{prefix} histogram counts":" ".join([str(n) for n in self.histogram])}
+    def __str__(self):
+        return "gamma pass rate {0:.2f}% ({1} of {2} voxels), mean gamma {3:.3f}, max gamma {4:.3f}".format(
+                100.*self.pass_rate,self.n_pass,self.n_voxels,self.mean_gamma,self.max_gamma)
+
+def get_gamma_summary(ref,target,pass_rate_only=True,bin_edges=None,**kwargs):
+    """
+    Compute the gamma pass rate and other summary statistics (see `GammaSummary`).
+    The positional and keyword arguments are the same as for `get_gamma_index`, plus:
+    * `pass_rate_only` is a flag. True (default) means that the neighbourhood search for a voxel
+      stops as soon as a reference point with gamma<=1 is found: only the pass/fail result is
+      computed for passing voxels, which is much faster for dose distributions that mostly pass.
+      False means that all gamma values are computed exactly, the gamma image is then available
+      as the `image` attribute of the summary.
+    * `bin_edges` are the edges of the gamma histogram bins (default: `default_gamma_bin_edges`).
+    For images with different geometry, the search only stops early with `interpolated_ref=True`.
+    """
+    defvalue = kwargs.pop('defvalue',-1.)
+    interpolated_ref = kwargs.pop('interpolated_ref',False)
+    dta = kwargs.pop('dta',3.)
+    dd = kwargs.pop('dd',3.)
+    ddpercent = kwargs.pop('ddpercent',True)
+    threshold = kwargs.pop('threshold',0.)
+    verbose = kwargs.pop('verbose',False)
+    threshold_percent = kwargs.pop('threshold_percent',False)
+    chunk_voxels = kwargs.pop('chunk_voxels',2**20)
+    n_workers = kwargs.pop('n_workers',1)
+    subdivision = kwargs.pop('subdivision',None)
+    margin = kwargs.pop('margin',2.)
+    if kwargs:
+        raise TypeError("unexpected keyword arguments for gamma summary: {}".format(", ".join(kwargs.keys())))
+    stop_below = 1. if pass_rate_only else None
+    if (np.allclose(ref.GetOrigin(),target.GetOrigin())) and \
+       (np.allclose(ref.GetSpacing(),target.GetSpacing())) and \
+       (ref.GetLargestPossibleRegion().GetSize() == target.GetLargestPossibleRegion().GetSize() ):
+        interpolated_ref = False
+        mask,g2 = _gamma2_equal_geometry(ref,target,dta,dd,ddpercent,threshold,verbose,threshold_percent,chunk_voxels,n_workers,stop_below)
+    elif interpolated_ref:
+        mask,g2 = _gamma2_interpolated_reference(ref,target,dta,dd,ddpercent,threshold,verbose,threshold_percent,subdivision,margin,chunk_voxels,n_workers,stop_below)
+    else:
+        mask,g2 = _gamma2_unequal_geometry(ref,target,dta,dd,ddpercent,threshold,verbose,threshold_percent)
+    summary = GammaSummary(g2,bin_edges,pass_rate_only,interpolated_ref)
+    if not pass_rate_only:
+        g = np.full(mask.shape,defvalue,dtype=np.float32)
+        g[mask] = np.sqrt(g2)
+        summary.image = itk.GetImageFromArray(g)
+        summary.image.CopyInformation(target)
+    if verbose:
+        print(summary)
+    return summary
+
+
+def gamma_index_3d_equal_geometry(imgref,imgtarget,dta=3.,dd=3., ddpercent=True,threshold=0.,defvalue=-1.,verbose=False,threshold_percent=False,chunk_voxels=2**20,n_workers=1):
     """
     Compare two images with equal geometry, using the gamma index formalism as introduced by Daniel Low (1998).
     * ddpercent indicates "dose difference" scale as a relative value, in units percent (the dd value is this percentage of the max dose in the reference image)
@@ -65,15 +178,50 @@ def gamma_index_3d_equal_geometry(imgref,imgtarget,dta=3.,dd=3., ddpercent=True,
     * dta indicates distance scale ("distance to agreement") in millimeter (e.g. 3mm)
     * threshold indicates minimum dose value (exclusive) for calculating gamma values: target voxels with dose<=threshold are skipped and get assigned gamma=defvalue.
     * threshold_percent is a flag, True means that threshold is given in percent, False (default) means that the threshold is absolute.
+    * chunk_voxels is the (approximate) maximum number of target voxels that is processed in one go; it limits the memory used for temporary arrays.
+    * n_workers is the number of worker processes; with n_workers>1 the target volume is split in about 4*n_workers z-tiles
+      that are processed in parallel. Only the bounding box of the voxels above the threshold is copied to shared memory.
+      Each tile costs some extra CPU time, because the shell search is run separately for each tile. For a full CT
+      dose grid of 512x512x200 voxels of 0.98x0.98x1.5 mm with 1.6 million voxels above the threshold (3%/3mm, 10%
+      threshold), a single process took 3.6 s, of which about 0.5 s (mask, zero offset gamma, summary) is not
+      parallelized, and each tile added about 0.06 s of CPU time. On multiple cores the expected wall clock time is
+      therefore about 0.5 s + 3.1 s/n_workers + 0.25 s, i.e. a speedup of about 3 with 8 workers and about 4 with 32 workers.
+      These numbers were measured on a single core (the sum of the CPU times of all tiles); use `bin/gamma_benchmark.py`
+      to measure the scaling curve on the machine that runs the postprocessing.
     Returns an image with the same geometry as the target image.
     For all target voxels that have d>threshold, a gamma index value is given.
     For all other voxels the "defvalue" is given.
     If geometries of the input images are not equal, then a `ValueError` is raised.
+
+    The neighbourhood search is not performed voxel by voxel. Instead, the
+    integer voxel offsets within the largest relevant gamma radius are sorted
+    by distance ("shells") and each offset is applied to all target voxels of a
+    z-slab at once. A voxel drops out of the search as soon as the distance term of
+    the next offset exceeds its smallest gamma value found so far, so the result
+    is the same as with an exhaustive search (see `_gamma_index_3d_equal_geometry_with_loops`).
     """
-    aref=itk.GetArrayViewFromImage(imgref).swapaxes(0,2)
-    atarget=itk.GetArrayViewFromImage(imgtarget).swapaxes(0,2)
+    atarget=itk.GetArrayViewFromImage(imgtarget)
+    mask,g2 = _gamma2_equal_geometry(imgref,imgtarget,dta,dd,ddpercent,threshold,verbose,threshold_percent,chunk_voxels,n_workers)
+    g = np.full(atarget.shape,defvalue,dtype=np.float32)
+    g[mask] = np.sqrt(g2)
+    # ITK does not support double precision images by default => cast down to float32.
+    # Also: only the first few digits of gamma index values are interesting.
+    gimg=itk.GetImageFromArray(g)
+    gimg.CopyInformation(imgtarget)
+    if verbose:
+        print("100% done!     ")
+    return gimg
+
+def _gamma2_equal_geometry(imgref,imgtarget,dta,dd,ddpercent,threshold,verbose,threshold_percent,chunk_voxels,n_workers,stop_below=None):
+    """
+    Implementation of `gamma_index_3d_equal_geometry`, returns the mask of target voxels
+    for which gamma is computed and the corresponding gamma**2 values.
+    With `stop_below`, the search for a voxel stops as soon as gamma**2<=stop_below.
+    """
+    aref=itk.GetArrayViewFromImage(imgref)
+    atarget=itk.GetArrayViewFromImage(imgtarget)
     if aref.shape != atarget.shape:
-        raise ValueError("input images have different geometries ({} vs {} voxels)".format(aref.shape,atarget.shape))
+        raise ValueError("input images have different geometries ({} vs {} voxels)".format(aref.shape[::-1],atarget.shape[::-1]))
     if not np.allclose(imgref.GetSpacing(),imgtarget.GetSpacing()):
         raise ValueError("input images have different geometries ({} vs {} spacing)".format(imgref.GetSpacing(),imgtarget.GetSpacing()))
     if not np.allclose(imgref.GetOrigin(),imgtarget.GetOrigin()):
@@ -82,54 +230,17 @@ def gamma_index_3d_equal_geometry(imgref,imgtarget,dta=3.,dd=3., ddpercent=True,
         dd *= 0.01*np.max(aref)
     if threshold_percent:
         threshold *= 0.01*np.max(aref)
-    relspacing = np.array(imgref.GetSpacing(),dtype=float)/dta
-    inv_spacing = np.ones(3,dtype=float)/relspacing
-    g00=np.ones(aref.shape,dtype=float)*-1
+    dd = float(dd)
+    # numpy arrays of ITK images are indexed (z,y,x), so we reverse the spacing
+    relspacing = np.array(imgref.GetSpacing(),dtype=float)[::-1]/dta
     mask=atarget>threshold
-    g00[mask]=np.sqrt(_reldiff2(aref[mask],atarget[mask],dd))
-    nx,ny,nz = atarget.shape
-    ntot = nx*ny*nz
+    nz,ny,nx = atarget.shape
     nmask = np.sum(mask)
-    ndone = 0
     if verbose:
-        print("Both images have {} x {} x {} = {} voxels.".format(nx,ny,nz,ntot))
+        print("Both images have {} x {} x {} = {} voxels.".format(nx,ny,nz,nx*ny*nz))
         print("{} target voxels have a dose > {}.".format(nmask,threshold))
-    g2 = np.zeros((nx,ny,nz),dtype=float)
-    for x in range(nx):
-        for y in range(ny):
-            for z in range(nz):
-                if g00[x,y,z] < 0:
-                    continue
-                igmax=np.round(g00[x,y,z]*inv_spacing).astype(int) # maybe we should use "floor" instead of "round"
-                if (igmax==0).all():
-                    g2[x,y,z]=g00[x,y,z]**2
-                else:
-                    ixmin = max(x-igmax[0],0)
-                    ixmax = min(x+igmax[0]+1,nx)
-                    iymin = max(y-igmax[1],0)
-                    iymax = min(y+igmax[1]+1,ny)
-                    izmin = max(z-igmax[2],0)
-                    izmax = min(z+igmax[2]+1,nz)
-                    ix,iy,iz = np.meshgrid(np.arange(ixmin,ixmax),
-                                           np.arange(iymin,iymax),
-                                           np.arange(izmin,izmax),indexing='ij')
-                    g2mesh = _reldiff2(aref[ix,iy,iz],atarget[x,y,z],dd)
-                    g2mesh += ((relspacing[0]*(ix-x)))**2
-                    g2mesh += ((relspacing[1]*(iy-y)))**2
-                    g2mesh += ((relspacing[2]*(iz-z)))**2
-                    g2[x,y,z] = np.min(g2mesh)
-                ndone += 1
-                if verbose and ((ndone % 1000) == 0):
-                    print("{0:.1f}% done...\r".format(ndone*100.0/nmask),end='')
-    g=np.sqrt(g2)
-    g[np.logical_not(mask)]=defvalue
-    # ITK does not support double precision images by default => cast down to float32.
-    # Also: only the first few digits of gamma index values are interesting.
-    gimg=itk.GetImageFromArray(g.swapaxes(0,2).astype(np.float32).copy())
-    gimg.CopyInformation(imgtarget)
-    if verbose:
-        print("100% done!     ")
-    return gimg
+    g2 = _gamma2_on_grid(aref,atarget,mask,relspacing,dd,chunk_voxels=chunk_voxels,verbose=verbose,stop_below=stop_below,n_workers=n_workers)
+    return mask,g2
 
 # FIXME: should this function remain public or be made private (by prefixing it with an _underscore)?
 def gamma_index_3d_unequal_geometry(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True,threshold=0.,defvalue=-1.,verbose=False,threshold_percent=False):
@@ -147,6 +258,26 @@ def gamma_index_3d_unequal_geometry(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True
     For all target voxels that are in the overlap region with the refernce image and that have d>threshold,
     a gamma index value is given. For all other voxels the "defvalue" is given.
     """
+    # test consistency: both must be 3D
+    # it would be cool to make this for 2D as well (and D>3), but not now
+    if len(itk.GetArrayViewFromImage(imgref).shape) != 3 or len(itk.GetArrayViewFromImage(imgtarget).shape) != 3:
+        return None
+    mask,g2 = _gamma2_unequal_geometry(imgref,imgtarget,dta,dd,ddpercent,threshold,verbose,threshold_percent)
+    # ITK does not support double precision images by default => cast down to float32.
+    # Also: only the first few digits of gamma index values are interesting.
+    g = np.full(mask.shape,defvalue,dtype=np.float32)
+    g[mask] = np.sqrt(g2)
+    gimg=itk.GetImageFromArray(g)
+    gimg.CopyInformation(imgtarget)
+    if verbose and len(g2)>0:
+        print("100% done!     ")
+    return gimg
+
+def _gamma2_unequal_geometry(imgref,imgtarget,dta,dd,ddpercent,threshold,verbose,threshold_percent):
+    """
+    Implementation of `gamma_index_3d_unequal_geometry`, returns the mask of target voxels
+    for which gamma is computed and the corresponding gamma**2 values.
+    """
     # get arrays
     aref = itk.GetArrayViewFromImage(imgref).swapaxes(0,2)
     atarget = itk.GetArrayViewFromImage(imgtarget).swapaxes(0,2)
@@ -154,10 +285,8 @@ def gamma_index_3d_unequal_geometry(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True
         dd *= 0.01*np.max(aref)
     if threshold_percent:
         threshold *= 0.01*np.max(aref)
-    # test consistency: both must be 3D
-    # it would be cool to make this for 2D as well (and D>3), but not now
     if len(aref.shape) != 3 or len(atarget.shape) != 3:
-        return None
+        raise ValueError("gamma index for unequal geometry is only implemented for 3D images")
     #bbref  = bounding_box(imgref)
     #bbtarget = bounding_box(imgtarget)
     areforigin = np.array(imgref.GetOrigin())
@@ -173,9 +302,7 @@ def gamma_index_3d_unequal_geometry(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True
     nmask=np.sum(mask)
     if nmask==0:
         print("WARNING: target has no dose over threshold.")
-        dummy = itk.GetImageFromArray((np.ones(atarget.shape)*defvalue).swapaxes(0,2).copy())
-        dummy.CopyInformation(imgtarget)
-        return dummy
+        return mask.swapaxes(0,2),np.zeros(0,dtype=float)
     # now define the indices of the target image voxel centers
     ixtarget, iytarget, iztarget = np.meshgrid(np.arange(nx),np.arange(ny),np.arange(nz),indexing='ij')
     xtarget = atargetorigin[0]+ixtarget*atargetspacing[0]
@@ -192,9 +319,7 @@ def gamma_index_3d_unequal_geometry(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True
     nmask=np.sum(mask)
     if nmask==0:
         print("WARNING: images do not seem to overlap.")
-        dummy = itk.GetImageFromArray((np.ones(atarget.shape)*defvalue).swapaxes(0,2).copy())
-        dummy.CopyInformation(imgtarget)
-        return dummy
+        return mask.swapaxes(0,2),np.zeros(0,dtype=float)
     if verbose:
         print("Reference image has {} x {} x {} = {} voxels.".format(mx,my,mz,mtot))
         print("Target image has {} x {} x {} = {} voxels.".format(nx,ny,nz,ntot))
@@ -238,6 +363,509 @@ def gamma_index_3d_unequal_geometry(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True
         ndone += 1
         if verbose and ((ndone % 1000) == 0):
             print("{0:.1f}% done...\r".format(ndone*100.0/nmask),end='')
+    # back to numpy (z,y,x) order
+    mask = mask.swapaxes(0,2)
+    return mask,g2.swapaxes(0,2)[mask]
+
+def gamma_index_3d_interpolated_reference(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True,threshold=0.,defvalue=-1.,verbose=False,threshold_percent=False,subdivision=None,margin=2.,chunk_voxels=2**20,n_workers=1):
+    """
+    Compare 3-dimensional arrays with possibly different spacing and different origin, using the
+    gamma index formalism, popular in medical physics.
+    We assume that the meshes are *NOT* rotated w.r.t. each other.
+    The arguments `dta`, `dd`, `ddpercent`, `threshold`, `threshold_percent` and
+    `defvalue` have the same meaning as for `gamma_index_3d_unequal_geometry`,
+    `chunk_voxels` and `n_workers` have the same meaning as for `gamma_index_3d_equal_geometry`.
+
+    Instead of searching the reference voxels around each target voxel, the
+    reference dose is interpolated (trilinear) once on a fine grid that is
+    aligned with the target grid: the fine spacing is the target spacing divided
+    by `subdivision` (an integer, or three integers for x,y,z) and each target
+    voxel center coincides with a fine grid point. By default the subdivision is
+    chosen such that the fine spacing is not larger than one third of the DTA.
+    The fine grid covers the
+    target volume plus a margin of `margin` times the DTA, restricted to the
+    reference volume. The gamma values are then computed with the same shell
+    search as for images with equal geometry.
+
+    The results are not identical to those of `gamma_index_3d_unequal_geometry`,
+    which only considers the reference dose at reference voxel centers. For
+    smooth dose distributions and a reference spacing not larger than one third
+    of the DTA, the pass rates (fraction of voxels with gamma<=1) agree within
+    one percentage point. For coarser reference grids the nearest voxel search
+    underestimates the pass rate (it cannot "see" the dose between reference
+    voxel centers) and the difference is large. For an analytical SOBP-like dose
+    (3 mm lateral penumbra, 2 mm distal falloff) on a 2 mm target grid, with
+    3%/3mm and a 10% threshold, 1-3% noise, shifts up to 3.4 mm and 0-3% scaling:
+
+    =================  ==================  ===================
+    reference spacing  nearest voxel       interpolated
+    =================  ==================  ===================
+    2.0 mm             -21 to -26 pp       -1.5 to +0.4 pp
+    2.5 mm             -27 to -30 pp       -0.3 to +1.2 pp
+    3.0 mm             -33 to -35 pp       -3.3 to +0.7 pp
+    =================  ==================  ===================
+
+    The numbers are the differences of the pass rate with the pass rate obtained
+    with the same dose sampled on a 0.5 mm reference grid (i.e. an approximation
+    of the continuous gamma index). The interpolated reference was 6 to 120 times faster
+    in these comparisons. Switching between the two implementations
+    therefore changes the pass rates reported for typical TPS dose grids.
+    Gamma values larger than `margin` may be overestimated for
+    target voxels at the edge of the target volume, because the search does not
+    extend beyond the margin.
+
+    Returns an image with the same geometry as the target image.
+    For all target voxels that are in the overlap region with the reference image and that have d>threshold,
+    a gamma index value is given. For all other voxels the "defvalue" is given.
+    """
+    atarget = itk.GetArrayViewFromImage(imgtarget)
+    if len(atarget.shape) != 3 or len(itk.GetArrayViewFromImage(imgref).shape) != 3:
+        return None
+    mask,g2 = _gamma2_interpolated_reference(imgref,imgtarget,dta,dd,ddpercent,threshold,verbose,threshold_percent,subdivision,margin,chunk_voxels,n_workers)
+    g = np.full(atarget.shape,defvalue,dtype=np.float32)
+    g[mask] = np.sqrt(g2)
+    gimg=itk.GetImageFromArray(g)
+    gimg.CopyInformation(imgtarget)
+    if verbose:
+        print("100% done!     ")
+    return gimg
+
+def _gamma2_interpolated_reference(imgref,imgtarget,dta,dd,ddpercent,threshold,verbose,threshold_percent,subdivision,margin,chunk_voxels,n_workers,stop_below=None):
+    """
+    Implementation of `gamma_index_3d_interpolated_reference`, returns the mask of target voxels
+    for which gamma is computed and the corresponding gamma**2 values.
+    With `stop_below`, the search for a voxel stops as soon as gamma**2<=stop_below.
+    """
+    aref = itk.GetArrayViewFromImage(imgref)
+    atarget = itk.GetArrayViewFromImage(imgtarget)
+    if ddpercent:
+        dd *= 0.01*np.max(aref)
+    if threshold_percent:
+        threshold *= 0.01*np.max(aref)
+    dd = float(dd)
+    if len(aref.shape) != 3 or len(atarget.shape) != 3:
+        raise ValueError("gamma index with interpolated reference is only implemented for 3D images")
+    # all geometry in numpy (z,y,x) order
+    reforigin = np.array(imgref.GetOrigin(),dtype=float)[::-1]
+    refspacing = np.array(imgref.GetSpacing(),dtype=float)[::-1]
+    targetorigin = np.array(imgtarget.GetOrigin(),dtype=float)[::-1]
+    targetspacing = np.array(imgtarget.GetSpacing(),dtype=float)[::-1]
+    if subdivision is None:
+        # fine spacing not larger than DTA/3
+        subdivision = np.ceil(3.*targetspacing/dta-1e-6).astype(int)
+    else:
+        subdivision = (np.ones(3,dtype=int)*np.array(subdivision,dtype=int))[::-1]
+    if (subdivision<1).any():
+        raise ValueError("subdivision should be a positive integer, got {}".format(subdivision[::-1]))
+    finespacing = targetspacing/subdivision
+    # fine grid points: target origin plus integer multiples of the fine spacing, inside the reference volume
+    eps = 1e-6*finespacing
+    lower = np.maximum(reforigin-0.5*refspacing,targetorigin-margin*dta)
+    upper = np.minimum(reforigin+(np.array(aref.shape)-0.5)*refspacing,targetorigin+(np.array(atarget.shape)-1)*targetspacing+margin*dta)
+    jmin = np.ceil((lower-targetorigin-eps)/finespacing).astype(int)
+    jmax = np.floor((upper-targetorigin+eps)/finespacing).astype(int)
+    mask = atarget>threshold
+    for axis in range(3):
+        jtarget = subdivision[axis]*np.arange(atarget.shape[axis])
+        shape = [1,1,1]
+        shape[axis] = -1
+        mask = mask*((jtarget>=jmin[axis])*(jtarget<=jmax[axis])).reshape(shape)
+    nmask = np.sum(mask)
+    if nmask==0:
+        print("WARNING: target has no dose over threshold in the overlap with the reference.")
+        return mask,np.zeros(0,dtype=float)
+    fineshape = jmax-jmin+1
+    fineorigin = targetorigin+jmin*finespacing
+    if verbose:
+        print("Reference image has {} x {} x {} = {} voxels.".format(*aref.shape[::-1],aref.size))
+        print("Target image has {} x {} x {} = {} voxels.".format(*atarget.shape[::-1],atarget.size))
+        print("Interpolated reference has {} x {} x {} = {} voxels.".format(*fineshape[::-1],np.prod(fineshape)))
+        print("{} target voxels in the overlap have dose > {}.".format(nmask,threshold))
+    afine = _interpolate_on_subgrid(aref,reforigin,refspacing,fineorigin,finespacing,fineshape)
+    g2 = _gamma2_on_grid(afine,atarget,mask,finespacing/dta,dd,stride=subdivision,offset=-jmin,chunk_voxels=chunk_voxels,verbose=verbose,stop_below=stop_below,n_workers=n_workers)
+    return mask,g2
+
+################################################################################
+# IMPLEMENTATION DETAILS, DO NOT USE IN CLIENT CODE                            #
+################################################################################
+
+# Maximum number of neighbourhood offsets that is precomputed for the shell search.
+# Voxels that are not resolved within these offsets (very large gamma values) are
+# finished with an exhaustive search in their own neighbourhood.
+_max_shell_offsets = 200000
+
+def _shell_offsets(relspacing,radius,shape,max_offsets=_max_shell_offsets):
+    """
+    Integer voxel offsets within a gamma distance `radius`, sorted by increasing distance.
+
+    The offsets do not include the zero offset and are limited by the array `shape`
+    (offsets larger than the array are never useful). If the number of offsets
+    would exceed `max_offsets`, then the radius is reduced accordingly.
+
+    Returns a tuple with an (n,3) integer array of offsets, an (n,3) array with
+    the squared distance terms per axis, the squared distance (sum of the terms)
+    per offset and the squared radius up to which the offsets are complete.
+    """
+    relspacing = np.asarray(relspacing,dtype=float)
+    r_max = (max_offsets*np.prod(relspacing)*3./(4.*np.pi))**(1./3.)
+    if radius > r_max:
+        radius = r_max
+    imax = np.minimum(np.floor(radius/relspacing).astype(int),np.array(shape)-1)
+    o0,o1,o2 = np.meshgrid(*[np.arange(-i,i+1) for i in imax],indexing='ij')
+    offsets = np.stack((o0.ravel(),o1.ravel(),o2.ravel()),axis=1)
+    terms = (relspacing*offsets)**2
+    d2 = np.sum(terms,axis=1)
+    keep = (d2>0)*(d2<=radius**2)
+    order = np.argsort(d2[keep],kind='stable')
+    # offsets beyond the edge of the array are never needed, so the search is complete up to the radius
+    return offsets[keep][order],terms[keep][order],d2[keep][order],radius**2
+
+def _gamma2_shell_search(aref,tvals,idx,g2,relspacing,dd,shells,stop_below=None):
+    """
+    Minimize gamma**2 for a set of target voxels by applying precomputed shells of offsets.
+
+    * `aref` is the 3D reference dose array
+    * `tvals` are the target dose values (1D)
+    * `idx` is a tuple of three 1D integer arrays with the indices in `aref` of the target voxel positions
+    * `g2` are the initial values of gamma**2 (typically from the zero offset), updated in place
+    * `shells` is the output of `_shell_offsets`
+    * `stop_below` (optional) stops the search for voxels as soon as gamma**2 is below this value
+
+    Returns an integer array with the indices of the voxels for which the
+    search did not finish within the given shells.
+    """
+    offsets,terms,d2,r2complete = shells
+    shape = aref.shape
+    active = np.arange(len(tvals))
+    for (o0,o1,o2),(t0,t1,t2),d2k in zip(offsets,terms,d2):
+        # voxels with a gamma**2 that is not larger than the distance term cannot get any better
+        keep = g2[active]>d2k
+        if stop_below is not None:
+            keep *= g2[active]>stop_below
+        active = active[keep]
+        if active.size == 0:
+            break
+        i0 = idx[0][active]+o0
+        i1 = idx[1][active]+o1
+        i2 = idx[2][active]+o2
+        inside = (i0>=0)*(i0<shape[0])*(i1>=0)*(i1<shape[1])*(i2>=0)*(i2<shape[2])
+        sel = active[inside]
+        cand = _reldiff2(aref[i0[inside],i1[inside],i2[inside]].astype(float),tvals[sel],dd)
+        cand += t2
+        cand += t1
+        cand += t0
+        g2[sel] = np.minimum(g2[sel],cand)
+    if active.size > 0:
+        keep = g2[active]>r2complete
+        if stop_below is not None:
+            keep *= g2[active]>stop_below
+        active = active[keep]
+    return active
+
+def _gamma2_brute_force(aref,tval,i,g2,relspacing,dd):
+    """
+    Exhaustive search for the minimum gamma**2 in the neighbourhood of one target voxel with indices `i`,
+    given an upper bound `g2` for gamma**2. This is only used for the (rare) voxels with very large gamma values.
+    """
+    r = np.sqrt(g2)
+    di = np.floor(r/relspacing).astype(int)
+    imin = np.maximum(np.array(i)-di,0)
+    imax = np.minimum(np.array(i)+di+1,aref.shape)
+    j0,j1,j2 = np.meshgrid(*[np.arange(a,b) for a,b in zip(imin,imax)],indexing='ij')
+    g2mesh = _reldiff2(aref[j0,j1,j2].astype(float),tval,dd)
+    g2mesh += (relspacing[2]*(j2-i[2]))**2
+    g2mesh += (relspacing[1]*(j1-i[1]))**2
+    g2mesh += (relspacing[0]*(j0-i[0]))**2
+    return min(g2,np.min(g2mesh))
+
+def _gamma2_on_grid(aref,atarget,mask,relspacing,dd,stride=(1,1,1),offset=(0,0,0),chunk_voxels=2**20,verbose=False,stop_below=None,n_workers=1):
+    """
+    Compute gamma**2 for all voxels in `mask` of the target array.
+
+    The target voxel with indices `i` corresponds to the reference voxel with indices
+    `offset+stride*i`, i.e. the reference grid is either the same as the target
+    grid or a finer grid that contains all target voxel centers. The `relspacing`
+    is the reference grid spacing divided by the DTA, in numpy (z,y,x) order.
+    Only the bounding box of the mask is processed (see `_crop_to_mask`), in z-slabs of at most
+    (roughly) `chunk_voxels` voxels. With `n_workers>1` the z-slabs are distributed over a pool of worker processes
+    (see `_gamma2_on_grid_parallel`), with identical results.
+    Returns a 1D array with gamma**2 values, in the order of `atarget[mask]`.
+    """
+    stride = np.array(stride,dtype=int)
+    offset = np.array(offset,dtype=int)
+    # the largest gamma value at zero offset limits the search radius for all voxels
+    g2max = _zero_offset_gamma2_max(aref,atarget,mask,dd,stride,offset,chunk_voxels)
+    if g2max is None:
+        return np.zeros(0,dtype=float)
+    radius = float(np.sqrt(g2max))
+    # only the bounding box of the mask is needed, and the reference around it up to the search radius
+    shell_shape = aref.shape
+    halo = np.floor(radius/np.asarray(relspacing,dtype=float)).astype(int)
+    aref,atarget,mask,offset = _crop_to_mask(aref,atarget,mask,stride,offset,halo)
+    if n_workers is not None and n_workers > 1:
+        # thinner slabs if needed, such that there are about four tiles per worker (for the load balance)
+        nslab = max(1,min(_slab_thickness(atarget.shape,chunk_voxels),atarget.shape[0]//(4*n_workers)))
+        chunk_voxels = nslab*atarget.shape[1]*atarget.shape[2]
+        tiles = _z_tiles(mask,4*n_workers,nslab)
+        # with a single tile the pool would only add overhead
+        if len(tiles) > 1:
+            return _gamma2_on_grid_parallel(aref,atarget,mask,relspacing,dd,stride,offset,radius,chunk_voxels,verbose,stop_below,n_workers,tiles,shell_shape)
+    shells = _shell_offsets(relspacing,radius,shell_shape)
+    return _gamma2_on_slabs(aref,atarget,mask,0,atarget.shape[0],relspacing,dd,stride,offset,shells,chunk_voxels,verbose,stop_below)
+
+def _zero_offset_gamma2_max(aref,atarget,mask,dd,stride,offset,chunk_voxels):
+    """
+    Largest gamma**2 at zero offset of the voxels in `mask`, or None if the mask is empty.
+    The volume is processed in the same z-slabs as in `_gamma2_on_slabs`, so that the
+    index arrays never cover more than (roughly) `chunk_voxels` voxels.
+    """
+    nz = atarget.shape[0]
+    nslab = _slab_thickness(atarget.shape,chunk_voxels)
+    g2max = None
+    for z0 in range(0,nz,nslab):
+        z1 = min(z0+nslab,nz)
+        i0,i1,i2 = np.nonzero(mask[z0:z1])
+        if len(i0) == 0:
+            continue
+        rvals = aref[offset[0]+stride[0]*(i0+z0),offset[1]+stride[1]*i1,offset[2]+stride[2]*i2].astype(float)
+        g2 = float(np.max(_reldiff2(rvals,atarget[z0:z1][mask[z0:z1]].astype(float),dd)))
+        g2max = g2 if g2max is None else max(g2max,g2)
+    return g2max
+
+def _gamma2_on_slabs(aref,atarget,mask,zmin,zmax,relspacing,dd,stride,offset,shells,chunk_voxels,verbose=False,stop_below=None):
+    """
+    Compute gamma**2 for the voxels in `mask[zmin:zmax]`, in z-slabs of at most (roughly) `chunk_voxels` voxels.
+    See `_gamma2_on_grid` for the meaning of the other arguments.
+    Returns a 1D array with gamma**2 values, in the order of `atarget[zmin:zmax][mask[zmin:zmax]]`.
+    """
+    nslab = _slab_thickness(atarget.shape,chunk_voxels)
+    nmask = np.sum(mask[zmin:zmax])
+    g2_all = np.empty(nmask,dtype=float)
+    ndone = 0
+    for z0 in range(zmin,zmax,nslab):
+        z1 = min(z0+nslab,zmax)
+        i0,i1,i2 = np.nonzero(mask[z0:z1])
+        n = len(i0)
+        if n == 0:
+            continue
+        i0 = offset[0]+stride[0]*(i0+z0)
+        i1 = offset[1]+stride[1]*i1
+        i2 = offset[2]+stride[2]*i2
+        tvals = atarget[z0:z1][mask[z0:z1]].astype(float)
+        g2 = _reldiff2(aref[i0,i1,i2].astype(float),tvals,dd)
+        todo = _gamma2_shell_search(aref,tvals,(i0,i1,i2),g2,relspacing,dd,shells,stop_below)
+        for j in todo:
+            g2[j] = _gamma2_brute_force(aref,tvals[j],(i0[j],i1[j],i2[j]),g2[j],relspacing,dd)
+        g2_all[ndone:ndone+n] = g2
+        ndone += n
+        if verbose:
+            print("{0:.1f}% done...\r".format(ndone*100.0/nmask),end='')
+    return g2_all
+
+def _crop_to_mask(aref,atarget,mask,stride,offset,halo):
+    """
+    Crop the target and the mask to the bounding box of the mask, and the reference to the
+    reference voxels within `halo` (number of reference voxels per axis) of the bounding box.
+    Returns the cropped reference, target and mask and the `offset` of the cropped target in the
+    cropped reference (see `_gamma2_on_grid`). The masked voxels of the cropped target are in the same order.
+    """
+    tlo = np.zeros(3,dtype=int)
+    thi = np.zeros(3,dtype=int)
+    for axis in range(3):
+        nonzero = np.nonzero(np.any(mask,axis=tuple(a for a in range(3) if a != axis)))[0]
+        tlo[axis],thi[axis] = nonzero[0],nonzero[-1]+1
+    rlo = np.maximum(offset+stride*tlo-halo,0)
+    rhi = np.minimum(offset+stride*(thi-1)+halo+1,aref.shape)
+    tbox = tuple(slice(a,b) for a,b in zip(tlo,thi))
+    rbox = tuple(slice(a,b) for a,b in zip(rlo,rhi))
+    return aref[rbox],atarget[tbox],mask[tbox],offset+stride*tlo-rlo
+
+def _slab_thickness(shape,chunk_voxels):
+    """
+    Number of z-planes per slab, such that a slab has at most (roughly) `chunk_voxels` voxels.
+    """
+    return max(1,int(chunk_voxels)//(shape[1]*shape[2]))
+
+def _z_tiles(mask,ntiles,nslab=1):
+    """
+    Split the z-range of `mask` in at most `ntiles` consecutive tiles with roughly the same number of masked voxels.
+    The tiles consist of whole slabs of `nslab` z-planes, and slabs without masked voxels at the
+    start or end of a tile are left out, such that the tiles together contain exactly the slabs
+    with masked voxels. Returns a list of (zmin,zmax) tuples.
+    """
+    nz = mask.shape[0]
+    slab_counts = np.add.reduceat(np.sum(mask,axis=(1,2)),np.arange(0,nz,nslab))
+    counts = np.cumsum(slab_counts)
+    bounds = np.searchsorted(counts,np.linspace(0,counts[-1],ntiles+1)[1:-1],side='right')
+    bounds = np.unique(np.concatenate(([0],bounds,[len(slab_counts)])))
+    tiles = list()
+    for b0,b1 in zip(bounds[:-1],bounds[1:]):
+        nonempty = np.nonzero(slab_counts[b0:b1])[0]
+        if len(nonempty) > 0:
+            tiles.append((int(nslab*(b0+nonempty[0])),int(min(nz,nslab*(b0+nonempty[-1]+1)))))
+    return tiles
+
+class _SharedArray:
+    """
+    Copy of a numpy array in shared memory, such that worker processes can
+    use it without pickling. The `spec` attribute is what workers need to attach.
+    """
+    def __init__(self,a):
+        a = np.ascontiguousarray(a)
+        self.shm = shared_memory.SharedMemory(create=True,size=max(1,a.nbytes))
+        self.array = np.ndarray(a.shape,dtype=a.dtype,buffer=self.shm.buf)
+        self.array[...] = a
+        self.spec = (self.shm.name,a.shape,a.dtype.str)
+    def release(self):
+        del self.array
+        self.shm.close()
+        self.shm.unlink()
+
+# shells are computed only once per worker process for a given gamma computation
+_worker_shells = dict()
+
+def _gamma2_tile(specs,zmin,zmax,relspacing,dd,stride,offset,radius,chunk_voxels,stop_below,shell_shape):
+    """
+    Worker process side of `_gamma2_on_grid_parallel`: attach to the shared
+    reference, target and mask arrays and compute gamma**2 for one z-tile.
+    The shells are limited by `shell_shape`, the shape of the uncropped reference array.
+    """
+    shms = [shared_memory.SharedMemory(name=name) for name,shape,dtype in specs]
+    try:
+        aref,atarget,mask = [np.ndarray(shape,dtype=np.dtype(dtype),buffer=shm.buf) for shm,(name,shape,dtype) in zip(shms,specs)]
+        key = (tuple(relspacing),radius,shell_shape)
+        if key not in _worker_shells:
+            _worker_shells.clear()
+            _worker_shells[key] = _shell_offsets(relspacing,radius,shell_shape)
+        g2 = _gamma2_on_slabs(aref,atarget,mask,zmin,zmax,relspacing,dd,stride,offset,_worker_shells[key],chunk_voxels,False,stop_below)
+        del aref,atarget,mask
+    finally:
+        for shm in shms:
+            shm.close()
+    return g2
+
+def _gamma2_on_grid_parallel(aref,atarget,mask,relspacing,dd,stride,offset,radius,chunk_voxels,verbose,stop_below,n_workers,tiles,shell_shape):
+    """
+    Compute gamma**2 like `_gamma2_on_grid`, with the z-`tiles` of the target (see `_z_tiles`) distributed over `n_workers` processes.
+    The arrays are cropped to the mask (see `_crop_to_mask`), `shell_shape` is the shape of the uncropped reference array.
+
+    The reference, target and mask arrays are put in shared memory once, so the
+    workers do not receive pickled copies. Each worker reads the whole (cropped) reference
+    array, so the halo around a tile is always as large as the search radius;
+    the tiles are just z-ranges of the target. The tiles consist of whole slabs of the cropped
+    target, which has no more slabs than the full target, so the shell search is not run more
+    often than with a single process. The gamma value of a voxel does not depend on the other
+    voxels in its slab, and every target voxel goes through exactly the same arithmetic as in
+    the single process computation, so the results are bit-identical.
+    """
+    shared = list()
+    try:
+        for a in (aref,atarget,mask):
+            shared.append(_SharedArray(a))
+        specs = [sa.spec for sa in shared]
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(_gamma2_tile,specs,z0,z1,tuple(relspacing),dd,stride,offset,radius,chunk_voxels,stop_below,tuple(shell_shape)) for z0,z1 in tiles]
+            g2 = list()
+            for i,future in enumerate(futures):
+                g2.append(future.result())
+                if verbose:
+                    print("{0:.1f}% done...\r".format((i+1)*100.0/len(futures)),end='')
+    finally:
+        for sa in shared:
+            sa.release()
+    return np.concatenate(g2)
+
+def _interpolate_on_subgrid(aref,reforigin,refspacing,origin,spacing,shape):
+    """
+    Trilinear interpolation of the reference array `aref` (numpy (z,y,x) order) on
+    a grid with given `origin`, `spacing` and `shape` (also in (z,y,x) order).
+    Grid points between the outermost reference voxel centers and the edge of the
+    reference volume get the value of the nearest reference voxel.
+    Since both grids are aligned with the axes, the interpolation is done as three
+    successive 1D interpolations.
+    """
+    a = np.asarray(aref,dtype=np.float32)
+    for axis in range(3):
+        n = a.shape[axis]
+        u = (origin[axis]+np.arange(shape[axis])*spacing[axis]-reforigin[axis])/refspacing[axis]
+        u = np.clip(u,0,n-1)
+        if n == 1:
+            a = np.take(a,np.zeros(shape[axis],dtype=int),axis=axis)
+            continue
+        ilow = np.minimum(np.floor(u).astype(int),n-2)
+        w = (u-ilow).astype(np.float32)
+        wshape = [1,1,1]
+        wshape[axis] = -1
+        w = w.reshape(wshape)
+        a = np.take(a,ilow,axis=axis)*(1-w) + np.take(a,ilow+1,axis=axis)*w
+    return a
+
+def _gamma_index_3d_equal_geometry_with_loops(imgref,imgtarget,dta=3.,dd=3., ddpercent=True,threshold=0.,defvalue=-1.,verbose=False,threshold_percent=False):
+    """
+    Reference implementation, only for testing.
+
+    Compare two images with equal geometry, using the gamma index formalism as introduced by Daniel Low (1998).
+    * ddpercent indicates "dose difference" scale as a relative value, in units percent (the dd value is this percentage of the max dose in the reference image)
+    * ddabs indicates "dose difference" scale as an absolute value
+    * dta indicates distance scale ("distance to agreement") in millimeter (e.g. 3mm)
+    * threshold indicates minimum dose value (exclusive) for calculating gamma values: target voxels with dose<=threshold are skipped and get assigned gamma=defvalue.
+    * threshold_percent is a flag, True means that threshold is given in percent, False (default) means that the threshold is absolute.
+    Returns an image with the same geometry as the target image.
+    For all target voxels that have d>threshold, a gamma index value is given.
+    For all other voxels the "defvalue" is given.
+    If geometries of the input images are not equal, then a `ValueError` is raised.
+    """
+    aref=itk.GetArrayViewFromImage(imgref).swapaxes(0,2)
+    atarget=itk.GetArrayViewFromImage(imgtarget).swapaxes(0,2)
+    if aref.shape != atarget.shape:
+        raise ValueError("input images have different geometries ({} vs {} voxels)".format(aref.shape,atarget.shape))
+    if not np.allclose(imgref.GetSpacing(),imgtarget.GetSpacing()):
+        raise ValueError("input images have different geometries ({} vs {} spacing)".format(imgref.GetSpacing(),imgtarget.GetSpacing()))
+    if not np.allclose(imgref.GetOrigin(),imgtarget.GetOrigin()):
+        raise ValueError("input images have different geometries ({} vs {} origin)".format(imgref.GetOrigin(),imgtarget.GetOrigin()))
+    if ddpercent:
+        dd *= 0.01*np.max(aref)
+    if threshold_percent:
+        threshold *= 0.01*np.max(aref)
+    relspacing = np.array(imgref.GetSpacing(),dtype=float)/dta
+    inv_spacing = np.ones(3,dtype=float)/relspacing
+    g00=np.ones(aref.shape,dtype=float)*-1
+    mask=atarget>threshold
+    g00[mask]=np.sqrt(_reldiff2(aref[mask],atarget[mask],dd))
+    nx,ny,nz = atarget.shape
+    ntot = nx*ny*nz
+    nmask = np.sum(mask)
+    ndone = 0
+    if verbose:
+        print("Both images have {} x {} x {} = {} voxels.".format(nx,ny,nz,ntot))
+        print("{} target voxels have a dose > {}.".format(nmask,threshold))
+    g2 = np.zeros((nx,ny,nz),dtype=float)
+    for x in range(nx):
+        for y in range(ny):
+            for z in range(nz):
+                if g00[x,y,z] < 0:
+                    continue
+                igmax=np.round(g00[x,y,z]*inv_spacing).astype(int) # maybe we should use "floor" instead of "round"
+                if (igmax==0).all():
+                    g2[x,y,z]=g00[x,y,z]**2
+                else:
+                    ixmin = max(x-igmax[0],0)
+                    ixmax = min(x+igmax[0]+1,nx)
+                    iymin = max(y-igmax[1],0)
+                    iymax = min(y+igmax[1]+1,ny)
+                    izmin = max(z-igmax[2],0)
+                    izmax = min(z+igmax[2]+1,nz)
+                    ix,iy,iz = np.meshgrid(np.arange(ixmin,ixmax),
+                                           np.arange(iymin,iymax),
+                                           np.arange(izmin,izmax),indexing='ij')
+                    g2mesh = _reldiff2(aref[ix,iy,iz],atarget[x,y,z],dd)
+                    g2mesh += ((relspacing[0]*(ix-x)))**2
+                    g2mesh += ((relspacing[1]*(iy-y)))**2
+                    g2mesh += ((relspacing[2]*(iz-z)))**2
+                    g2[x,y,z] = np.min(g2mesh)
+                ndone += 1
+                if verbose and ((ndone % 1000) == 0):
+                    print("{0:.1f}% done...\r".format(ndone*100.0/nmask),end='')
     g=np.sqrt(g2)
     g[np.logical_not(mask)]=defvalue
     # ITK does not support double precision images by default => cast down to float32.
@@ -308,6 +936,207 @@ class Test_GammaIndex3dIdenticalMesh(unittest.TestCase):
             tafter = datetime.now()
             print("{}^3 voxels calculating gamma took {}".format(N,tafter-tbefore))
 
+class Test_GammaIndex3dShellSearch(unittest.TestCase):
+    def test_vs_loops(self):
+        # the shell search should give the same gamma values as the exhaustive search with explicit loops
+        print('Test_GammaIndex3dShellSearch test_vs_loops')
+        np.random.seed(7654321)
+        for i in range(4):
+            nxyz=np.random.randint(8,16,3)
+            sxyz=np.random.uniform(0.5,2.5,3)
+            ix,iy,iz = np.meshgrid(*[np.arange(n) for n in nxyz],indexing='ij')
+            aref = 10.*np.exp(-((ix-nxyz[0]/2.)**2+(iy-nxyz[1]/2.)**2)/20.)+0.1*iz
+            atarget = aref*np.random.normal(1.,0.1,nxyz)
+            img_ref = itk.GetImageFromArray(aref.swapaxes(0,2).astype(np.float32).copy())
+            img_target = itk.GetImageFromArray(atarget.swapaxes(0,2).astype(np.float32).copy())
+            for img in (img_ref,img_target):
+                img.SetSpacing(sxyz)
+            for chunk in [1,200,2**20]:
+                img_gamma = gamma_index_3d_equal_geometry(img_ref,img_target,dd=2.,dta=2.,threshold=10.,threshold_percent=True,chunk_voxels=chunk)
+                img_loops = _gamma_index_3d_equal_geometry_with_loops(img_ref,img_target,dd=2.,dta=2.,threshold=10.,threshold_percent=True)
+                self.assertTrue(np.allclose(itk.GetArrayViewFromImage(img_gamma),itk.GetArrayViewFromImage(img_loops),atol=1e-5))
+    def test_brute_force_fallback(self):
+        # voxels that are not resolved by a truncated set of shells are finished by the exhaustive search
+        print('Test_GammaIndex3dShellSearch test_brute_force_fallback')
+        np.random.seed(7654322)
+        aref = np.random.uniform(0.,10.,(10,11,12))
+        atarget = np.random.uniform(0.,10.,(10,11,12))
+        relspacing = np.array([0.8,0.5,0.6])
+        mask = atarget>1.
+        g2_full = _gamma2_on_grid(aref,atarget,mask,relspacing,0.5)
+        i0,i1,i2 = np.nonzero(mask)
+        tvals = atarget[mask]
+        g2 = _reldiff2(aref[mask],tvals,0.5)
+        shells = _shell_offsets(relspacing,np.sqrt(np.max(g2)),aref.shape,max_offsets=20)
+        todo = _gamma2_shell_search(aref,tvals,(i0,i1,i2),g2,relspacing,0.5,shells)
+        self.assertTrue(len(todo)>0)
+        for j in todo:
+            g2[j] = _gamma2_brute_force(aref,tvals[j],(i0[j],i1[j],i2[j]),g2[j],relspacing,0.5)
+        self.assertTrue(np.allclose(g2,g2_full))
+
+class Test_GammaIndex3dInterpolatedReference(unittest.TestCase):
+    def test_EqualMesh(self):
+        # without subdivision and with equal geometry, the interpolated reference is the reference itself
+        print('Test_GammaIndex3dInterpolatedReference test_EqualMesh')
+        np.random.seed(81234567)
+        nxyz=np.random.randint(10,20,3)
+        sxyz=np.random.uniform(0.5,2.5,3)
+        img_ref = itk.GetImageFromArray(np.random.normal(1.,0.05,nxyz).astype(np.float32))
+        img_target = itk.GetImageFromArray(np.random.normal(1.,0.05,nxyz).astype(np.float32))
+        for img in (img_ref,img_target):
+            img.SetSpacing(sxyz)
+            img.SetOrigin((-10.,20.,5.))
+        img_gamma_equal = gamma_index_3d_equal_geometry(img_ref,img_target,dd=3.,dta=2.0)
+        img_gamma_interp = gamma_index_3d_interpolated_reference(img_ref,img_target,dd=3.,dta=2.0,subdivision=1)
+        self.assertTrue(np.allclose(itk.GetArrayViewFromImage(img_gamma_equal),itk.GetArrayViewFromImage(img_gamma_interp)))
+    def test_PassRate(self):
+        # smooth dose distributions on different grids, reference spacing is DTA/3: the pass rate
+        # should be the same as with the nearest voxel implementation, within one percentage point.
+        print('Test_GammaIndex3dInterpolatedReference test_PassRate')
+        np.random.seed(81234568)
+        def gauss(origin,spacing,n,center,width,scale):
+            x,y,z = [o+s*np.arange(m) for o,s,m in zip(origin,spacing,n)]
+            zz,yy,xx = np.meshgrid(z,y,x,indexing='ij')
+            r2 = (xx-center[0])**2+(yy-center[1])**2+(zz-center[2])**2
+            img = itk.GetImageFromArray((scale*np.exp(-0.5*r2/width**2)).astype(np.float32))
+            img.SetOrigin(origin)
+            img.SetSpacing(spacing)
+            return img
+        dt_old,dt_new = 0.,0.
+        for i in range(3):
+            center = np.random.uniform(-5.,5.,3)
+            img_ref = gauss((-40.,-40.,-40.),(1.,1.,1.),(81,81,81),(0.,0.,0.),15.,1.)
+            img_target = gauss((-30.5,-29.7,-31.1),(2.5,2.5,3.),(25,25,21),center,15.*np.random.uniform(0.97,1.03),np.random.uniform(0.97,1.03))
+            t0 = datetime.now()
+            img_gamma_old = gamma_index_3d_unequal_geometry(img_ref,img_target,dd=3.,dta=3.,threshold=10.,threshold_percent=True)
+            t1 = datetime.now()
+            img_gamma_new = gamma_index_3d_interpolated_reference(img_ref,img_target,dd=3.,dta=3.,threshold=10.,threshold_percent=True)
+            t2 = datetime.now()
+            g_old = itk.GetArrayViewFromImage(img_gamma_old)
+            g_new = itk.GetArrayViewFromImage(img_gamma_new)
+            print("{}. nearest voxel implementation took {}, interpolated reference took {}".format(i,t1-t0,t2-t1))
+            dt_old += (t1-t0).total_seconds()
+            dt_new += (t2-t1).total_seconds()
+            self.assertTrue(((g_old>=0)==(g_new>=0)).all())
+            m = g_old>=0
+            pr_old = np.mean(g_old[m]<=1.)
+            pr_new = np.mean(g_new[m]<=1.)
+            print("{}. pass rates: nearest voxel {:.4f}, interpolated reference {:.4f}".format(i,pr_old,pr_new))
+            self.assertTrue(abs(pr_old-pr_new)<0.01)
+        # at least an order of magnitude faster
+        self.assertTrue(dt_old>10.*dt_new)
+
+class Test_GammaIndex3dWorkers(unittest.TestCase):
+    def _gaussians(self,N=40,spacing=(2.,2.,2.5)):
+        x,y,z = np.meshgrid(*[np.arange(N,dtype=float)-N/2 for i in range(3)],indexing='ij')
+        aref = np.exp(-0.5*((x/6.)**2+(y/8.)**2+(z/7.)**2)).swapaxes(0,2).copy()
+        np.random.seed(4321)
+        atarget = (1.02*np.exp(-0.5*(((x-1.3)/6.)**2+(y/8.)**2+((z+0.7)/7.)**2))*np.random.normal(1.,0.02,x.shape)).swapaxes(0,2).copy()
+        img_ref = itk.GetImageFromArray(aref.astype(np.float32))
+        img_target = itk.GetImageFromArray(atarget.astype(np.float32))
+        img_ref.SetSpacing(spacing)
+        img_target.SetSpacing(spacing)
+        return img_ref,img_target
+    def test_bit_identical(self):
+        print('Test_GammaIndex3dWorkers test_bit_identical')
+        img_ref,img_target = self._gaussians()
+        img_gamma1 = get_gamma_index(img_ref,img_target,dd=2.,dta=2.,threshold=5.,threshold_percent=True)
+        g1 = itk.GetArrayViewFromImage(img_gamma1)
+        for n in [2,3]:
+            img_gamma = get_gamma_index(img_ref,img_target,dd=2.,dta=2.,threshold=5.,threshold_percent=True,n_workers=n,chunk_voxels=1000)
+            self.assertTrue(np.array_equal(itk.GetArrayViewFromImage(img_gamma),g1))
+        # unequal geometry
+        img_target.SetOrigin((0.5,-1.,1.25))
+        img_gamma1 = get_gamma_index(img_ref,img_target,dd=2.,dta=2.,threshold=5.,threshold_percent=True,interpolated_ref=True)
+        img_gamma2 = get_gamma_index(img_ref,img_target,dd=2.,dta=2.,threshold=5.,threshold_percent=True,interpolated_ref=True,n_workers=2)
+        self.assertTrue(np.array_equal(itk.GetArrayViewFromImage(img_gamma1),itk.GetArrayViewFromImage(img_gamma2)))
+
+    def test_tiles(self):
+        print('Test_GammaIndex3dWorkers test_tiles')
+        mask = np.zeros((30,4,5),dtype=bool)
+        mask[3:5,1,2] = True
+        mask[11:27,:,3] = True
+        tiles = _z_tiles(mask,6,nslab=4)
+        # whole slabs, in order, without the slabs without masked voxels
+        self.assertEqual(tiles[0][0],0)
+        self.assertEqual(tiles[-1][1],28)
+        for z0,z1 in tiles:
+            self.assertEqual(z0%4,0)
+            self.assertTrue(z1%4==0 or z1==30)
+        for (z0,z1),(z2,z3) in zip(tiles[:-1],tiles[1:]):
+            self.assertTrue(z1<=z2)
+        self.assertEqual(sum([np.sum(mask[z0:z1]) for z0,z1 in tiles]),np.sum(mask))
+        self.assertFalse(any([4<=z0<8 for z0,z1 in tiles]))
+        aref = np.arange(40*10*12,dtype=float).reshape(40,10,12)
+        aref_box,atarget_box,mask_box,offset_box = _crop_to_mask(aref,mask.astype(float),mask,np.array([1,2,2]),np.array([5,1,1]),np.array([2,1,1]))
+        self.assertEqual(mask_box.shape,(24,4,2))
+        self.assertTrue(np.array_equal(atarget_box[mask_box],mask[mask]))
+        # the reference voxel of target voxel (3,1,2) is (8,3,5)
+        self.assertEqual(aref_box[tuple(offset_box+np.array([1,2,2])*np.array([0,1,0]))],aref[8,3,5])
+
+class Test_GammaSummary(unittest.TestCase):
+    def _images(self,N=50,shift=1.,scale=1.03):
+        x,y,z = np.meshgrid(*[np.arange(N,dtype=float)-N/2 for i in range(3)],indexing='ij')
+        aref = 10.*np.exp(-0.5*((x/8.)**2+(y/10.)**2+(z/9.)**2)).swapaxes(0,2).copy()
+        atarget = scale*10.*np.exp(-0.5*(((x-shift)/8.)**2+(y/10.)**2+(z/9.)**2)).swapaxes(0,2).copy()
+        img_ref = itk.GetImageFromArray(aref.astype(np.float32))
+        img_target = itk.GetImageFromArray(atarget.astype(np.float32))
+        img_ref.SetSpacing((2.,2.,2.))
+        img_target.SetSpacing((2.,2.,2.))
+        return img_ref,img_target
+    def test_pass_rate_only(self):
+        print('Test_GammaSummary test_pass_rate_only')
+        for shift,scale in [(1.,1.03),(3.,1.06),(0.,1.2)]:
+            img_ref,img_target = self._images(shift=shift,scale=scale)
+            t0 = datetime.now()
+            full = get_gamma_summary(img_ref,img_target,pass_rate_only=False,dd=2.,dta=2.,threshold=10.,threshold_percent=True)
+            t1 = datetime.now()
+            fast = get_gamma_summary(img_ref,img_target,dd=2.,dta=2.,threshold=10.,threshold_percent=True)
+            t2 = datetime.now()
+            print("full gamma took {}, pass rate only took {}: {}".format(t1-t0,t2-t1,fast))
+            self.assertEqual(fast.n_voxels,full.n_voxels)
+            self.assertEqual(fast.n_pass,full.n_pass)
+            self.assertTrue(fast.mean_gamma >= full.mean_gamma)
+            self.assertEqual(np.sum(fast.histogram),fast.n_voxels)
+            self.assertEqual(np.sum(full.histogram),full.n_voxels)
+            self.assertEqual(fast.histogram[0],fast.n_pass)
+            # bins above gamma=1 are exact in both modes
+            nfine = np.sum(full.bin_edges<1.)
+            self.assertTrue(np.array_equal(fast.histogram[1:],full.histogram[nfine:]))
+            if full.n_pass < full.n_voxels:
+                self.assertEqual(fast.max_gamma,full.max_gamma)
+            # the full summary is consistent with the gamma image
+            img_gamma = get_gamma_index(img_ref,img_target,dd=2.,dta=2.,threshold=10.,threshold_percent=True)
+            self.assertTrue(np.array_equal(itk.GetArrayViewFromImage(img_gamma),itk.GetArrayViewFromImage(full.image)))
+            self.assertIsNone(fast.image)
+    def test_unequal_geometry(self):
+        # by default the nearest voxel implementation is used, also for the summary
+        print('Test_GammaSummary test_unequal_geometry')
+        img_ref,img_target = self._images(N=30)
+        img_target.SetOrigin((0.7,-0.4,1.1))
+        kwargs = dict(dd=2.,dta=2.,threshold=10.,threshold_percent=True)
+        for interpolated_ref in [False,True]:
+            img_gamma = get_gamma_index(img_ref,img_target,interpolated_ref=interpolated_ref,**kwargs)
+            full = get_gamma_summary(img_ref,img_target,pass_rate_only=False,interpolated_ref=interpolated_ref,**kwargs)
+            fast = get_gamma_summary(img_ref,img_target,interpolated_ref=interpolated_ref,**kwargs)
+            self.assertTrue(np.array_equal(itk.GetArrayViewFromImage(img_gamma),itk.GetArrayViewFromImage(full.image)))
+            self.assertEqual(fast.n_pass,full.n_pass)
+            self.assertEqual(full.interpolated_ref,interpolated_ref)
+            self.assertEqual(fast.as_dict()["gamma interpolated reference"],str(interpolated_ref))
+        img_default = get_gamma_index(img_ref,img_target,**kwargs)
+        img_old = gamma_index_3d_unequal_geometry(img_ref,img_target,**kwargs)
+        self.assertTrue(np.array_equal(itk.GetArrayViewFromImage(img_default),itk.GetArrayViewFromImage(img_old)))
+    def test_as_dict(self):
+        print('Test_GammaSummary test_as_dict')
+        summary = GammaSummary(np.array([0.,0.25,1.,1.5**2,16.]))
+        self.assertEqual(summary.n_pass,3)
+        self.assertAlmostEqual(summary.pass_rate,0.6)
+        self.assertEqual(summary.max_gamma,4.)
+        self.assertEqual(summary.histogram.tolist(),[1,1,0,1,0,1,0,0,1,0])
+        d = summary.as_dict("plan dose gamma")
+        self.assertEqual(d["plan dose gamma pass rate"],"0.6")
+        self.assertEqual(d["plan dose gamma histogram counts"],"1 1 0 1 0 1 0 0 1 0")
+
 class Test_GammaIndex3dUnequalMesh(unittest.TestCase):
     def test_EqualMesh(self):
         # For equal meshes, the "unequalmesh" implementation should give the
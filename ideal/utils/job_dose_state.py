@@ -0,0 +1,193 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Convergence statistics of a running job, shared between the job control
+daemon and other processes (the API, `ideal_module.ideal_simulation`).
+
+The job control daemon keeps the dose sums of all beams in memory and is the
+only process that reads the dose files of the subjobs. After each check of a
+beam it writes the statistics (number of primaries, average uncertainty,
+status message, predictions) of all beams to a small JSON file in the work
+directory of the job. The file is replaced atomically, so a reader never
+sees a partially written state. Other processes read this file instead of
+summing the dose files themselves.
+
+A daemon that is killed cannot report that it stopped, so readers should
+check that the state is not stale (see `job_dose_state.is_stale`) before
+they trust the statistics of a running daemon.
+"""
+
+import os
+import json
+import time
+import socket
+import numpy as np
+import logging
+logger=logging.getLogger(__name__)
+
+DOSE_STATE_FILE = "job_dose_state.json"
+
+def dose_state_file(workdir):
+    return os.path.join(workdir,DOSE_STATE_FILE)
+
+def _json_value(v):
+    # JSON has no infinity (e.g. the uncertainty before the first estimate) and no numpy types
+    if isinstance(v,(float,np.floating)):
+        return float(v) if np.isfinite(v) else None
+    if isinstance(v,np.integer):
+        return int(v)
+    if isinstance(v,np.bool_):
+        return bool(v)
+    return v
+
+class job_dose_state(object):
+    """
+    Statistics per beam, as written by the job control daemon. The statistics
+    of a beam are a dictionary with (at least) the keys of `beam_stats`.
+    The daemon saves the state at least once per `polling_interval` (in seconds).
+    """
+    def __init__(self,workdir,running=True,polling_interval=None):
+        self.workdir = workdir
+        self.running = running
+        self.pid = os.getpid()
+        self.host = socket.gethostname()
+        self.polling_interval = polling_interval
+        self.updated = time.time()
+        self.beams = dict()
+    @staticmethod
+    def beam_stats(dosemhd,n_dose_files,n_primaries,mean_unc_pct,status,stopped=False,**kwargs):
+        stats = {"dose file": dosemhd,
+                 "n dose files": n_dose_files,
+                 "n_particles": n_primaries,
+                 "average uncertainty": mean_unc_pct,
+                 "job control daemon status": status,
+                 "stopped": stopped,
+                 "checked": time.time()}
+        stats.update(kwargs)
+        return dict([(k,_json_value(v)) for k,v in stats.items()])
+    def set_beam(self,beamname,stats):
+        self.beams[beamname] = stats
+    def save(self):
+        """
+        Write the state to the work directory. The file is replaced atomically.
+        """
+        self.updated = time.time()
+        fname = dose_state_file(self.workdir)
+        tmpfile = fname+".tmp"
+        with open(tmpfile,"w") as fp:
+            json.dump({"pid":self.pid,"host":self.host,"running":self.running,"polling interval":self.polling_interval,
+                       "updated":self.updated,"beams":self.beams},fp,indent=1)
+        os.replace(tmpfile,fname)
+    @staticmethod
+    def load(workdir):
+        """
+        Read the state of the job in `workdir`. Returns None if no job control
+        daemon wrote a state (yet), or if it cannot be read.
+        """
+        fname = dose_state_file(workdir)
+        if not os.path.exists(fname):
+            return None
+        try:
+            with open(fname,"r") as fp:
+                d = json.load(fp)
+        except Exception as e:
+            logger.warning(f"failed to read dose state from {fname}: {e}")
+            return None
+        state = job_dose_state(workdir,running=bool(d["running"]),polling_interval=d.get("polling interval",None))
+        state.pid = d["pid"]
+        state.host = d.get("host",None)
+        state.updated = d["updated"]
+        state.beams = d["beams"]
+        return state
+    def is_stale(self):
+        """
+        True if the state claims that the daemon is running, but the daemon process
+        no longer exists (checked only on the host on which the daemon runs) or did
+        not save the state for more than two polling intervals. This happens if
+        the daemon was killed, or if the machine on which it ran was rebooted.
+        """
+        if not self.running:
+            return False
+        if self.host == socket.gethostname():
+            try:
+                os.kill(self.pid,0)
+            except ProcessLookupError:
+                return True
+            except PermissionError:
+                # the process exists, but belongs to another user
+                pass
+        if self.polling_interval is not None and time.time()-self.updated > 2*self.polling_interval:
+            return True
+        return False
+    def mean_unc_pct(self,beamname):
+        """
+        Average uncertainty of beam `beamname` (inf if it has not been estimated yet).
+        """
+        v = self.beams[beamname]["average uncertainty"]
+        return np.inf if v is None else v
+
+################################################################################
+# UNIT TESTS                                                                   #
+################################################################################
+
+import unittest
+import tempfile
+import subprocess
+import sys
+try:
+    from .logging_conf import LoggedTestCase
+except:
+    LoggedTestCase=unittest.TestCase
+
+class test_job_dose_state(LoggedTestCase):
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            self.assertIsNone(job_dose_state.load(workdir))
+            state = job_dose_state(workdir)
+            state.save()
+            self.assertEqual(job_dose_state.load(workdir).beams,dict())
+            state.set_beam("B1",job_dose_state.beam_stats("b1.mhd",np.int64(3),np.int64(1000),np.inf,"CONTINUE"))
+            state.set_beam("B2",job_dose_state.beam_stats("b2.mhd",5,2000,np.float32(1.5),"STOP",stopped=np.bool_(True),
+                                                          **{"predicted time to stop [s]":"0"}))
+            state.running = False
+            state.save()
+            self.assertEqual(os.listdir(workdir),[DOSE_STATE_FILE])
+            loaded = job_dose_state.load(workdir)
+            self.assertFalse(loaded.running)
+            self.assertEqual(loaded.beams["B1"]["n_particles"],1000)
+            self.assertEqual(loaded.mean_unc_pct("B1"),np.inf)
+            self.assertAlmostEqual(loaded.mean_unc_pct("B2"),1.5)
+            self.assertTrue(loaded.beams["B2"]["stopped"])
+            self.assertEqual(loaded.beams["B2"]["predicted time to stop [s]"],"0")
+            with open(dose_state_file(workdir),"w") as fp:
+                fp.write("{")
+            self.assertIsNone(job_dose_state.load(workdir))
+    def test_stale(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            state = job_dose_state(workdir,polling_interval=10.)
+            state.save()
+            self.assertFalse(job_dose_state.load(workdir).is_stale())
+            # not updated for more than two polling intervals
+            loaded = job_dose_state.load(workdir)
+            loaded.updated -= 21.
+            self.assertTrue(loaded.is_stale())
+            # a daemon that stopped normally leaves its final statistics
+            loaded.running = False
+            self.assertFalse(loaded.is_stale())
+            # the daemon process does not exist anymore
+            proc = subprocess.Popen([sys.executable,"-c","pass"])
+            proc.wait()
+            state.pid = proc.pid
+            state.save()
+            self.assertTrue(job_dose_state.load(workdir).is_stale())
+            # on another host the process cannot be checked, only the update time
+            state.host = "not-" + socket.gethostname()
+            state.save()
+            self.assertFalse(job_dose_state.load(workdir).is_stale())
+
+# vim: set et softtabstop=4 sw=4 smartindent:
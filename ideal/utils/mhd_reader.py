@@ -0,0 +1,176 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Lightweight reader for MetaImage (MHD/RAW) files, e.g. the dose outputs of
+the GATE subjobs. The header is parsed in Python and the raw data file is
+memory mapped with numpy, so that the voxel data is not copied until it is
+actually used (e.g. when it is added to a dose sum). Compressed data and
+data that is stored inside the header file (``ElementDataFile = LOCAL``) are
+not memory mapped; those files are read with ITK instead.
+"""
+
+import os
+import numpy as np
+import itk
+import logging
+logger=logging.getLogger(__name__)
+
+# MetaImage element types and corresponding numpy types
+_met_types = {
+    "MET_CHAR"   : np.int8,
+    "MET_UCHAR"  : np.uint8,
+    "MET_SHORT"  : np.int16,
+    "MET_USHORT" : np.uint16,
+    "MET_INT"    : np.int32,
+    "MET_UINT"   : np.uint32,
+    "MET_LONG"   : np.int64,
+    "MET_ULONG"  : np.uint64,
+    "MET_FLOAT"  : np.float32,
+    "MET_DOUBLE" : np.float64,
+}
+
+class mhd_geometry(object):
+    """
+    Geometry of an image: origin, spacing and size (in x,y,z order, like ITK) and the direction matrix.
+    """
+    def __init__(self,origin,spacing,size,direction=None):
+        self.origin = np.array(origin,dtype=float)
+        self.spacing = np.array(spacing,dtype=float)
+        self.size = np.array(size,dtype=int)
+        ndim = len(self.size)
+        self.direction = np.identity(ndim) if direction is None else np.array(direction,dtype=float).reshape(ndim,ndim)
+    @staticmethod
+    def from_image(img):
+        return mhd_geometry(img.GetOrigin(),img.GetSpacing(),img.GetLargestPossibleRegion().GetSize(),itk.array_from_matrix(img.GetDirection()))
+    def __repr__(self):
+        return "geometry origin={} spacing={} size={}".format(self.origin.tolist(),self.spacing.tolist(),self.size.tolist())
+    def allclose(self,other):
+        """
+        True if the `other` geometry has the same size and (within rounding errors) the same origin, spacing and direction.
+        """
+        return (self.size.shape == other.size.shape) and (self.size == other.size).all() and \
+                np.allclose(self.origin,other.origin) and np.allclose(self.spacing,other.spacing) and \
+                np.allclose(self.direction,other.direction)
+    def apply_to(self,img):
+        """
+        Set the origin, spacing and direction of ITK image `img` (which should have the same size).
+        """
+        if tuple(img.GetLargestPossibleRegion().GetSize()) != tuple(self.size):
+            raise ValueError("image size {} differs from geometry size {}".format(tuple(img.GetLargestPossibleRegion().GetSize()),tuple(self.size)))
+        img.SetOrigin(self.origin.tolist())
+        img.SetSpacing(self.spacing.tolist())
+        img.SetDirection(itk.matrix_from_array(self.direction))
+    def image_from_array(self,a):
+        """
+        Create an ITK image with this geometry from numpy array `a` (indexed z,y,x, like `itk.image_from_array`).
+        """
+        img = itk.image_from_array(np.ascontiguousarray(a))
+        self.apply_to(img)
+        return img
+
+def read_mhd_header(mhd):
+    """
+    Parse the header of a MetaImage file. Returns a dictionary with the values as strings.
+    """
+    header = dict()
+    with open(mhd,"rb") as fp:
+        for line in fp:
+            line = line.decode("latin-1").strip()
+            if not "=" in line:
+                continue
+            key,value = [w.strip() for w in line.split("=",1)]
+            header[key] = value
+            if key == "ElementDataFile":
+                # the data file is the last entry in the header
+                break
+    return header
+
+def read_mhd(mhd,mode="r"):
+    """
+    Read a MetaImage file with a memory mapped data array.
+    Returns a tuple with the data as a numpy array (indexed z,y,x like `itk.array_view_from_image`)
+    and the geometry (`mhd_geometry`) of the image.
+
+    With the default `mode` ("r") the array is read only, with mode "c" it can
+    be modified without changing the file (copy on write); see `numpy.memmap`.
+    Note that the array becomes invalid if the data file is truncated or
+    rewritten by another process while the array is in use. If that is a
+    risk, make a copy (e.g. with `np.array`) while the file is protected
+    against changes, for instance with a lock file.
+
+    Files that cannot be memory mapped (compressed, data in the header file,
+    multi-component voxels) are read with ITK; the array is then an ordinary
+    numpy array.
+    """
+    header = read_mhd_header(mhd)
+    ndim = int(header.get("NDims","3"))
+    size = [int(w) for w in header["DimSize"].split()]
+    spacing = [float(w) for w in header.get("ElementSpacing",header.get("ElementSize"," ".join(["1"]*ndim))).split()]
+    origin = [float(w) for w in header.get("Offset",header.get("Position",header.get("Origin"," ".join(["0"]*ndim)))).split()]
+    direction = header.get("TransformMatrix",header.get("Rotation",header.get("Orientation",None)))
+    if direction is not None:
+        direction = np.array([float(w) for w in direction.split()]).reshape(ndim,ndim).T
+    geometry = mhd_geometry(origin,spacing,size,direction)
+    datafile = header.get("ElementDataFile","")
+    compressed = header.get("CompressedData","False").lower() == "true"
+    nchannels = int(header.get("ElementNumberOfChannels","1"))
+    met_type = header.get("ElementType","")
+    if compressed or nchannels != 1 or datafile in ("","LOCAL","LIST") or datafile.startswith("LIST") or "%" in datafile or met_type not in _met_types:
+        logger.debug("cannot memory map {}, reading it with ITK".format(mhd))
+        img = itk.imread(mhd)
+        return itk.array_from_image(img),mhd_geometry.from_image(img)
+    dtype = np.dtype(_met_types[met_type])
+    msb = header.get("ElementByteOrderMSB",header.get("BinaryDataByteOrderMSB","False")).lower() == "true"
+    dtype = dtype.newbyteorder(">" if msb else "<")
+    rawpath = datafile if os.path.isabs(datafile) else os.path.join(os.path.dirname(mhd),datafile)
+    nbytes = int(np.prod(size))*dtype.itemsize
+    headersize = int(header.get("HeaderSize","0"))
+    if headersize < 0:
+        # the data are the last bytes of the file
+        headersize = os.stat(rawpath).st_size - nbytes
+    a = np.memmap(rawpath,dtype=dtype,mode=mode,offset=headersize,shape=tuple(size[::-1]))
+    return a,geometry
+
+################################################################################
+# UNIT TESTS                                                                   #
+################################################################################
+
+import unittest
+import tempfile
+
+class test_mhd_reader(unittest.TestCase):
+    def test_float_image(self):
+        a = np.random.normal(1.,0.1,(4,5,6)).astype(np.float32)
+        img = itk.image_from_array(a)
+        img.SetOrigin((-1.5,2.,3.25))
+        img.SetSpacing((0.5,1.,2.5))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            mhd = os.path.join(tmpdir,"dose.mhd")
+            itk.imwrite(img,mhd)
+            b,geometry = read_mhd(mhd)
+            self.assertIsInstance(b,np.memmap)
+            self.assertEqual(b.shape,a.shape)
+            self.assertEqual(b.dtype,np.float32)
+            self.assertTrue(np.array_equal(a,b))
+            self.assertTrue(geometry.allclose(mhd_geometry.from_image(img)))
+            img2 = geometry.image_from_array(np.array(b))
+            self.assertTrue(np.allclose(img2.GetOrigin(),img.GetOrigin()))
+            self.assertTrue(np.allclose(img2.GetSpacing(),img.GetSpacing()))
+            del b
+    def test_compressed(self):
+        a = np.arange(60,dtype=np.uint16).reshape(3,4,5)
+        img = itk.image_from_array(a)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            mhd = os.path.join(tmpdir,"counts.mhd")
+            itk.imwrite(img,mhd,compression=True)
+            b,geometry = read_mhd(mhd)
+            self.assertNotIsInstance(b,np.memmap)
+            self.assertTrue(np.array_equal(a,b))
+            self.assertEqual(geometry.size.tolist(),[5,4,3])
+
+# vim: set et softtabstop=4 sw=4 smartindent:
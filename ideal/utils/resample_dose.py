@@ -32,6 +32,8 @@ machine.
 # -----------------------------------------------------------------------------
 
 
+import os
+import hashlib
 import numpy as np
 import itk
 from datetime import datetime
@@ -39,7 +41,7 @@ from utils.bounding_box import bounding_box
 import logging
 logger=logging.getLogger(__name__)
 
-def mass_weighted_resampling(dose,mass,newgrid):
+def mass_weighted_resampling(dose,mass,newgrid,cache_dir=None):
     """
     This function computes a dose distribution using the geometry (origin,
     size, spacing) of the `newgrid` image, using the energy deposition and mass
@@ -48,11 +50,19 @@ def mass_weighted_resampling(dose,mass,newgrid):
     and then we want to resample this dose distribution to the geometry of the
     new grid, e.g. from the dose distribution computed by a TPS.
 
-    This implementation relies on a bit of numpy magic (np.tensordot,
-    repeatedly).  A intuitively more clear but in practice much slower
-    implementation is given by `_mwr_wit_loops(dose,mass,newgrid)`; the unit
-    tests are verifying that these two implementation indeed yield the same
-    result. 
+    The actual work is done by a `ResamplingOperator`. The operators for the
+    most recently used mass/newgrid pairs are kept in memory, such that
+    repeated calls with the same mass image object and new grid only compute the
+    overlaps and the normalization once (a mass image that is read again from
+    file is a different object and gets a new operator). The mass image should
+    therefore not be modified in place between calls. If you resample many doses with the same
+    mass and new grid, then it is cleaner to create a `ResamplingOperator` yourself.
+    With `cache_dir`, an operator that is not in memory yet is read from (or
+    saved to) the on-disk cache in that directory, see `ResamplingOperator`.
+
+    An intuitively more clear but in practice much slower implementation is
+    given by `_mwr_with_loops(dose,mass,newgrid)`; the unit tests are verifying
+    that these two implementation indeed yield the same result.
     """
     assert(equal_geometry(dose,mass))
     if equal_geometry(dose,newgrid):
@@ -60,37 +70,109 @@ def mass_weighted_resampling(dose,mass,newgrid):
         newdose=itk.image_from_array(itk.array_from_image(dose))
         newdose.CopyInformation(dose)
         return newdose
-    if not enclosing_geometry(dose,newgrid):
-        # In a later release we may provide some smart code to deal with dose resampling outside of the input geometry.
-        raise RuntimeError("new grid must be inside the old one")
-    # start the timer
-    t0=datetime.now()
-    xol,yol,zol = [ _overlaps(*xyz) for xyz in zip(dose.GetOrigin(),
-                                                   dose.GetSpacing(),
-                                                   dose.GetLargestPossibleRegion().GetSize(),
-                                                   newgrid.GetOrigin(),
-                                                   newgrid.GetSpacing(),
-                                                   newgrid.GetLargestPossibleRegion().GetSize()) ]
-    adose = itk.array_from_image(dose)
-    amass = itk.array_from_image(mass)
-    aedep = adose*amass
-    # now the magic happens :-)
-    anew = np.tensordot(zol,np.tensordot(yol,np.tensordot(xol,aedep,axes=(0,2)),axes=(0,2)),axes=(0,2))
-    wsum = np.tensordot(zol,np.tensordot(yol,np.tensordot(xol,amass,axes=(0,2)),axes=(0,2)),axes=(0,2))
-    # paranoia
-    mzyx = tuple(np.array(newgrid.GetLargestPossibleRegion().GetSize())[::-1])
-    assert(anew.shape==tuple(mzyx))
-    assert(wsum.shape==tuple(mzyx))
-    # dose=edep/mass, but only if mass>0
-    mask=(wsum>0)
-    anew[mask]/=wsum[mask]
-    newdose=itk.image_from_array(anew)
-    newdose.CopyInformation(newgrid)
-    # stop the timer
-    t1=datetime.now()
-    dt=(t1-t0).total_seconds()
-    logger.debug(f"resampling using `np.tensordot` took {dt:.3f} seconds")
-    return newdose
+    return _get_operator(mass,newgrid,cache_dir).resample(dose)
+
+class ResamplingOperator(object):
+    """
+    Mass weighted resampling (see `mass_weighted_resampling`) from the geometry of
+    a given mass image to the geometry of a given new grid, for many dose distributions.
+
+    The resampling is separable: the overlaps of the input and output voxels
+    are computed per axis (see `_overlap_entries`), and only the nonzero
+    overlaps are stored. The energy deposition (dose times mass) is
+    contracted with these sparse overlaps one axis at a time, in single
+    precision. The contraction of the mass only (`wsum`, the normalization)
+    is computed once, when the operator is created.
+
+    If a `cache_dir` is given, then the overlaps and the normalization are
+    saved in that directory, in a file with a name based on a hash of the
+    geometries and of the mass data. Operators created later with the same
+    mass and new grid (e.g. by a restarted job control daemon) read that file
+    instead of computing everything again.
+    """
+    def __init__(self,mass,newgrid,cache_dir=None):
+        if not enclosing_geometry(mass,newgrid):
+            # In a later release we may provide some smart code to deal with dose resampling outside of the input geometry.
+            raise RuntimeError("new grid must be inside the old one")
+        t0=datetime.now()
+        self.amass = itk.array_view_from_image(mass)
+        self.mass_shape = self.amass.shape
+        self.origin = np.array(newgrid.GetOrigin(),dtype=float)
+        self.spacing = np.array(newgrid.GetSpacing(),dtype=float)
+        self.direction = np.array(itk.array_from_matrix(newgrid.GetDirection()),dtype=float)
+        self.shape = tuple(np.array(newgrid.GetLargestPossibleRegion().GetSize(),dtype=int)[::-1])
+        self.cache_file = None
+        if bool(cache_dir):
+            self.cache_file = os.path.join(cache_dir,"resampling_{}.npz".format(self.hash_key(mass,newgrid)))
+        if self.cache_file and os.path.exists(self.cache_file):
+            self._load(self.cache_file)
+            logger.debug(f"read resampling operator from {self.cache_file}")
+        else:
+            self.entries = [ _overlap_entries(*xyz) for xyz in zip(mass.GetOrigin(),
+                                                                  mass.GetSpacing(),
+                                                                  mass.GetLargestPossibleRegion().GetSize(),
+                                                                  newgrid.GetOrigin(),
+                                                                  newgrid.GetSpacing(),
+                                                                  newgrid.GetLargestPossibleRegion().GetSize()) ]
+            self.wsum = self._contract(self.amass)
+            if self.cache_file:
+                os.makedirs(cache_dir,exist_ok=True)
+                self._save(self.cache_file)
+                logger.debug(f"saved resampling operator in {self.cache_file}")
+        # paranoia
+        assert(self.wsum.shape==self.shape)
+        self.mask = self.wsum>0
+        dt=(datetime.now()-t0).total_seconds()
+        logger.debug(f"creating resampling operator took {dt:.3f} seconds")
+    @staticmethod
+    def hash_key(mass,newgrid):
+        """
+        Hash of the geometries of the mass image and the new grid and of the mass data.
+        """
+        h = hashlib.sha1()
+        for img in (mass,newgrid):
+            h.update(np.array(_geometry_key(img),dtype=float).tobytes())
+        h.update(np.ascontiguousarray(itk.array_view_from_image(mass)).tobytes())
+        return h.hexdigest()
+    def _contract(self,a):
+        for axis,e in zip((2,1,0),self.entries):
+            a = _sparse_contraction(a,e,axis)
+        return a
+    def _save(self,path):
+        arrays = {"wsum":self.wsum}
+        for label,(ia,ib,w,nb) in zip("xyz",self.entries):
+            arrays.update({"ia"+label:ia,"ib"+label:ib,"w"+label:w,"nb"+label:np.array(nb)})
+        tmpfile = path+".tmp"
+        with open(tmpfile,"wb") as fp:
+            np.savez(fp,**arrays)
+        os.replace(tmpfile,path)
+    def _load(self,path):
+        with np.load(path) as arrays:
+            self.wsum = arrays["wsum"]
+            self.entries = [(arrays["ia"+label],arrays["ib"+label],arrays["w"+label],int(arrays["nb"+label])) for label in "xyz"]
+    def apply(self,dose_array):
+        """
+        Resample a dose array (indexed z,y,x, with the same shape as the mass image).
+        Returns a float32 array with the shape of the new grid (also indexed z,y,x).
+        """
+        if dose_array.shape != self.mass_shape:
+            raise ValueError("dose shape {} differs from mass shape {}".format(dose_array.shape,self.mass_shape))
+        t0=datetime.now()
+        anew = self._contract(np.multiply(dose_array,self.amass,dtype=np.float32))
+        # dose=edep/mass, but only if mass>0
+        anew[self.mask]/=self.wsum[self.mask]
+        dt=(datetime.now()-t0).total_seconds()
+        logger.debug(f"resampling using sparse overlaps took {dt:.3f} seconds")
+        return anew
+    def resample(self,dose):
+        """
+        Resample an ITK dose image, returns an ITK image with the geometry of the new grid.
+        """
+        newdose=itk.image_from_array(self.apply(itk.array_view_from_image(dose)))
+        newdose.SetOrigin(self.origin)
+        newdose.SetSpacing(self.spacing)
+        newdose.SetDirection(itk.matrix_from_array(self.direction))
+        return newdose
 
 
 def equal_geometry(img1,img2):
@@ -215,12 +297,90 @@ def _mwr_with_loops(dose,mass,newgrid):
     return newdose
     
 
+# Cache for the resampling operators of `mass_weighted_resampling`.
+# The key consists of the id of the mass image and the geometries of the mass image and of the new grid.
+# The operators include a view of the mass data, such that the id is not reused while it is in the cache.
+_operator_cache = dict()
+_operator_cache_size = 4
+
+def _geometry_key(img):
+    return tuple(img.GetOrigin())+tuple(img.GetSpacing())+tuple(img.GetLargestPossibleRegion().GetSize()) \
+           +tuple(np.array(itk.array_from_matrix(img.GetDirection()),dtype=float).flat)
+
+def _get_operator(mass,newgrid,cache_dir=None):
+    """
+    Returns a (possibly cached) `ResamplingOperator` for the mass image and the new grid.
+    Only if the operator is not in the in-memory cache, it is created (or read
+    from the on-disk cache in `cache_dir`, if given).
+
+    This is an auxiliary function for `mass_weighted_resampling`.
+    """
+    key = (id(mass),_geometry_key(mass),_geometry_key(newgrid))
+    if key in _operator_cache:
+        logger.debug("reusing resampling operator from cache")
+        return _operator_cache[key][1]
+    op = ResamplingOperator(mass,newgrid,cache_dir=cache_dir)
+    while len(_operator_cache) >= _operator_cache_size:
+        _operator_cache.pop(next(iter(_operator_cache)))
+    _operator_cache[key] = (mass,op)
+    return op
+
+def _sparse_contraction(a,entries,axis):
+    """
+    Contract the array `a` along `axis` with the sparse overlap matrix given by
+    `entries` (see `_overlap_entries`), in single precision. The length of the
+    output along `axis` is the number of intervals `nb` of the second range.
+
+    The overlap matrix is banded: each interval of B overlaps with at most K
+    consecutive intervals of A. The contraction is computed as a sum of K
+    terms, the k'th term takes the k'th overlapping interval of A for every
+    interval of B (with weight zero if there are less than k+1 overlaps).
+
+    This is an auxiliary function for `mass_weighted_resampling`.
+    """
+    ia,ib,w,nb = entries
+    shape = list(a.shape)
+    shape[axis] = nb
+    out = np.zeros(shape,dtype=np.float32)
+    if len(ia) == 0:
+        return out
+    # the entries are sorted by ib, so the overlaps for each interval of B are contiguous
+    starts = np.flatnonzero(np.concatenate(([True],ib[1:]!=ib[:-1])))
+    counts = np.diff(np.append(starts,len(ib)))
+    wshape = [1]*a.ndim
+    wshape[axis] = -1
+    tmp = np.empty(shape,dtype=np.float32)
+    for k in range(np.max(counts)):
+        idx = np.zeros(nb,dtype=int)
+        wk = np.zeros(nb,dtype=np.float32)
+        has_k = counts>k
+        idx[ib[starts[has_k]]] = ia[starts[has_k]+k]
+        wk[ib[starts[has_k]]] = w[starts[has_k]+k]
+        np.take(a,idx,axis=axis,out=tmp)
+        tmp *= wk.reshape(wshape)
+        out += tmp
+    return out
+
 def _overlaps(a0,da,na,b0,db,nb,label="",center=True):
     """
     This function returns an (na,nb) array with the length of the overlaps in
     two ranges of intervals. In other words, the value of the element (i,j)
     represents the length that the i'th interval of A overlaps with the j'th
-    interval of B.
+    interval of B. See `_overlap_entries` for the meaning of the arguments.
+
+    This is an auxiliary function for `_mwr_with_loops`.
+    """
+    ia,ib,w,nb = _overlap_entries(a0,da,na,b0,db,nb,label,center)
+    o=np.zeros((na,nb),dtype=float)
+    o[ia,ib]=w
+    return o
+
+def _overlap_entries(a0,da,na,b0,db,nb,label="",center=True):
+    """
+    This function returns the nonzero overlaps in two ranges of intervals, as
+    a tuple with three 1D arrays (ia,ib,w) and the number `nb` of intervals of B.
+    The k'th overlap is between the ia[k]'th interval of A and the ib[k]'th
+    interval of B and has length w[k]. The entries are sorted by ia and by ib.
 
     If center is True, then a0 and b0 are assumed to be the *centers* of the first
     interval of range A and B, respectively. 
@@ -245,10 +405,10 @@ def _overlaps(a0,da,na,b0,db,nb,label="",center=True):
         # In these calculations it's more convenient to work with the left edge.
         a0-=0.5*da
         b0-=0.5*db
-    o=np.zeros((na,nb),dtype=float)
+    ia_list,ib_list,w_list=[],[],[]
     if a0+na*da<b0 or b0+nb*db<a0:
         # no overlap at all
-        return o
+        return np.zeros(0,dtype=int),np.zeros(0,dtype=int),np.zeros(0,dtype=float),nb
     ia,a,ada=0,a0,a0+da
     ib,b,bdb=0,b0,b0+db
     while ia<na and ib<nb:
@@ -257,8 +417,9 @@ def _overlaps(a0,da,na,b0,db,nb,label="",center=True):
         elif bdb<a or np.isclose(bdb,a):
             ab=False
         else:
-            o[ia,ib]=min(ada,bdb)-max(a,b)
-            #logger.debug(f"o[{ia},{ib}]={o[ia,ib]:.2f}")
+            ia_list.append(ia)
+            ib_list.append(ib)
+            w_list.append(min(ada,bdb)-max(a,b))
             ab = (ada<bdb)
         if ab:
             ia+=1
@@ -268,7 +429,7 @@ def _overlaps(a0,da,na,b0,db,nb,label="",center=True):
             ib+=1
             b=bdb
             bdb=b0+(ib+1)*db
-    return o
+    return np.array(ia_list,dtype=int),np.array(ib_list,dtype=int),np.array(w_list,dtype=float),nb
 
 
 ################################################################################
@@ -276,6 +437,7 @@ def _overlaps(a0,da,na,b0,db,nb,label="",center=True):
 ################################################################################
 
 import unittest
+import tempfile
 try:
     from .logging_conf import LoggedTestCase
 except:
@@ -404,6 +566,70 @@ class dose_resampling_tests(LoggedTestCase):
         ar0=itk.array_from_image(resampled_loops)
         ar1=itk.array_from_image(resampled)
         self.assertTrue(np.allclose(ar0,ar1))
+    def test_operator_cache(self):
+        # nonuniform mass, two different doses with the same mass and new grid
+        amass = np.random.uniform(0.5,1.5,self.dims[::-1]).astype(np.float32)
+        mass = itk.image_from_array(amass)
+        mass.CopyInformation(self.dose)
+        _operator_cache.clear()
+        for i in range(2):
+            adose = np.random.normal(1.,0.05,self.dims[::-1]).astype(np.float32)
+            dose = itk.image_from_array(adose)
+            dose.CopyInformation(self.dose)
+            resampled_loops=_mwr_with_loops(dose,mass,self.newdose)
+            resampled=mass_weighted_resampling(dose,mass,self.newdose)
+            self.assertEqual(len(_operator_cache),1)
+            ar0=itk.array_from_image(resampled_loops)
+            ar1=itk.array_from_image(resampled)
+            self.assertTrue(np.allclose(ar0,ar1,rtol=1e-5))
+    def test_operator_disk_cache(self):
+        amass = np.random.uniform(0.5,1.5,self.dims[::-1]).astype(np.float32)
+        mass = itk.image_from_array(amass)
+        mass.CopyInformation(self.dose)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            op1 = ResamplingOperator(mass,self.newdose,cache_dir=tmpdir)
+            self.assertTrue(os.path.exists(op1.cache_file))
+            op2 = ResamplingOperator(mass,self.newdose,cache_dir=tmpdir)
+            self.assertEqual(op1.cache_file,op2.cache_file)
+            self.assertTrue(np.array_equal(op1.wsum,op2.wsum))
+            anew1 = op1.apply(self.adose)
+            anew2 = op2.apply(self.adose)
+            self.assertTrue(np.array_equal(anew1,anew2))
+            self.assertEqual(anew1.shape,self.anewdose.shape)
+            ar0 = itk.array_from_image(_mwr_with_loops(self.dose,mass,self.newdose))
+            self.assertTrue(np.allclose(ar0,anew1,rtol=1e-5))
+            # different mass data => different cache file
+            itk.array_view_from_image(mass)[0,0,0] += 1.
+            op3 = ResamplingOperator(mass,self.newdose,cache_dir=tmpdir)
+            self.assertNotEqual(op1.cache_file,op3.cache_file)
+            # the in-memory cache is checked before the mass is hashed for the disk cache
+            _operator_cache.clear()
+            op4 = _get_operator(mass,self.newdose,tmpdir)
+            self.assertIs(_get_operator(mass,self.newdose,tmpdir),op4)
+            self.assertEqual(op4.cache_file,op3.cache_file)
+    def test_direction(self):
+        newgrid = itk.image_from_array(self.anewdose)
+        newgrid.CopyInformation(self.newdose)
+        direction = np.diag([1.,-1.,-1.])
+        newgrid.SetDirection(itk.matrix_from_array(direction))
+        _operator_cache.clear()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for cache_dir in (None,tmpdir):
+                resampled = mass_weighted_resampling(self.dose,self.mass,newgrid,cache_dir=cache_dir)
+                self.assertTrue(np.array_equal(itk.array_from_matrix(resampled.GetDirection()),direction))
+        # the operator for the new grid with identity direction is a different one
+        resampled = mass_weighted_resampling(self.dose,self.mass,self.newdose)
+        self.assertTrue(np.array_equal(itk.array_from_matrix(resampled.GetDirection()),np.eye(3)))
+        self.assertEqual(len(_operator_cache),2)
+    def test_sparse_overlaps(self):
+        for args in [(0,1,10,0.3,0.7,12),(-5.,0.5,20,-4.2,1.1,5),(0.,1.,3,10.,1.,3)]:
+            ia,ib,w,nb = _overlap_entries(*args,center=False)
+            o = _overlaps(*args,center=False)
+            self.assertEqual(np.sum(o>0),len(w))
+            self.assertTrue((np.diff(ia)>=0).all())
+            self.assertTrue((np.diff(ib)>=0).all())
+            a = np.random.uniform(0.,1.,(3,4,args[2]))
+            self.assertTrue(np.allclose(_sparse_contraction(a,(ia,ib,w,nb),2),np.tensordot(a,o,axes=(2,0)),rtol=1e-5))
     def test_single_voxel(self):
         # source grid is 2x2x2 voxels with spacing 1x1x1, centered on (0,0,0)
         # dest grid is 1x1x1 voxels with spacing 1x1x1, centered on (0,0,0)
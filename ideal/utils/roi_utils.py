@@ -18,14 +18,20 @@ import logging
 logger=logging.getLogger(__name__)
 
 #import SimpleITK as sitk
+import os
+import hashlib
 import itk
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 logging.disable(logging.INFO) # avoid matplotlib noise
 import matplotlib.path # for useful Path class, not for plotting...
 logging.disable(logging.NOTSET)
 #The shapely module is needed for intersecting ROIs with each other.
 #from shapely.geometry import Polygon
 
+# engine for binary masks: "scanline" (see `_scanline_inside`) or "path" (matplotlib.path.Path.contains_points)
+default_mask_engine = "scanline"
+
 # tolerances for dose histograms
 negative_tol = 1e-4
 nb_negative_tol = 5
@@ -239,6 +245,45 @@ class contour_layer(object):
             flatmask &= np.logical_not(p.contains_points(xycoords))
         return flatmask
 
+    def contains_grid_points(self,xpoints,ypoints):
+        """
+        Same as `contains_points` for all points on a grid given by the (increasing)
+        x and y coordinates, but much faster. Returns a boolean array indexed y,x.
+        """
+        mask = np.zeros((len(ypoints),len(xpoints)),dtype=bool)
+        for q in self.inclusion:
+            mask |= _scanline_inside(q.vertices,xpoints,ypoints)
+        for p in self.exclusion:
+            mask &= np.logical_not(_scanline_inside(p.vertices,xpoints,ypoints))
+        return mask
+
+    def get_coverage(self,orig,space,dims):
+        """
+        Compute for every voxel of a 2D image (given by the origin and spacing of
+        the center of the corner voxel and the number of voxels, in x and y) which
+        fraction of its area is inside this layer. Returns a float array, indexed y,x.
+
+        The fractions are computed exactly for each contour (see `_polygon_coverage`).
+        For overlapping inclusion contours the sum of the fractions is clipped to 1.
+        """
+        nx,ny = int(dims[0]),int(dims[1])
+        inc = np.zeros((ny,nx),dtype=float)
+        exc = np.zeros((ny,nx),dtype=float)
+        for paths,cov in ((self.inclusion,inc),(self.exclusion,exc)):
+            for q in paths:
+                # contour vertices in voxel units, with the voxel boundaries at integer values
+                uv = (q.vertices[:,:2]-np.array(orig,dtype=float)[:2])/np.array(space,dtype=float)[:2]+0.5
+                j0,i0 = np.maximum(np.floor(np.min(uv,axis=0)).astype(int),0)
+                j1,i1 = np.minimum(np.ceil(np.max(uv,axis=0)).astype(int),(nx,ny))
+                if j1<=j0 or i1<=i0:
+                    continue
+                cov[i0:i1,j0:j1] += _polygon_coverage(uv-(j0,i0),i1-i0,j1-j0)
+        cov = np.minimum(inc,1.)-np.minimum(exc,1.)
+        # rounding errors
+        cov[cov<1e-9] = 0.
+        cov[cov>1.-1e-9] = 1.
+        return cov
+
     def correct_mask(self,xymesh,mask, spacing):
         xx, yy = xymesh
         mask = np.reshape(mask, xx.shape)
@@ -327,6 +372,483 @@ class contour_layer(object):
             a += pa
         return a
 
+class roi_mask(object):
+    """
+    Mask of a ROI in an image with the given geometry (origin, spacing and size,
+    see `_img_geometry`). Only the sub-array `amask` (indexed z,y,x) of the
+    bounding box of the nonzero mask values is stored; `offset` is the (z,y,x)
+    index of its first voxel in the image. The mask values are voxel fractions
+    (float32) or 0/1 (uint8), see `region_of_interest.get_mask`.
+    """
+    def __init__(self,amask,offset,geometry):
+        self.amask = amask
+        self.offset = tuple([int(i) for i in offset])
+        self.origin,self.spacing,self.size = geometry
+    @property
+    def shape(self):
+        """
+        Shape (z,y,x) of the full mask array.
+        """
+        return tuple(self.size[::-1])
+    @property
+    def slices(self):
+        """
+        Index of the bounding box in a full image array (indexed z,y,x).
+        """
+        return tuple([slice(i,i+n) for i,n in zip(self.offset,self.amask.shape)])
+    @property
+    def binary(self):
+        """
+        Boolean array: True for the voxels in the bounding box with a nonzero mask value.
+        """
+        return self.amask>0
+    @property
+    def fraction(self):
+        """
+        Mask values in the bounding box as floats (without a copy, if they are floats already).
+        """
+        return self.amask.astype(np.float32,copy=False)
+    def cropped(self):
+        """
+        Return the same mask, restricted to the bounding box of its nonzero values.
+        """
+        nonzero = self.binary
+        lo,hi = [],[]
+        for axis in range(3):
+            iany = np.flatnonzero(np.any(nonzero,axis=tuple([a for a in range(3) if a != axis])))
+            lo.append(iany[0] if len(iany) else 0)
+            hi.append(iany[-1]+1 if len(iany) else 0)
+        if tuple(lo) == (0,0,0) and tuple(hi) == self.amask.shape:
+            return self
+        sub = tuple([slice(i0,i1) for i0,i1 in zip(lo,hi)])
+        offset = [i+i0 for i,i0 in zip(self.offset,lo)] if hi[0] > 0 else (0,0,0)
+        return roi_mask(np.ascontiguousarray(self.amask[sub]),offset,(self.origin,self.spacing,self.size))
+    def full_array(self):
+        """
+        The mask as an array (indexed z,y,x) with the size of the full image.
+        """
+        afull = np.zeros(self.shape,dtype=self.amask.dtype)
+        afull[self.slices] = self.amask
+        return afull
+    def to_full(self,img=None):
+        """
+        The mask as an ITK image with the size of the full image; the geometry is copied from `img`, if given.
+        """
+        roimask = itk.GetImageFromArray(self.full_array())
+        if img is None:
+            roimask.SetOrigin(self.origin)
+            roimask.SetSpacing(self.spacing)
+        else:
+            roimask.CopyInformation(img)
+        return roimask
+    def apply(self,adose):
+        """
+        Return the array `adose` (indexed z,y,x, with the full image size) multiplied with the mask, within the bounding box.
+        """
+        return adose[self.slices]*self.fraction
+    def values(self,adose):
+        """
+        Return the values of array `adose` (indexed z,y,x, with the full image size)
+        in the voxels with a nonzero mask value, and the mask values of those voxels.
+        """
+        nonzero = np.nonzero(self.amask)
+        return adose[self.slices][nonzero],self.amask[nonzero]
+    def sum(self):
+        """
+        Sum of the mask values, i.e. the number of voxels in the ROI.
+        """
+        return np.sum(self.amask,dtype=float)
+
+def _histogram_bins(a,dmin,dmax,nbins):
+    """
+    Bin index of each value in `a` for `nbins` equal bins between `dmin` and
+    `dmax`, with the same edge conventions as `np.histogram`. Values below
+    and above the range get index -1 and `nbins`, respectively.
+    """
+    edges = np.linspace(dmin,dmax,nbins+1)
+    if dmax <= dmin:
+        return np.where(a<dmin,-1,np.where(a>dmin,nbins,0)),edges
+    ibin = ((a-dmin)*(nbins/(dmax-dmin))).astype(np.intp)
+    outside = (a<dmin) | (a>dmax)
+    ibin[outside] = 0
+    ibin[ibin==nbins] -= 1
+    # correct the rounding errors at the bin edges (like np.histogram)
+    ibin[a<edges[ibin]] -= 1
+    ibin[(a>=edges[ibin+1]) & (ibin!=nbins-1)] += 1
+    ibin[a<dmin] = -1
+    ibin[a>dmax] = nbins
+    return ibin,edges
+
+class dvh_table(object):
+    """
+    Dose volume histograms of several ROIs for the same dose distribution, see
+    `get_dvhs`. For each ROI (in the same order as `names`) there is a row with
+    the cumulative DVH (fraction of the ROI volume that receives at least the
+    dose of each bin edge, like `region_of_interest.get_dvh`), the volume (sum
+    of the mask values), the mean dose and the near maximum, median and near
+    minimum doses D02, D50 and D98. These are NaN for ROIs that do not overlap
+    with the dose distribution.
+    """
+    columns = ["volume [voxels]","mean dose","D02","D50","D98"]
+    def __init__(self,names,edges,dhist,dsum,dunder=None,dover=None):
+        self.names = list(names)
+        self.edges = edges
+        self.dhist = dhist
+        dunder = np.zeros(len(self.names)) if dunder is None else dunder
+        dover = np.zeros(len(self.names)) if dover is None else dover
+        self.volume = dunder+np.sum(dhist,axis=1)+dover
+        with np.errstate(invalid='ignore',divide='ignore'):
+            self.dmean = dsum/self.volume
+            # volume with a dose below the upper edge of each bin
+            adchist = dunder[:,np.newaxis]+np.cumsum(dhist,axis=1)
+            self.dvh = 1.0-adchist/self.volume[:,np.newaxis]
+        # the dose below which a given fraction of the volume receives its dose, interpolated in the bins
+        d98,d50,d02 = [np.full(len(self.names),np.nan) for i in range(3)]
+        for i in np.flatnonzero(self.volume>0):
+            cdf = np.concatenate([[dunder[i]],adchist[i]])
+            for dq,q in ((d98,0.02),(d50,0.50),(d02,0.98)):
+                dq[i] = np.interp(q*self.volume[i],cdf,edges)
+        self.d02,self.d50,self.d98 = d02,d50,d98
+    def rows(self):
+        """
+        The summary table: a list with a dictionary for each ROI.
+        """
+        return [dict(zip(["roi"]+self.columns,[name,v,dm,d02,d50,d98]))
+                for name,v,dm,d02,d50,d98 in zip(self.names,self.volume,self.dmean,self.d02,self.d50,self.d98)]
+    def as_dict(self,label):
+        """
+        The D02, D50 and D98 values of all ROIs as strings, with keys that start with `label`
+        (e.g. for the user logs/settings file).
+        """
+        return dict([("{} {} {}".format(label,row["roi"],col),"{:.6g}".format(row[col]))
+                     for row in self.rows() for col in ("D02","D50","D98")])
+    def write(self,path):
+        """
+        Write the summary table and the cumulative DVHs to a tab separated text file.
+        """
+        with open(path,"w") as fp:
+            fp.write("\t".join(["roi"]+self.columns)+"\n")
+            for row in self.rows():
+                fp.write("\t".join([row["roi"]]+["{:.6g}".format(row[col]) for col in self.columns])+"\n")
+            fp.write("\n")
+            fp.write("\t".join(["dose"]+self.names)+"\n")
+            for j,d in enumerate(self.edges[1:]):
+                fp.write("\t".join(["{:.6g}".format(d)]+["{:.6g}".format(v) for v in self.dvh[:,j]])+"\n")
+
+def get_dvhs(img,roimasks,names=None,nbins=100,dmin=None,dmax=None):
+    """
+    Compute the DVHs of several ROIs for dose image `img` in one pass, see
+    `dvh_table`. The masks are `roi_mask` objects for the geometry of `img`
+    (e.g. from `region_of_interest.get_masks` with `compact=True`); None is
+    treated as an empty mask. The dose is quantized only once (in the union
+    of the bounding boxes of the masks), the dose bins of all ROIs are
+    stored with one label per ROI and bin, and all histograms are obtained
+    with one `np.bincount`. Negative doses are counted as zero dose. By
+    default the histogram range is the dose range of the whole image.
+    """
+    if names is None:
+        names = ["roi{}".format(i) for i in range(len(roimasks))]
+    assert(len(names)==len(roimasks))
+    adose = np.asarray(itk.GetArrayViewFromImage(img))
+    if dmin is None:
+        dmin=max(float(np.min(adose)),0.)
+    if dmax is None:
+        dmax=float(np.max(adose))
+    roimasks = [m for m in roimasks]
+    nonempty = [m for m in roimasks if m is not None and m.amask.size>0]
+    nroi = len(roimasks)
+    if not nonempty:
+        return dvh_table(names,np.linspace(dmin,dmax,nbins+1),np.zeros((nroi,nbins)),np.zeros(nroi))
+    for m in nonempty:
+        if m.shape != adose.shape:
+            raise ValueError("mask shape {} differs from dose shape {}".format(m.shape,adose.shape))
+    # union of the bounding boxes
+    lo = np.min([m.offset for m in nonempty],axis=0)
+    hi = np.max([np.array(m.offset)+m.amask.shape for m in nonempty],axis=0)
+    union = tuple([slice(i0,i1) for i0,i1 in zip(lo,hi)])
+    adose_union = np.maximum(adose[union],0.)
+    ibin,edges = _histogram_bins(adose_union,dmin,dmax,nbins)
+    # label = ROI index * (nbins+2) + bin index + 1; the first and last label of each ROI are for doses outside the range
+    nlabel = nbins+2
+    labels,weights,dweights = [],[],[]
+    for iroi,m in enumerate(roimasks):
+        if m is None or m.amask.size == 0:
+            continue
+        sub = tuple([slice(i0-j0,i0-j0+n) for i0,j0,n in zip(m.offset,lo,m.amask.shape)])
+        nonzero = np.nonzero(m.amask)
+        labels.append(ibin[sub][nonzero]+(iroi*nlabel+1))
+        w = m.amask[nonzero].astype(float)
+        weights.append(w)
+        dweights.append(w*adose_union[sub][nonzero])
+    labels = np.concatenate(labels)
+    dhist = np.bincount(labels,weights=np.concatenate(weights),minlength=nroi*nlabel).reshape(nroi,nlabel)
+    dsum = np.bincount(labels//nlabel,weights=np.concatenate(dweights),minlength=nroi)
+    logger.debug("computed {} DVHs with {} bins for {} mask voxels".format(nroi,nbins,len(labels)))
+    return dvh_table(names,edges,dhist[:,1:-1],dsum,dhist[:,0],dhist[:,-1])
+
+class roi_mask_cache(object):
+    """
+    On-disk cache of ROI masks, shared between processes (e.g. subsequent
+    preprocessing runs for the same plan). Each mask is saved as a compressed
+    npz file in `cache_dir`, the file name is a hash of the structure set UID,
+    the ROI number, the image geometry, the z range and the corrected flag.
+    When the total size of the cache exceeds `max_megabytes`, the least
+    recently used masks are removed.
+    """
+    # increase this number when the mask computation or the file format changes
+    version = 2
+    def __init__(self,cache_dir,max_megabytes=1000.):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_megabytes*1024**2)
+        os.makedirs(cache_dir,exist_ok=True)
+    @staticmethod
+    def key(ss_uid,roinr,mask_key):
+        return hashlib.sha1(repr((roi_mask_cache.version,str(ss_uid),str(roinr),mask_key)).encode()).hexdigest()
+    def path(self,key):
+        return os.path.join(self.cache_dir,"roimask_{}.npz".format(key))
+    def get(self,key):
+        """
+        Return the cached mask array for `key` and its offset (see `roi_mask`), None if it is not in the cache.
+        """
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                amask = data['mask']
+                offset = tuple([int(i) for i in data['offset']])
+            # the modification time is used for the LRU bookkeeping
+            os.utime(path)
+            return amask,offset
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warn("failed to read cached mask {}, removing it: {}".format(path,e))
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+    def put(self,key,amask,offset=(0,0,0)):
+        """
+        Save mask array `amask` and its offset for `key` (atomically), then evict old masks if necessary.
+        """
+        path = self.path(key)
+        tmpfile = "{}.{}.tmp".format(path,os.getpid())
+        try:
+            with open(tmpfile,"wb") as fp:
+                np.savez_compressed(fp,mask=amask,offset=np.array(offset,dtype=int))
+            os.replace(tmpfile,path)
+        except OSError as e:
+            logger.warn("failed to save mask {} in the cache: {}".format(path,e))
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            return
+        self.evict()
+    def evict(self):
+        """
+        Remove the least recently used masks until the total size of the cache is below the maximum.
+        """
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if not (fname.startswith("roimask_") and fname.endswith(".npz")):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir,fname))
+            except FileNotFoundError:
+                # removed by another process
+                continue
+            entries.append((st.st_mtime_ns,st.st_size,fname))
+        total = sum([size for mtime,size,fname in entries])
+        for mtime,size,fname in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            logger.debug("removing mask {} from the cache".format(fname))
+            try:
+                os.remove(os.path.join(self.cache_dir,fname))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+def use_mask_cache(cache_dir,max_megabytes=1000.):
+    """
+    Use an on-disk cache (see `roi_mask_cache`) for all ROI masks computed in
+    this process. An empty `cache_dir` or a zero size disables the cache.
+    """
+    if cache_dir and max_megabytes > 0:
+        region_of_interest.mask_cache = roi_mask_cache(cache_dir,max_megabytes)
+        logger.debug("using ROI mask cache in {} with max size {} MB".format(cache_dir,max_megabytes))
+    else:
+        region_of_interest.mask_cache = None
+
+def _img_geometry(img):
+    """
+    Origin, spacing and size of ITK image `img`, as tuples of Python numbers.
+    """
+    return (tuple([float(v) for v in img.GetOrigin()]),
+            tuple([float(v) for v in img.GetSpacing()]),
+            tuple([int(v) for v in img.GetLargestPossibleRegion().GetSize()]))
+
+def _sub_geometry(geometry,offset,shape):
+    """
+    Origin (x,y) and dims (x,y) of the part of an image with `geometry` that
+    starts at (z,y,x) index `offset` and has array shape `shape`.
+    """
+    orig,space,dims = geometry
+    return (orig[0]+offset[2]*space[0],orig[1]+offset[1]*space[1]),(shape[2],shape[1])
+
+def _mask_key(orig,space,dims,zrange,corrected):
+    """
+    Hashable identification of a mask: the image geometry (rounded, to ignore
+    rounding errors), the z range and the corrected flag.
+    """
+    rounded = lambda v: tuple(np.round(np.array(v,dtype=float),6).tolist())
+    return (rounded(orig),rounded(space),tuple(np.array(dims,dtype=int).tolist()),
+            None if zrange is None else rounded(zrange),bool(corrected))
+
+def _check_engine(engine):
+    if engine is None:
+        engine = default_mask_engine
+    if engine not in ("scanline","path"):
+        raise ValueError("unknown mask engine '{}'".format(engine))
+    return engine
+
+def _layer_mask(layer,orig,space,dims,corrected,engine):
+    """
+    Compute one slice (indexed y,x) of a ROI mask, see `region_of_interest.get_mask`.
+    """
+    # xpoints and ypoints contain the x/y coordinates of the voxel centers
+    xpoints=np.linspace(orig[0],orig[0]+space[0]*dims[0],dims[0],False)
+    ypoints=np.linspace(orig[1],orig[1]+space[1]*dims[1],dims[1],False)
+    if corrected:
+        # fraction of each voxel (in the xy plane) that is inside the contours
+        amask = layer.get_coverage(orig,space,dims)
+        logger.debug("got {} voxels (partially) inside".format(np.sum(amask>0)))
+    elif engine == "scanline":
+        amask = layer.contains_grid_points(xpoints,ypoints)
+        logger.debug("got {} points inside".format(np.sum(amask)))
+    else:
+        xymesh = np.meshgrid(xpoints,ypoints)
+        xyflat = np.stack([xymesh[0].ravel(),xymesh[1].ravel()],axis=1)
+        flatmask = layer.contains_points(xyflat)
+        logger.debug("got {} points inside".format(np.sum(flatmask)))
+        amask = flatmask.astype(int).reshape(dims[1],dims[0])
+    return amask
+
+def _layer_masks(items,space,corrected,engine):
+    """
+    Compute the mask slices for a list of (contour layer, origin, dims) tuples
+    (for the process pool in `region_of_interest.get_masks`).
+    """
+    return [_layer_mask(layer,orig,space,dims,corrected,engine) for layer,orig,dims in items]
+
+def _scanline_inside(vertices,xpoints,ypoints):
+    """
+    Compute which points of a grid with increasing coordinates `xpoints` and
+    `ypoints` are inside the polygon with the given vertices, with the even-odd
+    rule (the polygon is closed implicitly). The crossing test is the same as
+    the one in `matplotlib.path.Path.contains_points`, evaluated with the same
+    floating point expressions, so the result is identical, also for points
+    on the boundary. Returns a boolean array indexed y,x.
+
+    Each edge that crosses a row of points toggles the inside/outside state of
+    all points to the left of the crossing; the toggles are summed per row.
+    Only the rows and columns in the bounding box of the polygon are touched.
+    """
+    xpoints = np.asarray(xpoints,dtype=float)
+    ypoints = np.asarray(ypoints,dtype=float)
+    inside = np.zeros((len(ypoints),len(xpoints)),dtype=bool)
+    v0 = np.asarray(vertices,dtype=float)[:,:2]
+    v1 = np.roll(v0,-1,axis=0)
+    x0,y0,x1,y1 = v0[:,0],v0[:,1],v1[:,0],v1[:,1]
+    # rows: the edge crosses a row at y=ty if (y0>=ty) != (y1>=ty)
+    ylo = np.searchsorted(ypoints,np.minimum(y0,y1),side='right')
+    yhi = np.searchsorted(ypoints,np.maximum(y0,y1),side='right')
+    i0,i1 = np.min(ylo),np.max(yhi)
+    # columns: to the left of the polygon the number of crossings is even
+    j0 = max(np.searchsorted(xpoints,np.min(v0[:,0]),side='left')-1,0)
+    j1 = min(np.searchsorted(xpoints,np.max(v0[:,0]),side='right')+1,len(xpoints))
+    if i1<=i0 or j1<=j0:
+        return inside
+    nrow,ncol = i1-i0,j1-j0
+    cnt = yhi-ylo
+    e = np.repeat(np.arange(len(v0)),cnt)
+    row = ylo[e] + np.arange(len(e)) - np.repeat(np.cumsum(cnt)-cnt,cnt)
+    x0,y0,x1,y1,ty = x0[e],y0[e],x1[e],y1[e],ypoints[row]
+    yflag1 = y1>=ty
+    xs = xpoints[j0:j1]
+    def left_of_crossing(k):
+        # the matplotlib crossing test for the point with column index k (relative to j0)
+        tx = xs[k]
+        return ((y1-ty)*(x0-x1) >= (x1-tx)*(y0-y1)) == yflag1
+    # number of points left of the crossing: first estimate, then make exact
+    xc = x1+(y1-ty)*(x0-x1)/(y1-y0)
+    k = np.searchsorted(xs,xc)
+    while True:
+        dec = (k>0) & ~left_of_crossing(np.maximum(k-1,0))
+        inc = (k<ncol) & left_of_crossing(np.minimum(k,ncol-1))
+        if not (dec.any() or inc.any()):
+            break
+        k = k-dec+inc
+    toggles = np.bincount((row-i0)*(ncol+1),minlength=nrow*(ncol+1)) + \
+              np.bincount((row-i0)*(ncol+1)+k,minlength=nrow*(ncol+1))
+    inside[i0:i1,j0:j1] = (np.cumsum(toggles.reshape(nrow,ncol+1),axis=1)[:,:ncol] % 2).astype(bool)
+    return inside
+
+def _polygon_coverage(uv,ny,nx):
+    """
+    Compute for each pixel of a grid with `ny` rows and `nx` columns of unit
+    pixels (pixel i,j covers the square [j,j+1] x [i,i+1]) the fraction of its
+    area that is covered by the polygon with vertices `uv` (array with shape
+    N,2; the polygon is closed implicitly). The result does not depend on the
+    orientation of the polygon. Parts of the polygon outside of the grid are
+    allowed.
+
+    The edges are split into pieces at the grid lines, such that each piece
+    lies within a single pixel. The area below the polygon boundary in a pixel
+    column is then the signed sum of the trapezoids below the pieces in the
+    pixel itself plus the full pixel heights for pieces in the pixels above it.
+    """
+    n = len(uv)
+    p0 = np.array(uv,dtype=float)
+    d = np.roll(p0,-1,axis=0)-p0
+    eids = [np.arange(n),np.arange(n)]
+    ts = [np.zeros(n),np.ones(n)]
+    for axis in (0,1):
+        # crossings with the grid lines, excluding the edge end points
+        a0 = p0[:,axis]
+        a1 = a0+d[:,axis]
+        lo = np.floor(np.minimum(a0,a1))+1
+        cnt = np.maximum(np.ceil(np.maximum(a0,a1))-lo,0).astype(int)
+        eid = np.repeat(np.arange(n),cnt)
+        k = lo[eid] + np.arange(len(eid)) - np.repeat(np.cumsum(cnt)-cnt,cnt)
+        eids.append(eid)
+        ts.append((k-a0[eid])/d[eid,axis])
+    eid = np.concatenate(eids)
+    t = np.concatenate(ts)
+    order = np.lexsort((t,eid))
+    eid,t = eid[order],t[order]
+    same = eid[1:]==eid[:-1]
+    e = eid[:-1][same]
+    pa = p0[e]+t[:-1][same,None]*d[e]
+    pb = p0[e]+t[1:][same,None]*d[e]
+    du = pb[:,0]-pa[:,0]
+    umid = 0.5*(pa[:,0]+pb[:,0])
+    vmid = 0.5*(pa[:,1]+pb[:,1])
+    j = np.floor(umid).astype(int)
+    i = np.floor(vmid).astype(int)
+    keep = (du!=0)&(j>=0)&(j<nx)&(i>=0)
+    du,vmid,i,j = du[keep],vmid[keep],i[keep],j[keep]
+    # pieces above the grid only contribute full pixel heights, collect them in an extra row
+    above = i>=ny
+    i[above] = ny
+    iflat = i*nx+j
+    area = np.bincount(iflat,weights=np.where(above,0.,-du*(vmid-i)),minlength=(ny+1)*nx).reshape(ny+1,nx)
+    height = np.bincount(iflat,weights=-du,minlength=(ny+1)*nx).reshape(ny+1,nx)
+    coverage = area[:ny] + np.cumsum(height[::-1],axis=0)[::-1][1:]
+    if np.sum(p0[:,0]*np.roll(p0[:,1],-1)-np.roll(p0[:,0],-1)*p0[:,1]) < 0:
+        # clockwise
+        coverage = -coverage
+    return coverage
+
 def check_roi(ds,roi_id):
     # Beware: the three sequences for structureset (name,nr), observation (type), contoursets (actual contours) are NOT necessarily synchronous.
     # So you can NOT zip these sequences. The exceptions would bite you badly.
@@ -343,30 +865,109 @@ def check_roi(ds,roi_id):
     logger.error("ROI with id {} not found; structure set contains: ".format(roi_id) + ", ".join(list_roinames(ds)))
     raise ValueError("ROI with id {} not found".format(roi_id))
 
+def contour_points(contour):
+    """
+    Return the points of a contour (an item of the ContourSequence of a ROI) as
+    an N x 3 array. If pydicom has not yet converted the ContourData element,
+    then the raw value (a backslash separated string of decimal numbers) is
+    converted to floats in bulk, which is much faster than the conversion to
+    a pydicom MultiValue of DSfloat objects.
+    """
+    elem = contour.get_item(0x30060050) # ContourData
+    if elem is None:
+        raise ValueError("contour has no ContourData")
+    value = elem.value
+    if isinstance(value,(bytes,bytearray)):
+        points = np.array(value.decode("ascii").split("\\"),dtype=float)
+    else:
+        points = np.array(value,dtype=float)
+    return points.reshape(-1,3)
+
+class roi_registry(object):
+    """
+    Index of the ROIs in a DICOM structure set `ds`: the numbers, names and
+    types of the ROIs that have contours and a type are read directly, the
+    contours are only decoded (as a `region_of_interest`) when a ROI is used
+    for the first time with `get`. The `region_of_interest` objects (and thus
+    their masks) are kept, so each ROI is decoded only once.
+    """
+    def __init__(self,ds):
+        self.ds = ds
+        self.roinumbers = list()
+        self.roinames = list()
+        self.roitypes = list()
+        self._rois = dict()
+        # Beware: the structure set, observation and contour sequences are not necessarily synchronous (see `check_roi`).
+        contournumbers = set([str(ci.ReferencedROINumber) for ci in getattr(ds,"ROIContourSequence",[])])
+        types = dict()
+        for obsi in getattr(ds,"RTROIObservationsSequence",[]):
+            roinumber = str(obsi.ReferencedROINumber)
+            if roinumber not in types and bool(getattr(obsi,"RTROIInterpretedType","")):
+                types[roinumber] = str(obsi.RTROIInterpretedType)
+        for i,ssroi in enumerate(getattr(ds,"StructureSetROISequence",[])):
+            try:
+                roinumber = str(ssroi.ROINumber) # NOTE: roi numbers are *strings*
+                roiname = str(ssroi.ROIName)
+            except Exception as e:
+                logger.error("something went wrong with {}th ROI in the structure set, skipping it: {}".format(i,e))
+                continue
+            if roinumber not in contournumbers:
+                logger.warn("ROI nr={} name={} does not have a contour, skipping it".format(roinumber,roiname))
+            elif roinumber not in types:
+                logger.warn("ROI nr={} name={} does not have a type, skipping it".format(roinumber,roiname))
+            else:
+                self.roinumbers.append(roinumber)
+                self.roinames.append(roiname)
+                self.roitypes.append(types[roinumber])
+        logger.debug("structure set has {} ROIs with contours and type".format(len(self.roinames)))
+    def __len__(self):
+        return len(self.roinames)
+    def __contains__(self,roi_id):
+        return str(roi_id) in self.roinames or str(roi_id) in self.roinumbers
+    def get(self,roi_id):
+        """
+        Return the `region_of_interest` with the given name or number; the contours are decoded on first access.
+        """
+        roi_id = str(roi_id)
+        if roi_id in self.roinames:
+            roinumber = self.roinumbers[self.roinames.index(roi_id)]
+        elif roi_id in self.roinumbers:
+            roinumber = roi_id
+        else:
+            raise ValueError("ROI with id {} not found".format(roi_id))
+        if roinumber not in self._rois:
+            logger.debug("decoding contours of ROI nr={}".format(roinumber))
+            self._rois[roinumber] = region_of_interest(ds=self.ds,roi_id=roinumber)
+        return self._rois[roinumber]
+
 class region_of_interest(object):
+    # on-disk cache for the masks of all ROIs, see `use_mask_cache`
+    mask_cache = None
     def __init__(self,ds=None,roi_id=None,verbose=False, contours_list = None):
         if contours_list is not None:
             self.from_contours(contours_list)
             return
         #assert(len(ds.ROIContourSequence)==len(ds.StructureSetROISequence))
         roi,self.roinr,self.roiname = check_roi(ds,roi_id)
+        # the structure set UID identifies the masks of this ROI in the mask cache
+        self.ss_uid = str(getattr(ds,"SOPInstanceUID","")) or None
         self.ncontours = len(roi.ContourSequence)
-        self.npoints_total = sum([len(c.ContourData) for c in roi.ContourSequence])
+        self.npoints_total = 0
         self.bb = bounding_box()
         # we are sort the contours by depth-coordinate
         self.contour_layers=[]
         self.zlist = []
         self.dz = 0.
         self.z_precision = 3
-        self.maskparameters = []
-        self.masklist = []
+        self.masks = dict()
         #self.contour_refs=[]
         for contour in roi.ContourSequence:
             ref = contour.ContourImageSequence[0].ReferencedSOPInstanceUID
             npoints = int(contour.NumberOfContourPoints)
+            points = contour_points(contour)
             # check assumption on number of contour coordinates
-            assert(len(contour.ContourData)==3*npoints)
-            points = np.array([float(coord) for coord in contour.ContourData]).reshape(npoints,3)
+            assert(len(points)==npoints)
+            self.npoints_total += 3*npoints
             zvalues = set(points[:,2])
             # check assumption that all points are in the same xy plane (constant z)
             assert(len(zvalues)==1)
@@ -394,23 +995,25 @@ class region_of_interest(object):
                 logger.warn("{} not one single z step: {}".format(self.roiname,", ".join([str(d) for d in dz])))
                 self.dz = 0.
 
-    def get_mask_from_parameters(self, img_params):           
-        if(img_params in self.maskparameters):
-            return self.masklist[self.maskparameters.index(img_params)]
-        else:
-            return None
+    def get_mask_from_parameters(self, img_params, corrected=True):
+        """
+        Return the mask that was computed earlier for the given image parameters
+        (origin, spacing, size and z range), None if there is no such mask.
+        """
+        return self.masks.get(_mask_key(*img_params,corrected))
 
     def from_contours(self, contours_list):
         self.roiname = "Arficial roi created from scratch"
         self.roinr = 1337
+        self.z_precision = 3
         self.ncontours = len(contours_list)
         self.npoints_total = 0
         self.bb = bounding_box()
         self.contour_layers=[]
         self.zlist=[]
         self.dz=0.
-        self.maskparameters = []
-        self.masklist = []
+        self.masks = dict()
+        self.ss_uid = None
         for contour_layer in contours_list:
             z = round(contour_layer.z, self.z_precision)
             self.zlist.append(z)
@@ -447,11 +1050,97 @@ class region_of_interest(object):
             vol += cvol
             logger.debug("{}. got volume = dz * area = {} * {} = {}, sum={}".format(i,self.dz,area,cvol,vol))
         return vol
-    def get_mask(self,img,zrange=None, corrected=True):
+    def get_mask(self,img,zrange=None, corrected=True, engine=None, cache=True):
         """
         For a given image, compute for every voxel whether it is inside the ROI or not.
         The `zrange` can be used to limit the z-range of the ROI.
         If specified, the `zrange` should be contained in the z-range of the given image.
+        With `corrected=True` the mask values are the fractions of the voxel areas (in
+        the xy plane) that are inside the contours, see `contour_layer.get_coverage`;
+        otherwise the mask is 1 for voxels with their center inside the contours, 0 elsewhere.
+        The `engine` for the binary mask is "scanline" or "path" (the default is given
+        by `default_mask_engine`); both give the same mask, "scanline" is much faster.
+        With `cache=False` the mask is not looked up or kept in memory and in the mask
+        cache, e.g. for a grid that is used only once.
+        Returns an ITK image with the same geometry as `img`; use `get_roi_mask` to get
+        the compact `roi_mask` instead.
+        """
+        roimask = self.get_roi_mask(img,zrange,corrected,engine,cache)
+        if roimask is None:
+            return None
+        return roimask.to_full(img)
+    def get_roi_mask(self,img,zrange=None, corrected=True, engine=None, cache=True):
+        """
+        Same as `get_mask`, but returns the mask as a `roi_mask`, which only stores
+        the bounding box of the nonzero mask values. Masks are kept in memory (and
+        in the mask cache, if enabled) in this compact form.
+        """
+        engine = _check_engine(engine)
+        geometry = _img_geometry(img)
+        key = _mask_key(*geometry,zrange,corrected)
+        roimask = self._cached_mask(key) if cache else None
+        if roimask is not None:
+            return roimask
+        plan = self._mask_plan(img,zrange,corrected)
+        if plan is None:
+            return None
+        aroimask,offset,slices = plan
+        sub_orig,sub_dims = _sub_geometry(geometry,offset,aroimask.shape)
+        for iz,icz in slices:
+            aroimask[iz,:,:] = _layer_mask(self.contour_layers[icz],sub_orig,geometry[1],sub_dims,corrected,engine)
+        return self._store_mask(roi_mask(aroimask,offset,geometry),key,cache)
+    @staticmethod
+    def get_masks(roilist,img,zrange=None,corrected=True,engine=None,nworkers=1,compact=False,cache=True):
+        """
+        Compute the masks (see `get_mask`) of several ROIs for the same image. The
+        slices of all ROIs are independent; with `nworkers>1` they are computed in
+        parallel by a pool of `nworkers` processes. By default everything is computed
+        in the current process: starting the pool and sending the contours to the
+        workers only pays off for many ROIs and/or large images. Returns a list of
+        masks, in the same order as the ROIs: ITK images, or `roi_mask` objects if
+        `compact` is True. With `cache=False` the masks are not kept, see `get_mask`.
+        """
+        engine = _check_engine(engine)
+        geometry = _img_geometry(img)
+        key = _mask_key(*geometry,zrange,corrected)
+        # masks that were computed before (in memory or in the mask cache) are not recomputed
+        masks = [roi._cached_mask(key) if cache else None for roi in roilist]
+        plans = dict([(iroi,roilist[iroi]._mask_plan(img,zrange,corrected)) for iroi,mask in enumerate(masks) if mask is None])
+        tasks = []
+        for iroi,plan in plans.items():
+            if plan is None:
+                continue
+            aroimask,offset,slices = plan
+            sub_orig,sub_dims = _sub_geometry(geometry,offset,aroimask.shape)
+            tasks += [(iroi,iz,(roilist[iroi].contour_layers[icz],sub_orig,sub_dims)) for iz,icz in slices]
+        nworkers = max(1,min(nworkers,len(tasks)))
+        logger.debug("going to compute {} mask slices for {} ROIs with {} worker(s)".format(len(tasks),len(roilist),nworkers))
+        if nworkers == 1:
+            slices = _layer_masks([item for iroi,iz,item in tasks],geometry[1],corrected,engine)
+        else:
+            # a few chunks per worker, for load balancing
+            nchunk = min(len(tasks),4*nworkers)
+            chunks = [tasks[k::nchunk] for k in range(nchunk)]
+            with ProcessPoolExecutor(max_workers=nworkers) as pool:
+                futures = [pool.submit(_layer_masks,[item for iroi,iz,item in chunk],geometry[1],corrected,engine) for chunk in chunks]
+                results = [f.result() for f in futures]
+            tasks = [task for chunk in chunks for task in chunk]
+            slices = [a for result in results for a in result]
+        for (iroi,iz,item),aslice in zip(tasks,slices):
+            plans[iroi][0][iz,:,:] = aslice
+        for iroi,plan in plans.items():
+            if plan is not None:
+                masks[iroi] = roilist[iroi]._store_mask(roi_mask(plan[0],plan[1],geometry),key,cache)
+        if compact:
+            return masks
+        return [None if mask is None else mask.to_full(img) for mask in masks]
+    def _mask_plan(self,img,zrange=None,corrected=True):
+        """
+        Prepare the computation of a mask for `get_roi_mask` and `get_masks`.
+        Returns None if no mask can be computed, otherwise the (empty) mask array
+        for the part of the image that contains the ROI, the (z,y,x) index of its
+        first voxel in the image, and the list of pairs of mask slice index and
+        contour layer index (the list is empty if the ROI and the image do not overlap).
         """
         if not self.have_mask():
             logger.warn("Irregular z-values, masking not yet supported")
@@ -463,18 +1152,12 @@ class region_of_interest(object):
         #logger.debug("create roi mask image object with dims={}".format(dims))
         if corrected:
             logger.debug("{} going to get mask with 'corrected' float weights".format(self.roiname))
-            aroimask = np.zeros(dims[::-1],dtype=np.float32)
+            dtype = np.float32
         else:
             logger.debug("{} going to get mask with 'uncorrected' binary weights".format(self.roiname))
-            aroimask = np.zeros(dims[::-1],dtype=np.uint8)
-        roimask = itk.GetImageFromArray(aroimask)
-        roimask.CopyInformation(img)
-        orig = roimask.GetOrigin()
-        space = roimask.GetSpacing()
-        roisize=np.array(roimask.GetLargestPossibleRegion().GetSize())
-        if (roisize!=dims).any():
-            logger.error("roimask size {} differs from img size {}".format(roisize,dims))
-            raise RuntimeError("array size error!")
+            dtype = np.uint8
+        orig = img.GetOrigin()
+        space = img.GetSpacing()
         #############################################################################################
         # check that the bounding box of this ROI is contained within the volume of the given image #
         #############################################################################################
@@ -486,18 +1169,16 @@ class region_of_interest(object):
             logger.warn('DUIZEND BOMMEN EN GRANATEN orig={} space={} dims={} bbroi={}'.format(orig,space,dims,self.bb))
         else:
             logger.debug('YAY: roi "{}" is contained in image'.format(self.roiname))
-        #logger.debug("copied infor orig={} spacing={}".format(orig,space))
         # ITK: the "origin" has the coordinates of the *center* of the corner voxel
         # zmin and zmax are the z coordinates of the boundary of the volume
         zmin = orig[2] - 0.5*space[2]
         zmax = orig[2] + (dims[2]-0.5)*space[2]
         eps=0.001*np.abs(self.dz)
-        #logger.debug("got point mesh")
+        no_overlap = (np.zeros((0,0,0),dtype=dtype),(0,0,0),[])
         if zmin-eps>self.bb.zmax+self.dz or zmax+eps<self.bb.zmin-self.dz:
             logger.warn("WARNING: no overlap in z ranges")
             logger.warn("WARNING: img z range [{}-{}], roi z range [{}-{}]".format(zmin,zmax,self.bb.zmin,self.bb.zmax))
-            return roimask
-        img_params = [orig, space, dims, zrange]
+            return no_overlap
         if zrange is None:
             zrange=(zmin,zmax)
         else:
@@ -506,18 +1187,9 @@ class region_of_interest(object):
             assert(zrange[1]<=zmax)
             if zrange[0]-eps>self.bb.zmax+self.dz or zrange[1]+eps<self.bb.zmin-self.dz:
                 logger.warn("WARNING: no overlap in (restricted) z ranges")
-                return roimask
-        # logger.debug("zmin={} zmax={}".format(zmin,zmax))
-        # xpoints and ypoints contain the x/y coordinates of the voxel centers
-        xpoints=np.linspace(orig[0],orig[0]+space[0]*dims[0],dims[0],False)
-        ypoints=np.linspace(orig[1],orig[1]+space[1]*dims[1],dims[1],False)
-        xymesh = np.meshgrid(xpoints,ypoints)
-        xyflat = np.array([(x,y) for x,y in zip(xymesh[0].flat,xymesh[1].flat)])
-        clayer0 = self.contour_layers[0]
-        #logger.debug contour0pts.shape
-        z0 = clayer0.z
-        #logger.debug("z0={}".format(z0))
-        #logger.debug("going to loop over z planes in image")
+                return no_overlap
+        z0 = self.contour_layers[0].z
+        slices = []
         for iz in range(dims[2]):
             z = orig[2]+space[2]*iz # z coordinate in image/mask
             if z<zrange[0] or z>zrange[1]:
@@ -525,44 +1197,58 @@ class region_of_interest(object):
             icz = int(np.round((z-z0)/self.dz)) # layer index
             if icz>=0 and icz<len(self.contour_layers):
                 logger.debug("INSIDE roi: z index mask/image iz={} (z={}) layer index icz={} (z={})".format(iz,z,icz,self.contour_layers[icz].z))
-                flatmask = self.contour_layers[icz].contains_points(xyflat)
-                logger.debug("got {} points inside".format(np.sum(flatmask)))
-                if corrected:
-                    flatmask = flatmask.astype(float)
-                    flatmask = self.contour_layers[icz].correct_mask(xymesh, flatmask, space)
-                    for iflat,b in enumerate(flatmask):
-                        if not b:
-                            continue
-                        ix = iflat % dims[0]
-                        iy = iflat // dims[0]
-                        #x = orig[0]+space[0]*ix # x coordinate in image/mask
-                        #y = orig[1]+space[1]*iy # y coordinate in image/mask
-                        #assert(self.contour_layers[icz].contains_point(point=(x,y)))
-                        try:
-                            roimask[ix,iy,iz]=b
-                        except IndexError as inderr:
-                            logger.error("iflat={} ix={} iy={} iz={}, error={}".format(iflat,ix,iy,iz,inderr))
-                            raise
-                else:
-                    flatmask = flatmask.astype(int)
-                    aroimask[iz,:,:] = flatmask.reshape(dims[1],dims[0])[:,:]
+                slices.append((iz,icz))
             elif icz<0:
                 logger.debug("BELOWroi: z index mask/image iz={} (z={}) layer index icz={} (z0={} dz={})".format(iz,z,icz,z0,self.dz))
             else:
                 logger.debug("ABOVE roi: z index mask/image iz={} (z={}) layer index icz={} (z0={} dz={} nlayer={})".format(iz,z,icz,z0,self.dz,len(self.contour_layers)))
-        logger.debug("got mask with {} enabled voxels out of {}".format(np.sum(aroimask>0),np.prod(aroimask.shape)))
-        if not corrected:
-            roimask = itk.GetImageFromArray(aroimask)
-            roimask.CopyInformation(img)
-            #achk = sitk.GetArrayFromImage(roimask)
-            #ndiff = np.sum(achk!=aroimask)
-            #nsame = np.sum(achk==aroimask)
-            #nboth = np.sum((achk>0)*(aroimask>0))
-            #nachk = np.sum(achk>0)
-            #naroi = np.sum(aroimask>0)
-            #logger.debug("N(chk)={} N(aroi)={} ndiff={} nsame={} nboth={}".format(nachk,naroi,ndiff,nsame,nboth))
-        self.maskparameters.append(img_params)
-        self.masklist.append(roimask)
+        # x and y index range of the voxels that (partially) overlap with the bounding box of the ROI, plus a safety margin
+        ixy = []
+        for o,s,d,rmin,rmax in list(zip(orig,space,dims,self.bb.mincorner,self.bb.maxcorner))[:2]:
+            imin = int(np.floor((rmin-o)/s+0.5))-1
+            imax = int(np.floor((rmax-o)/s+0.5))+2
+            ixy.append((min(max(imin,0),d),min(max(imax,0),d)))
+        (ix0,ix1),(iy0,iy1) = ixy
+        if not slices or ix0>=ix1 or iy0>=iy1:
+            logger.warn("WARNING: no overlap of the ROI {} with the image".format(self.roiname))
+            return no_overlap
+        iz0,iz1 = slices[0][0],slices[-1][0]+1
+        aroimask = np.zeros((iz1-iz0,iy1-iy0,ix1-ix0),dtype=dtype)
+        return aroimask,(iz0,iy0,ix0),[(iz-iz0,icz) for iz,icz in slices]
+    def _disk_key(self,key):
+        return roi_mask_cache.key(self.ss_uid,self.roinr,key)
+    def _cached_mask(self,key):
+        """
+        Return the mask for `key` from memory or from the on-disk mask cache, None if it is not available.
+        """
+        if key in self.masks:
+            logger.debug("using already computed mask for these dimensions")
+            return self.masks[key]
+        cache = region_of_interest.mask_cache
+        if cache is None or not self.ss_uid:
+            return None
+        cached = cache.get(self._disk_key(key))
+        if cached is None:
+            return None
+        aroimask,offset = cached
+        orig,space,dims = key[:3]
+        if np.any(np.array(offset)+aroimask.shape > dims[::-1]):
+            logger.warn("cached mask for {} does not fit in the image, ignoring it".format(self.roiname))
+            return None
+        logger.debug("got mask for {} from the mask cache".format(self.roiname))
+        roimask = roi_mask(aroimask,offset,(orig,space,dims))
+        self.masks[key] = roimask
+        return roimask
+    def _store_mask(self,roimask,key,cache=True):
+        roimask = roimask.cropped()
+        logger.debug("got mask with {} enabled voxels out of {}, {} in its bounding box".format(
+            np.sum(roimask.binary),np.prod(roimask.shape),roimask.amask.size))
+        if not cache:
+            return roimask
+        self.masks[key] = roimask
+        cache = region_of_interest.mask_cache
+        if cache is not None and self.ss_uid:
+            cache.put(self._disk_key(key),roimask.amask,roimask.offset)
         logger.debug("returning mask")
         return roimask
     def get_dvh(self,img,nbins=100,dmin=None,dmax=None,zrange=None,debuglabel=None):
@@ -572,23 +1258,17 @@ class region_of_interest(object):
             logger.error("ERROR only 3d images supported")
             return None
         logger.debug("got size = {}".format(dims.tolist()))
-        aimg = itk.GetArrayFromImage(img)
+        aimg = itk.GetArrayViewFromImage(img)
         logger.debug("got array with shape {}".format(list(aimg.shape)))
-        img_params = [img.GetOrigin(), img.GetSpacing(), np.array(img.GetLargestPossibleRegion().GetSize()), zrange]
-        itkmask = self.get_mask_from_parameters(img_params)
-        if(itkmask):
-            logger.debug("Using already computed mask for these dimensions")
-        else:
-            itkmask=self.get_mask(img,zrange)
-        logger.debug("got mask with size {}".format(itkmask.GetLargestPossibleRegion().GetSize()))
-        amask=(itk.GetArrayFromImage(itkmask))
+        roimask=self.get_roi_mask(img,zrange)
+        logger.debug("got mask with bounding box size {}".format(roimask.amask.shape))
 
         if dmin is None:
             dmin=np.min(aimg)
         if dmax is None:
             dmax=np.max(aimg)
         logger.debug("Specified dmin={} dmax={}".format(dmin,dmax))
-        a = aimg[np.nonzero(amask)]
+        a,w = roimask.values(aimg)
         logger.debug("Dose dmin={} dmax={}".format(np.min(a),np.max(a)))
         nb_negative = np.sum(a<0)
         assert(nb_negative <= nb_negative_tol) 
@@ -597,13 +1277,13 @@ class region_of_interest(object):
         if nb_negative:
             logger.warning("There are {} negative voxels in the mask !! OK because below {}".format(nb_negative, nb_negative_tol))
     
-        dhist,dedges = np.histogram(a,bins=nbins,range=(dmin,dmax), weights=amask[np.nonzero(amask)])
+        dhist,dedges = np.histogram(a,bins=nbins,range=(dmin,dmax), weights=w.astype(float))
         logger.debug("got histogram with {} edges for {} bins".format(len(dedges),nbins))
         adhist=np.array(dhist,dtype=float)
         adedges=np.array(dedges,dtype=float)
         dsum=0.5*np.sum(adhist*adedges[:-1]+adhist*adedges[1:])
         dhistsum=np.sum(adhist)
-        amasksum=np.sum(amask)
+        amasksum=roimask.sum()
         adchist=np.cumsum(adhist)
         logger.debug("dhistsum={} amasksum={} adchist[-1]={}".format(dhistsum,amasksum,adchist[-1]))
         assert(round(amasksum, 7)==round(dhistsum,7))
@@ -632,9 +1312,10 @@ class region_of_interest(object):
             assert(dd50>0)
             assert(dd02>0)
             # interpolate
-            d98 = ( (adchist[i98]-dsum98)*dedges[i98-1] + (dsum98-adchist[i98-1])*dedges[i98] ) / dd98
-            d50 = ( (adchist[i50]-dsum50)*dedges[i50-1] + (dsum50-adchist[i50-1])*dedges[i50] ) / dd50
-            d02 = ( (adchist[i02]-dsum02)*dedges[i02-1] + (dsum02-adchist[i02-1])*dedges[i02] ) / dd02
+            # note: adchist[i] is the cumulative histogram at the upper edge of bin i, dedges[i+1]
+            d98 = ( (adchist[i98]-dsum98)*dedges[i98] + (dsum98-adchist[i98-1])*dedges[i98+1] ) / dd98
+            d50 = ( (adchist[i50]-dsum50)*dedges[i50] + (dsum50-adchist[i50-1])*dedges[i50+1] ) / dd50
+            d02 = ( (adchist[i02]-dsum02)*dedges[i02] + (dsum02-adchist[i02-1])*dedges[i02+1] ) / dd02
             # convert from normal statistics to medical physics statistics conventions
             logger.debug("getting dvh")
             dvh=-1.0*adchist/dhistsum+1.0
@@ -666,6 +1347,88 @@ class region_of_interest(object):
     #    roi_intsc = region_of_interest(contours_list=contour_layers_intsc)
     #    return roi_intsc
 
+# number of bits set in each byte value
+_popcount8 = np.array([bin(i).count("1") for i in range(256)],dtype=np.uint8)
+
+def _packed_masks(roilist,xvoxel,yvoxel,nworkers=1):
+    """
+    Compute binary masks of the ROIs on a common grid (voxel size `xvoxel` and
+    `yvoxel`, and in z the smallest slice distance of the ROIs) and pack them
+    into bits along x. The packed masks only cover the bounding box of each
+    ROI; they are returned as pairs of (z,y,byte) offset and packed array,
+    together with the voxel volume. The byte offsets refer to the same grid
+    for all ROIs, so overlapping parts can be combined with bitwise operations.
+    """
+    dz = min([r.dz for r in roilist])
+    assert(dz>0)
+    assert(xvoxel>0)
+    assert(yvoxel>0)
+    bb = bounding_box(bb=roilist[0].bb)
+    for roi in roilist[1:]:
+        bb.merge(roi.bb)
+    spacing = np.array([xvoxel,yvoxel,dz],dtype=float)
+    # voxel centers on the layers in z, margin of two voxels in x and y
+    orig = bb.mincorner - np.array([2*xvoxel,2*yvoxel,0.])
+    dimsize = np.array(np.round((bb.maxcorner-orig)/spacing),dtype=int) + np.array([3,3,1])
+    img = itk.GetImageFromArray(np.zeros(dimsize[::-1],dtype=np.uint8))
+    img.SetOrigin(orig)
+    img.SetSpacing(spacing)
+    # the common grid depends on the list of ROIs, so the masks are not cached
+    masks = region_of_interest.get_masks(roilist,img,corrected=False,nworkers=nworkers,compact=True,cache=False)
+    packed = []
+    for mask in masks:
+        if mask is None or mask.amask.size == 0:
+            packed.append(((0,0,0),np.zeros((0,0,0),dtype=np.uint8)))
+            continue
+        iz,iy,ix = mask.offset
+        pad = ix % 8
+        abin = mask.binary
+        if pad:
+            abin = np.pad(abin,((0,0),(0,0),(pad,0)))
+        packed.append(((iz,iy,ix//8),np.packbits(abin,axis=2)))
+    return packed,float(np.prod(spacing))
+
+def _packed_overlap(packed):
+    """
+    Bitwise AND of the overlapping part of a list of packed masks (see `_packed_masks`), None if they do not overlap.
+    """
+    lo = np.max([offset for offset,bits in packed],axis=0)
+    hi = np.min([np.array(offset)+bits.shape for offset,bits in packed],axis=0)
+    if np.any(hi<=lo):
+        return None
+    overlap = None
+    for offset,bits in packed:
+        sub = bits[tuple([slice(l-o,h-o) for l,h,o in zip(lo,hi,offset)])]
+        overlap = sub.copy() if overlap is None else np.bitwise_and(overlap,sub,out=overlap)
+    return overlap
+
+def _popcount(bits):
+    return 0 if bits is None else int(np.sum(_popcount8[bits],dtype=np.int64))
+
+def get_intersection_volumes(roilist,xvoxel=0.5,yvoxel=0.5,nworkers=1):
+    """
+    Compute the volumes (in mm3) of the pairwise intersections of the ROIs in
+    `roilist`, as a symmetric N x N matrix; the diagonal contains the volumes of
+    the ROIs themselves. The ROIs are rasterized once on a common grid with
+    voxel size `xvoxel` and `yvoxel` (in mm; in z the slice distance of the
+    ROIs is used), with the binary masks of `region_of_interest.get_masks`.
+    The masks are packed into bits, so that each intersection is a bitwise AND
+    and a bit count, restricted to the overlap of the bounding boxes.
+    The accuracy depends on the grid: a voxel counts as inside if its center is.
+    """
+    n = len(roilist)
+    volumes = np.zeros((n,n),dtype=float)
+    if n == 0:
+        return volumes
+    packed,voxel_volume = _packed_masks(roilist,xvoxel,yvoxel,nworkers)
+    for i in range(n):
+        volumes[i,i] = _popcount(packed[i][1])*voxel_volume
+        for j in range(i+1,n):
+            if volumes[i,i] == 0.:
+                break
+            volumes[i,j] = volumes[j,i] = _popcount(_packed_overlap([packed[i],packed[j]]))*voxel_volume
+    return volumes
+
 def get_intersection_volume(roilist,xvoxel=1.,yvoxel=1.):
     # There is probably a clever way to compute this by constructing
     # an "intersection contour" for each layer: for each contour, keep only
@@ -674,6 +1437,9 @@ def get_intersection_volume(roilist,xvoxel=1.,yvoxel=1.):
     # Instead we'll just make a grid of points and get the volume of the combined mask.
     # With xvoxel and yvoxel the caller can tweak the voxel size of the mask in x and y.
     # In z the voxel size is given by the incoming ROIs.
+    # The masks are the fractional ("corrected") masks, so the result is the sum over
+    # the voxels of the product of the fractions, unlike `get_intersection_volumes`,
+    # which counts voxels with their center inside all ROIs.
     dz = min([r.dz for r in roilist])
     assert(dz>0)
     assert(xvoxel>0)
@@ -687,14 +1453,17 @@ def get_intersection_volume(roilist,xvoxel=1.,yvoxel=1.):
     spacing = np.array([xvoxel,yvoxel,dz],dtype=float)
     bb.add_margins(2*spacing)
     dimsize = np.array(np.round((bb.maxcorner-bb.mincorner)/spacing),dtype=int)
-    #img = sitk.Image(dimsize,sitk.sitkUInt8)
-    img = itk.GetImageFromArray(np.zeros(dimsize[::-2],dtype=np.uint8))
+    img = itk.GetImageFromArray(np.zeros(dimsize[::-1],dtype=np.uint8))
     img.SetOrigin(bb.mincorner)
     img.SetSpacing(spacing)
-    itkmask = itk.GetArrayFromImage(roilist[0].get_mask(img))
-    for roi in roilist[1:]:
-        itkmask *= itk.GetArrayFromImage(roi.get_mask(img))
-    return np.sum(itkmask)*np.prod(spacing)
+    # the grid is only used for this intersection, so the masks are not cached
+    masks = region_of_interest.get_masks(roilist,img,compact=True,cache=False)
+    if any([mask is None for mask in masks]):
+        return 0.
+    amask = masks[0].full_array().astype(float)
+    for mask in masks[1:]:
+        amask *= mask.full_array()
+    return np.sum(amask)*np.prod(spacing)
 
 def intersect_segments(S1, S2, eps = 1e-10):
     perp = lambda u,v: (u[0]*v[1]-v[0]*u[1])
@@ -715,4 +1484,431 @@ def intersect_segments(S1, S2, eps = 1e-10):
         return np.array([])
     return(S1[0] + sI * u)
 
+################################################################################
+# UNIT TESTS                                                                   #
+################################################################################
+
+import unittest
+import tempfile
+try:
+    from .logging_conf import LoggedTestCase
+except:
+    LoggedTestCase=unittest.TestCase
+
+def _star_contour(z,npoints=37,r=20.,dr=5.,x0=1.3,y0=-0.7,clockwise=False):
+    phi = np.linspace(0,2*np.pi,npoints,endpoint=False)
+    if clockwise:
+        phi = phi[::-1]
+    rr = r+dr*np.sin(5*phi)
+    return np.stack([rr*np.cos(phi)+x0,rr*np.sin(phi)+y0,np.full(npoints,z)],axis=1)
+
+class test_coverage(LoggedTestCase):
+    def setUp(self):
+        self.orig = (-30.,-30.)
+        self.space = (1.1,0.9)
+        self.dims = (56,70)
+    def area(self,layer):
+        # shoelace formula, the contours are not explicitly closed
+        a = 0.
+        for paths,sign in ((layer.inclusion,1),(layer.exclusion,-1)):
+            for q in paths:
+                x,y = q.vertices[:,0],q.vertices[:,1]
+                a += sign*0.5*abs(np.sum(x*np.roll(y,-1)-np.roll(x,-1)*y))
+        return a
+    def supersampled(self,layer,nsub=40):
+        # brute force: fraction of sub-voxel centers inside the contours
+        xs = self.orig[0]-0.5*self.space[0]+(np.arange(self.dims[0]*nsub)+0.5)*self.space[0]/nsub
+        ys = self.orig[1]-0.5*self.space[1]+(np.arange(self.dims[1]*nsub)+0.5)*self.space[1]/nsub
+        xx,yy = np.meshgrid(xs,ys)
+        inside = layer.contains_points(np.stack([xx.ravel(),yy.ravel()],axis=1)).reshape(xx.shape)
+        return inside.reshape(self.dims[1],nsub,self.dims[0],nsub).mean(axis=(1,3))
+    def test_square(self):
+        # unit square, both orientations, partially outside of the grid
+        sq = np.array([[0.5,0.25],[3.,0.25],[3.,2.5],[0.5,2.5]])
+        for uv in (sq,sq[::-1],sq-1.):
+            cov = _polygon_coverage(uv,2,3)
+            expected = np.zeros((2,3))
+            u0,v0 = np.min(uv,axis=0)
+            u1,v1 = np.max(uv,axis=0)
+            for i in range(2):
+                for j in range(3):
+                    expected[i,j] = max(min(j+1,u1)-max(j,u0),0)*max(min(i+1,v1)-max(i,v0),0)
+            self.assertTrue(np.allclose(cov,expected))
+    def test_star(self):
+        layer = contour_layer(_star_contour(5.))
+        cov = layer.get_coverage(self.orig,self.space,self.dims)
+        self.assertEqual(cov.shape,self.dims[::-1])
+        self.assertAlmostEqual(np.sum(cov)*np.prod(self.space),self.area(layer),places=6)
+        self.assertTrue(np.allclose(cov,self.supersampled(layer),atol=0.02))
+    def test_hole(self):
+        layer = contour_layer(_star_contour(5.),ignore_orientation=False)
+        layer.add_contour(_star_contour(5.,r=8.,dr=1.,clockwise=True))
+        self.assertEqual(len(layer.exclusion),1)
+        cov = layer.get_coverage(self.orig,self.space,self.dims)
+        self.assertAlmostEqual(np.sum(cov)*np.prod(self.space),self.area(layer),places=6)
+        self.assertTrue(np.allclose(cov,self.supersampled(layer),atol=0.02))
+    def test_compatible_with_correct_mask(self):
+        # The old correction is only exact for voxels in which the contour is a straight line.
+        # The area of the ROI and the voxels that are fully inside or outside should agree.
+        layer = contour_layer(_star_contour(5.,npoints=400))
+        xpoints = self.orig[0]+self.space[0]*np.arange(self.dims[0])
+        ypoints = self.orig[1]+self.space[1]*np.arange(self.dims[1])
+        xymesh = np.meshgrid(xpoints,ypoints)
+        xyflat = np.stack([xymesh[0].ravel(),xymesh[1].ravel()],axis=1)
+        old = np.array(layer.correct_mask(xymesh,layer.contains_points(xyflat).astype(float),self.space)).reshape(self.dims[::-1])
+        new = layer.get_coverage(self.orig,self.space,self.dims)
+        self.assertLess(abs(np.sum(new)-np.sum(old)),1e-3*np.sum(new))
+        self.assertTrue(np.array_equal(new==1.,old==1.))
+        self.assertTrue(np.array_equal(new==0.,old==0.))
+        self.assertLess(np.max(np.abs(new-old)),0.5)
+    def test_get_mask(self):
+        layers = [contour_layer(_star_contour(z)) for z in (-3.,0.,3.)]
+        roi = region_of_interest(contours_list=layers)
+        img = itk.GetImageFromArray(np.zeros((5,)+self.dims[::-1],dtype=np.float32))
+        img.SetOrigin(self.orig+(-6.,))
+        img.SetSpacing(self.space+(3.,))
+        amask = itk.GetArrayFromImage(roi.get_mask(img,corrected=True))
+        self.assertEqual(amask.dtype,np.float32)
+        self.assertTrue((amask[0]==0).all())
+        self.assertTrue((amask[4]==0).all())
+        for iz in range(1,4):
+            self.assertTrue(np.allclose(amask[iz],layers[iz-1].get_coverage(self.orig,self.space,self.dims)))
+        bmask = itk.GetArrayFromImage(roi.get_mask(img,corrected=False))
+        self.assertTrue(((bmask>0) <= (amask>0)).all())
+
+class test_scanline(LoggedTestCase):
+    def test_random_polygons(self):
+        # including self-intersecting polygons and vertices on grid points
+        rng = np.random.default_rng(42)
+        xpoints = np.linspace(-50.,50.,101)
+        ypoints = np.linspace(-40.,40.,81)
+        xx,yy = np.meshgrid(xpoints,ypoints)
+        xyflat = np.stack([xx.ravel(),yy.ravel()],axis=1)
+        for trial in range(60):
+            vertices = rng.uniform(-45.,45.,(rng.integers(3,40),2))
+            if trial%2:
+                vertices = np.round(vertices)
+            expected = matplotlib.path.Path(vertices).contains_points(xyflat).reshape(xx.shape)
+            self.assertTrue(np.array_equal(_scanline_inside(vertices,xpoints,ypoints),expected))
+    def test_get_mask_engines(self):
+        layers = [contour_layer(_star_contour(z),ignore_orientation=False) for z in (-3.,0.,3.)]
+        layers[1].add_contour(_star_contour(0.,r=8.,dr=1.,clockwise=True))
+        roi = region_of_interest(contours_list=layers)
+        img = itk.GetImageFromArray(np.zeros((5,60,50),dtype=np.float32))
+        img.SetOrigin((-25.3,-29.9,-6.))
+        img.SetSpacing((1.,1.,3.))
+        mask_path = itk.GetArrayFromImage(roi.get_mask(img,corrected=False,engine="path"))
+        mask_scan = itk.GetArrayFromImage(roi.get_mask(img,corrected=False,engine="scanline"))
+        self.assertEqual(mask_scan.dtype,mask_path.dtype)
+        self.assertTrue(np.sum(mask_scan)>0)
+        self.assertTrue(np.array_equal(mask_path,mask_scan))
+        with self.assertRaises(ValueError):
+            roi.get_mask(img,corrected=False,engine="magic")
+
+class test_get_masks(LoggedTestCase):
+    def test_batch(self):
+        rois = []
+        for k in range(4):
+            layers = [contour_layer(_star_contour(z,r=5.+3*k,dr=k,x0=2.*k)) for z in (-3.+3*k,3*k,3.+3*k)]
+            rois.append(region_of_interest(contours_list=layers))
+        img = itk.GetImageFromArray(np.zeros((8,60,50),dtype=np.float32))
+        img.SetOrigin((-25.3,-29.9,-6.))
+        img.SetSpacing((1.,1.,3.))
+        for corrected in (False,True):
+            expected = [itk.GetArrayFromImage(roi.get_mask(img,corrected=corrected)) for roi in rois]
+            for nworkers in (1,2):
+                # forget the masks computed by get_mask
+                for roi in rois:
+                    roi.masks.clear()
+                masks = region_of_interest.get_masks(rois,img,corrected=corrected,nworkers=nworkers)
+                self.assertEqual(len(masks),len(rois))
+                for mask,aexp in zip(masks,expected):
+                    amask = itk.GetArrayFromImage(mask)
+                    self.assertEqual(amask.dtype,aexp.dtype)
+                    self.assertTrue(np.sum(amask)>0)
+                    self.assertTrue(np.array_equal(amask,aexp))
+                    self.assertTrue(np.allclose(mask.GetOrigin(),img.GetOrigin()))
+
+class test_roi_mask(LoggedTestCase):
+    def setUp(self):
+        layers = [contour_layer(_star_contour(z,r=8.,dr=2.)) for z in (-3.,0.,3.)]
+        self.roi = region_of_interest(contours_list=layers)
+        self.img = itk.GetImageFromArray(np.random.uniform(1.,2.,(8,60,50)).astype(np.float32))
+        self.img.SetOrigin((-25.3,-29.9,-9.))
+        self.img.SetSpacing((1.,1.,3.))
+    def test_compact(self):
+        for corrected in (True,False):
+            roimask = self.roi.get_roi_mask(self.img,corrected=corrected)
+            afull = itk.GetArrayFromImage(self.roi.get_mask(self.img,corrected=corrected))
+            self.assertEqual(roimask.shape,afull.shape)
+            self.assertEqual(roimask.amask.dtype,afull.dtype)
+            self.assertTrue(np.array_equal(roimask.full_array(),afull))
+            # the bounding box is tight
+            self.assertEqual(roimask.offset[0],2)
+            self.assertEqual(roimask.amask.shape[0],3)
+            for axis in range(3):
+                other = tuple([a for a in range(3) if a != axis])
+                self.assertTrue(np.any(roimask.binary,axis=other)[[0,-1]].all())
+            self.assertLess(roimask.amask.size,0.1*afull.size)
+            adose = itk.GetArrayViewFromImage(self.img)
+            self.assertTrue(np.allclose(np.sum(roimask.apply(adose)),np.sum(adose*afull)))
+            values,weights = roimask.values(adose)
+            self.assertTrue(np.array_equal(values,adose[afull>0]))
+            self.assertTrue(np.array_equal(weights,afull[afull>0]))
+            self.assertAlmostEqual(roimask.sum(),np.sum(afull,dtype=float))
+    def test_no_overlap(self):
+        img = itk.GetImageFromArray(np.zeros((4,10,10),dtype=np.float32))
+        img.SetOrigin((100.,100.,-3.))
+        roimask = self.roi.get_roi_mask(img)
+        self.assertEqual(roimask.amask.size,0)
+        self.assertEqual(np.sum(itk.GetArrayFromImage(roimask.to_full(img))),0)
+    def test_dvh(self):
+        dvh = self.roi.get_dvh(self.img,nbins=20,dmin=0.,dmax=2.)
+        dvh,dedges,dhistsum,dsum,d02,d50,d98 = dvh
+        self.assertAlmostEqual(dhistsum,self.roi.get_roi_mask(self.img).sum(),places=6)
+        self.assertEqual(len(dvh),20)
+        self.assertTrue(d98<d50<d02)
+        self.assertTrue(1.3<d50<1.7)
+    def test_dvh_quantiles(self):
+        # The D-values are interpolated in the bin in which the cumulative histogram
+        # crosses the volume fraction. They used to be interpolated between the edges
+        # of the previous bin, i.e. they were one bin width (here 0.1) too low.
+        rng = np.random.default_rng(7)
+        img = itk.GetImageFromArray(rng.uniform(1.,2.,(8,60,50)).astype(np.float32))
+        img.CopyInformation(self.img)
+        dvh,dedges,dhistsum,dsum,d02,d50,d98 = self.roi.get_dvh(img,nbins=20,dmin=0.,dmax=2.)
+        values,weights = self.roi.get_roi_mask(img).values(itk.GetArrayViewFromImage(img))
+        order = np.argsort(values)
+        cweights = np.cumsum(weights[order],dtype=float)
+        for d,q in ((d98,0.02),(d50,0.50),(d02,0.98)):
+            exact = values[order][np.searchsorted(cweights,q*cweights[-1])]
+            self.assertAlmostEqual(d,exact,delta=0.02)
+
+class test_dvhs(LoggedTestCase):
+    def test_histogram_bins(self):
+        a = np.concatenate([np.random.uniform(-1.,3.,1000),np.linspace(0.,2.,41)])
+        ibin,edges = _histogram_bins(a,0.,2.,20)
+        hist,hedges = np.histogram(a,bins=20,range=(0.,2.))
+        self.assertTrue(np.array_equal(edges,hedges))
+        self.assertTrue(np.array_equal(np.bincount(ibin[(ibin>=0)&(ibin<20)],minlength=20),hist))
+        self.assertEqual(np.sum(ibin==-1),np.sum(a<0.))
+        self.assertEqual(np.sum(ibin==20),np.sum(a>2.))
+    def test_compare_with_get_dvh(self):
+        rois = []
+        for k in range(3):
+            layers = [contour_layer(_star_contour(z,r=5.+3*k,dr=k,x0=2.*k)) for z in (-3.+3*k,3*k,3.+3*k)]
+            rois.append(region_of_interest(contours_list=layers))
+        img = itk.GetImageFromArray(np.random.uniform(1.,2.,(8,60,50)).astype(np.float32))
+        img.SetOrigin((-25.3,-29.9,-6.))
+        img.SetSpacing((1.,1.,3.))
+        masks = region_of_interest.get_masks(rois,img,compact=True,nworkers=1)
+        # get_dvh needs an empty first bin
+        table = get_dvhs(img,masks+[None],names=["a","b","c","none"],nbins=50,dmin=0.)
+        rows = table.rows()
+        self.assertEqual([row["roi"] for row in rows],["a","b","c","none"])
+        for roi,mask,row,dvh in zip(rois,masks,rows,table.dvh):
+            dvh1,dedges,dhistsum,dsum,d02,d50,d98 = roi.get_dvh(img,nbins=50,dmin=0.)
+            self.assertTrue(np.allclose(dedges,table.edges))
+            self.assertTrue(np.allclose(dvh,dvh1))
+            self.assertAlmostEqual(row["volume [voxels]"],dhistsum)
+            for key,value in (("D02",d02),("D50",d50),("D98",d98)):
+                self.assertAlmostEqual(row[key],value,places=5)
+            values,weights = mask.values(itk.GetArrayFromImage(img))
+            self.assertAlmostEqual(row["mean dose"],float(np.sum(values*weights)/np.sum(weights)),places=5)
+        self.assertEqual(rows[-1]["volume [voxels]"],0)
+        self.assertTrue(np.isnan(rows[-1]["D50"]))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            table.write(os.path.join(tmpdir,"dvh.txt"))
+            with open(os.path.join(tmpdir,"dvh.txt")) as fp:
+                lines = fp.readlines()
+            self.assertEqual(len(lines),1+4+1+1+50)
+        self.assertEqual(len(table.as_dict("plan")),12)
+
+class test_intersection_volumes(LoggedTestCase):
+    def _cylinder(self,x0,y0,r,zs):
+        return region_of_interest(contours_list=[contour_layer(_star_contour(z,npoints=360,r=r,dr=0.,x0=x0,y0=y0)) for z in zs])
+    def test_circles(self):
+        zs = [-6.,-3.,0.,3.,6.]
+        rois = [self._cylinder(0.,0.,10.,zs),self._cylinder(10.,0.,10.,zs),self._cylinder(50.,0.,5.,zs),self._cylinder(2.13,3.07,3.,zs[1:3])]
+        volumes = get_intersection_volumes(rois,0.25,0.25,nworkers=1)
+        self.assertEqual(volumes.shape,(4,4))
+        self.assertTrue(np.array_equal(volumes,volumes.T))
+        # the ROI volume is the number of layers times the area times dz
+        for i,(r,nz) in enumerate(((10.,5),(10.,5),(5.,5),(3.,2))):
+            self.assertAlmostEqual(volumes[i,i]/(nz*3.*np.pi*r**2),1.,delta=0.02)
+        # lens shaped intersection of two circles with radius r at distance r
+        r = 10.
+        lens = 2*r**2*np.arccos(0.5)-0.5*r*np.sqrt(3*r**2)
+        self.assertAlmostEqual(volumes[0,1]/(5*3.*lens),1.,delta=0.02)
+        self.assertEqual(volumes[0,2],0.)
+        self.assertEqual(volumes[1,2],0.)
+        # the small cylinder is inside the first and partially inside the second one
+        self.assertEqual(volumes[0,3],volumes[3,3])
+        self.assertTrue(0.<volumes[1,3]<volumes[3,3])
+        # the intersection of all ROIs in a list, with fractional masks
+        self.assertAlmostEqual(get_intersection_volume(rois[:2],0.25,0.25)/volumes[0,1],1.,delta=0.02)
+        self.assertEqual(get_intersection_volume(rois,0.25,0.25),0.)
+        self.assertAlmostEqual(get_intersection_volume([rois[0],rois[1],rois[3]],0.25,0.25)/volumes[1,3],1.,delta=0.05)
+        # masks on the ad hoc grids are not kept
+        for roi in rois:
+            self.assertEqual(len(roi.masks),0)
+    def test_packed_masks(self):
+        rois = [self._cylinder(x0,y0,r,[0.,3.,6.]) for x0,y0,r in ((0.,0.,10.),(7.3,2.1,6.),(-3.,-8.,4.))]
+        packed,voxel_volume = _packed_masks(rois,0.7,0.9)
+        self.assertAlmostEqual(voxel_volume,0.7*0.9*3.)
+        img = itk.GetImageFromArray(np.zeros((3,40,40),dtype=np.uint8))
+        for i in range(3):
+            for j in range(3):
+                overlap = _packed_overlap([packed[i],packed[j]])
+                # compare with the unpacked masks
+                full = []
+                for offset,bits in (packed[i],packed[j]):
+                    a = np.unpackbits(bits,axis=2)
+                    afull = np.zeros((3,64,80),dtype=np.uint8)
+                    afull[offset[0]:offset[0]+a.shape[0],offset[1]:offset[1]+a.shape[1],8*offset[2]:8*offset[2]+a.shape[2]] = a
+                    full.append(afull)
+                self.assertEqual(_popcount(overlap),np.sum(full[0]&full[1]))
+
+class test_roi_registry(LoggedTestCase):
+    def setUp(self):
+        import pydicom
+        from pydicom.dataset import Dataset, FileMetaDataset
+        from pydicom.sequence import Sequence
+        from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+        ds = Dataset()
+        ds.SOPClassUID = "1.2.840.10008.5.1.4.1.1.481.3"
+        ds.SOPInstanceUID = generate_uid()
+        ds.StructureSetROISequence = Sequence()
+        ds.ROIContourSequence = Sequence()
+        ds.RTROIObservationsSequence = Sequence()
+        # ROI 3 has no type, ROI 4 has no contours; the sequences are in different orders
+        for nr,name,roitype,r in ((1,"body","EXTERNAL",20.),(2,"ptv","PTV",5.),(3,"notype","",3.),(4,"nocontour","OAR",0.)):
+            ssroi = Dataset()
+            ssroi.ROINumber = nr
+            ssroi.ROIName = name
+            ds.StructureSetROISequence.append(ssroi)
+            if roitype:
+                obs = Dataset()
+                obs.ReferencedROINumber = nr
+                obs.RTROIInterpretedType = roitype
+                ds.RTROIObservationsSequence.insert(0,obs)
+            if r > 0:
+                ci = Dataset()
+                ci.ReferencedROINumber = nr
+                ci.ContourSequence = Sequence()
+                for z in (-3.,0.,3.):
+                    contour = Dataset()
+                    img = Dataset()
+                    img.ReferencedSOPInstanceUID = generate_uid()
+                    contour.ContourImageSequence = Sequence([img])
+                    points = np.round(_star_contour(z,r=r,dr=r/4.),3)
+                    contour.NumberOfContourPoints = len(points)
+                    contour.ContourData = [str(v) for v in points.ravel()]
+                    ci.ContourSequence.append(contour)
+                ds.ROIContourSequence.append(ci)
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+        ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.rs = os.path.join(self.tmpdir.name,"rs.dcm")
+        ds.save_as(self.rs,write_like_original=False)
+        self.dcmread = pydicom.dcmread
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def test_registry(self):
+        ds = self.dcmread(self.rs)
+        registry = roi_registry(ds)
+        self.assertEqual(registry.roinames,["body","ptv"])
+        self.assertEqual(registry.roinumbers,["1","2"])
+        self.assertEqual(registry.roitypes,["EXTERNAL","PTV"])
+        self.assertTrue("ptv" in registry)
+        self.assertTrue(2 in registry)
+        self.assertFalse("notype" in registry)
+        # the contours have not been decoded yet
+        for ci in ds.ROIContourSequence:
+            for contour in ci.ContourSequence:
+                self.assertIsInstance(contour.get_item(0x30060050).value,bytes)
+        roi = registry.get("ptv")
+        self.assertIs(registry.get(2),roi)
+        self.assertEqual(roi.roinr,"2")
+        self.assertEqual(len(roi.contour_layers),3)
+        self.assertEqual(roi.npoints_total,3*3*37)
+        with self.assertRaises(ValueError):
+            registry.get("nocontour")
+    def test_contour_points(self):
+        # bulk conversion of the raw data and conversion of the pydicom values give the same points
+        ds_raw = self.dcmread(self.rs)
+        ds_converted = self.dcmread(self.rs)
+        for ci_raw,ci_conv in zip(ds_raw.ROIContourSequence,ds_converted.ROIContourSequence):
+            for c_raw,c_conv in zip(ci_raw.ContourSequence,ci_conv.ContourSequence):
+                expected = np.array([float(v) for v in c_conv.ContourData]).reshape(-1,3)
+                self.assertTrue(np.array_equal(contour_points(c_raw),expected))
+                self.assertTrue(np.array_equal(contour_points(c_conv),expected))
+
+class test_mask_cache(LoggedTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+    def tearDown(self):
+        use_mask_cache(None)
+        self.tmpdir.cleanup()
+    def test_put_get(self):
+        cache = roi_mask_cache(self.tmpdir.name)
+        key = roi_mask_cache.key("1.2.3",4,_mask_key((0.,0.,0.),(1.,1.,1.),(5,4,3),None,True))
+        self.assertIsNone(cache.get(key))
+        amask = np.random.uniform(0.,1.,(3,4,5)).astype(np.float32)
+        cache.put(key,amask,(1,2,3))
+        bmask,offset = cache.get(key)
+        self.assertEqual(offset,(1,2,3))
+        self.assertEqual(bmask.dtype,np.float32)
+        self.assertTrue(np.array_equal(amask,bmask))
+        # a different ROI number, geometry or flag gives a different key
+        self.assertNotEqual(key,roi_mask_cache.key("1.2.3",5,_mask_key((0.,0.,0.),(1.,1.,1.),(5,4,3),None,True)))
+        self.assertNotEqual(key,roi_mask_cache.key("1.2.3",4,_mask_key((0.,0.,0.),(1.,1.,2.),(5,4,3),None,True)))
+        self.assertNotEqual(key,roi_mask_cache.key("1.2.3",4,_mask_key((0.,0.,0.),(1.,1.,1.),(5,4,3),None,False)))
+        # but rounding errors are ignored
+        self.assertEqual(key,roi_mask_cache.key("1.2.3",4,_mask_key((1e-9,0.,0.),(1.,1.,1.),(5,4,3),None,True)))
+        # corrupt files are removed
+        with open(cache.path(key),"wb") as fp:
+            fp.write(b"garbage")
+        self.assertIsNone(cache.get(key))
+        self.assertFalse(os.path.exists(cache.path(key)))
+    def test_eviction(self):
+        cache = roi_mask_cache(self.tmpdir.name,max_megabytes=1.)
+        amasks = [np.random.uniform(0.,1.,(10,100,100)).astype(np.float32) for i in range(4)]
+        keys = ["{:040x}".format(i) for i in range(4)]
+        for i,(key,amask) in enumerate(zip(keys,amasks)):
+            cache.put(key,amask)
+            os.utime(cache.path(key),ns=(i*10**9,i*10**9))
+            if i == 1:
+                # access the first mask, so it is more recently used than the second one
+                cache.get(keys[0])
+        # random floats do not compress: only two masks (0.4 MB each) fit in the cache
+        self.assertIsNotNone(cache.get(keys[0]))
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertIsNone(cache.get(keys[2]))
+        self.assertIsNotNone(cache.get(keys[3]))
+    def test_get_mask(self):
+        use_mask_cache(self.tmpdir.name)
+        layers = [contour_layer(_star_contour(z)) for z in (-3.,0.,3.)]
+        roi = region_of_interest(contours_list=layers)
+        roi.ss_uid = "1.2.3"
+        img = itk.GetImageFromArray(np.zeros((5,60,50),dtype=np.float32))
+        img.SetOrigin((-25.3,-29.9,-6.))
+        img.SetSpacing((1.,1.,3.))
+        amask = itk.GetArrayFromImage(roi.get_mask(img))
+        self.assertEqual(len(os.listdir(self.tmpdir.name)),1)
+        # a new ROI object for the same structure set gets the mask from the cache
+        roi2 = region_of_interest(contours_list=layers)
+        roi2.ss_uid = "1.2.3"
+        roi2._mask_plan = None
+        for mask in (roi2.get_mask(img),region_of_interest.get_masks([roi2],img)[0]):
+            self.assertTrue(np.array_equal(itk.GetArrayFromImage(mask),amask))
+            self.assertTrue(np.allclose(mask.GetOrigin(),img.GetOrigin()))
+        # the binary mask is a different mask
+        roi2.masks.clear()
+        with self.assertRaises(TypeError):
+            roi2.get_mask(img,corrected=False)
+
+
 # vim: set et softtabstop=4 sw=4 smartindent:
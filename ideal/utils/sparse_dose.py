@@ -0,0 +1,249 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Dose sums that only cover the part of the grid where the dose is nonzero.
+
+With a small target inside a large (e.g. full CT) dose grid, most voxels of
+the subjob doses are zero. A `box_accumulator` keeps the sums only for a box
+(in the z,y,x index space of the full grid) that contains all nonzero dose
+values added so far. The box is learned from the first dose that is added and
+grows when a later dose has nonzero values outside of it (with some margin, to
+avoid growing in many small steps). The dense full grid array is only created
+when it is needed, e.g. to write the final dose.
+
+A `dose_box` is a single dose distribution in the same representation: the
+values inside a box and zero outside. `dose_box.from_array` crops a (possibly
+memory mapped) dose array, copying only the values inside the box.
+"""
+
+import numpy as np
+import logging
+logger=logging.getLogger(__name__)
+
+def nonzero_box(a):
+    """
+    Smallest box containing all nonzero values of array `a`. Returns the lower
+    and upper (exclusive) indices per axis as two tuples, or None if all values are zero.
+    """
+    nz = (a != 0)
+    lo,hi = list(),list()
+    for axis in range(a.ndim):
+        other = tuple([i for i in range(a.ndim) if i != axis])
+        idx = np.flatnonzero(np.any(nz,axis=other))
+        if len(idx) == 0:
+            return None
+        lo.append(int(idx[0]))
+        hi.append(int(idx[-1])+1)
+    return tuple(lo),tuple(hi)
+
+def _union(box1,box2):
+    if box1 is None:
+        return box2
+    if box2 is None:
+        return box1
+    return tuple(np.minimum(box1[0],box2[0]).tolist()),tuple(np.maximum(box1[1],box2[1]).tolist())
+
+def _slices(box):
+    return tuple([slice(l,h) for l,h in zip(*box)])
+
+def _nonzero_outside(a,box):
+    """
+    True if array `a` has nonzero values outside of `box`. Only the slabs around the box are read.
+    """
+    lo,hi = box
+    for axis in range(a.ndim):
+        # the slabs below and above the box along this axis, restricted to the box along the previous axes
+        pre = tuple([slice(lo[i],hi[i]) for i in range(axis)])
+        if np.any(a[pre+(slice(0,lo[axis]),)]) or np.any(a[pre+(slice(hi[axis],None),)]):
+            return True
+    return False
+
+class dose_box(object):
+    """
+    Dose distribution on a grid with shape `shape` that is zero outside the box
+    starting at index `lo`; `data` is the array with the values inside the box.
+    """
+    def __init__(self,shape,lo,data):
+        self.shape = tuple(shape)
+        self.lo = tuple(lo)
+        self.data = data
+    @property
+    def hi(self):
+        return tuple([l+n for l,n in zip(self.lo,self.data.shape)])
+    @property
+    def box(self):
+        return self.lo,self.hi
+    @property
+    def slices(self):
+        return _slices(self.box)
+    @staticmethod
+    def from_array(a,hint=None,dtype=None):
+        """
+        Crop array `a` to the box with its nonzero values. If a box `hint` is given
+        (e.g. the box of an accumulator) and `a` is zero outside of it, then `a` is
+        cropped to `hint` without searching for the nonzero values inside it.
+        The values in the box are copied (and converted to `dtype`, if given).
+        """
+        if hint is None or _nonzero_outside(a,hint):
+            box = _union(hint,nonzero_box(a))
+            if box is None:
+                box = ((0,)*a.ndim,(0,)*a.ndim)
+        else:
+            box = hint
+        data = np.array(a[_slices(box)],dtype=dtype if dtype is not None else a.dtype.newbyteorder("="))
+        return dose_box(a.shape,box[0],data)
+    def to_full(self,dtype=None):
+        full = np.zeros(self.shape,dtype=dtype if dtype is not None else self.data.dtype)
+        full[self.slices] = self.data
+        return full
+
+class box_accumulator(object):
+    """
+    Sums of dose distributions (`nchannels` sums, e.g. the dose and the squared
+    dose, or the dose per batch) on a grid with shape `shape`, stored only for
+    the box that covers all nonzero values added so far. When the box grows, it
+    is extended by `margin` (a fraction of the grid size) on each side.
+    """
+    def __init__(self,shape,nchannels=1,dtype=float,margin=0.05):
+        self.shape = tuple(shape)
+        self.nchannels = nchannels
+        self.dtype = dtype
+        self.margin = [int(np.ceil(margin*n)) for n in self.shape]
+        self.box = None
+        self.data = None
+    @property
+    def slices(self):
+        return None if self.box is None else _slices(self.box)
+    @property
+    def box_shape(self):
+        return (0,)*len(self.shape) if self.box is None else tuple([h-l for l,h in zip(*self.box)])
+    @property
+    def nbytes(self):
+        return 0 if self.data is None else self.data.nbytes
+    def grow(self,box):
+        """
+        Make sure that the accumulator box contains `box`.
+        """
+        if box is None or (self.box is not None and _union(self.box,box) == self.box):
+            return
+        if np.prod([h-l for l,h in zip(*box)]) == 0:
+            return
+        lo,hi = _union(self.box,box)
+        if self.box is not None:
+            # grow with a margin, only on the sides where it is needed
+            lo = tuple([max(0,l-m) if l < l0 else l for l,l0,m in zip(lo,self.box[0],self.margin)])
+            hi = tuple([min(n,h+m) if h > h0 else h for h,h0,m,n in zip(hi,self.box[1],self.margin,self.shape)])
+        data = np.zeros((self.nchannels,)+tuple([h-l for l,h in zip(lo,hi)]),dtype=self.dtype)
+        if self.box is not None:
+            inner = tuple([slice(l0-l,h0-l) for l,l0,h0 in zip(lo,*self.box)])
+            data[(slice(None),)+inner] = self.data
+            logger.debug("growing dose box from {} to {}".format(self.box,(lo,hi)))
+        self.box = (lo,hi)
+        self.data = data
+    def add(self,dbox,channel=0,weight=1.,power=1):
+        """
+        Add `weight` times `dbox.data**power` to the sum in `channel`.
+        """
+        if dbox.shape != self.shape:
+            raise ValueError("dose shape {} differs from accumulator shape {}".format(dbox.shape,self.shape))
+        if dbox.data.size == 0:
+            return
+        self.grow(dbox.box)
+        inner = tuple([slice(l-l0,h-l0) for l,h,l0 in zip(dbox.lo,dbox.hi,self.box[0])])
+        values = dbox.data if power == 1 else dbox.data.astype(self.dtype)**power
+        if weight == 1:
+            self.data[(channel,)+inner] += values
+        else:
+            self.data[(channel,)+inner] += weight*values
+    def crop(self,a,dtype=None):
+        """
+        Crop array `a` (on the full grid) to a `dose_box`, using the accumulator box as a hint.
+        """
+        return dose_box.from_array(a,self.box,dtype)
+    def channel(self,channel=0):
+        """
+        The sum in `channel`, for the accumulator box only (an empty array if nothing was added).
+        """
+        if self.data is None:
+            return np.zeros((0,)*len(self.shape),dtype=self.dtype)
+        return self.data[channel]
+    def full(self,channel=0,dtype=None):
+        """
+        The sum in `channel` as a dense array on the full grid.
+        """
+        full = np.zeros(self.shape,dtype=dtype if dtype is not None else self.dtype)
+        if self.data is not None:
+            full[self.slices] = self.data[channel]
+        return full
+    def add_to(self,full,channel=0):
+        """
+        Add the sum in `channel` to dense array `full` (on the full grid).
+        """
+        if self.data is not None:
+            full[self.slices] += self.data[channel]
+        return full
+
+################################################################################
+# UNIT TESTS                                                                   #
+################################################################################
+
+import unittest
+try:
+    from .logging_conf import LoggedTestCase
+except:
+    LoggedTestCase=unittest.TestCase
+
+class test_sparse_dose(LoggedTestCase):
+    def spot(self,shape,center,radius):
+        z,y,x = np.meshgrid(*[np.arange(n) for n in shape],indexing="ij")
+        r2 = (z-center[0])**2+(y-center[1])**2+(x-center[2])**2
+        return np.where(r2<radius**2,np.random.uniform(0.5,1.5,shape),0.).astype(np.float32)
+    def test_nonzero_box(self):
+        a = np.zeros((10,20,30))
+        self.assertIsNone(nonzero_box(a))
+        a[3,5,7] = 1.
+        a[4,15,8] = -1.
+        self.assertEqual(nonzero_box(a),((3,5,7),(5,16,9)))
+        self.assertFalse(_nonzero_outside(a,((3,5,7),(5,16,9))))
+        self.assertTrue(_nonzero_outside(a,((3,5,7),(5,15,9))))
+        self.assertTrue(_nonzero_outside(a,((4,5,7),(5,16,9))))
+    def test_accumulation(self):
+        shape = (40,50,60)
+        doses = [self.spot(shape,(20,25,30),6) for i in range(5)]
+        # a later dose reaches further out
+        doses.append(self.spot(shape,(20,25,40),8))
+        acc = box_accumulator(shape,nchannels=2)
+        dense = np.zeros(shape)
+        dense2 = np.zeros(shape)
+        for i,a in enumerate(doses):
+            dbox = acc.crop(a)
+            self.assertTrue(np.array_equal(dbox.to_full(),a))
+            acc.add(dbox,0)
+            acc.add(dbox,1,weight=1./(i+1),power=2)
+            dense += a
+            dense2 += a.astype(float)**2/(i+1)
+        self.assertTrue(np.allclose(acc.full(0),dense))
+        self.assertTrue(np.allclose(acc.full(1),dense2))
+        self.assertTrue(np.allclose(acc.add_to(np.ones(shape),0),dense+1))
+        self.assertLess(np.prod(acc.box_shape),np.prod(shape)/5)
+        # subtract a contribution again
+        acc.add(acc.crop(doses[-1]),0,weight=-1.)
+        self.assertTrue(np.allclose(acc.full(0),dense-doses[-1]))
+        with self.assertRaises(ValueError):
+            acc.add(dose_box.from_array(np.ones((4,5,6))))
+    def test_empty(self):
+        shape = (4,5,6)
+        acc = box_accumulator(shape)
+        dbox = acc.crop(np.zeros(shape))
+        self.assertEqual(dbox.data.size,0)
+        acc.add(dbox)
+        self.assertIsNone(acc.box)
+        self.assertEqual(acc.channel(0).size,0)
+        self.assertTrue(np.array_equal(acc.full(0),np.zeros(shape)))
+
+# vim: set et softtabstop=4 sw=4 smartindent: